@@ -1,5 +1,8 @@
 from __future__ import print_function
 
+import os
+import sqlite3
+
 import matplotlib
 matplotlib.use("Agg")  # noqa E402
 import matplotlib.pyplot as plt
@@ -9,18 +12,147 @@ np.seterr(all="ignore")  # noqa E402
 
 import lsst.afw.geom as afwGeom
 from lsst.display.matplotlib.matplotlib import AsinhNormalize
-from lsst.pex.config import Config, Field, ListField, DictField
+from lsst.log import Log
+from lsst.pex.config import Config, Field, ListField, DictField, ChoiceField
+from lsst.pipe.base import Struct
 
-from .utils import Data, Stats, E1Resids, E2Resids, checkIdLists, fluxToPlotString
+from .utils import (Data, calculateClippedStats, solveSysErrors, histogramBinIndices, binnedStatistics,
+                    E1Resids, E2Resids, checkIdLists, fluxToPlotString, magnitude, ellipseAxes)
+from .renderScheduler import getRenderScheduler
 from .plotUtils import (annotateAxes, AllLabeller, setPtSize, labelVisit, plotText, plotCameraOutline,
-                        plotTractOutline, plotPatchOutline, plotCcdOutline, labelCamera, getQuiver,
-                        getRaDecMinMaxPatchList, bboxToXyCoordLists, makeAlphaCmap, buildTractImage)
+                        plotTractOutline, plotPatchOutline, plotCcdOutline, getCcdOutlines, labelCamera,
+                        getQuiver, binWhiskers, getRaDecMinMaxPatchList, bboxToXyCoordLists, makeAlphaCmap,
+                        plotDensity, TractImagePyramid)
 
-__all__ = ["AnalysisConfig", "Analysis"]
+__all__ = ["AnalysisConfig", "Analysis", "AnalysisMetrics", "startAnalysisMetrics", "getAnalysisMetrics",
+           "finishAnalysisMetrics"]
 
 colorList = ["blue", "red", "green", "black", "yellow", "cyan", "magenta", ]
 
 
+class AnalysisMetrics(object):
+    """Collector of the statistics calculated by each `Analysis.plotAll` call
+
+    Parameters
+    ----------
+    statsOnly : `bool`
+       Only calculate the selections and statistics, skipping all rendering?
+    """
+    columns = [("dataId", "TEXT"), ("shortName", "TEXT"), ("postFix", "TEXT"), ("label", "TEXT"),
+               ("mean", "REAL"), ("stdev", "REAL"), ("median", "REAL"), ("clip", "REAL"),
+               ("num", "INTEGER"), ("total", "INTEGER"), ("forcedMean", "REAL"), ("sysErr", "REAL")]
+
+    def __init__(self, statsOnly=False):
+        self.statsOnly = statsOnly
+        self.rows = []
+
+    @staticmethod
+    def dataIdToString(dataId):
+        return "-".join("{0:s}{1:s}".format(str(key), str(dataId[key]).replace(",", "x"))
+                        for key in sorted(dataId))
+
+    def record(self, dataId, shortName, stats, postFix=""):
+        """Record the statistics of each label of an analysis"""
+        if not stats:
+            return
+        dataIdStr = self.dataIdToString(dataId) if dataId is not None else ""
+
+        def toFloat(value):
+            return float(value) if value is not None else None
+
+        for label, labelStats in stats.items():
+            self.rows.append((dataIdStr, shortName, postFix, label, toFloat(labelStats.mean),
+                              toFloat(labelStats.stdev), toFloat(labelStats.median), toFloat(labelStats.clip),
+                              int(labelStats.num), int(labelStats.total), toFloat(labelStats.forcedMean),
+                              toFloat(getattr(labelStats, "sysErr", None))))
+
+    @classmethod
+    def getFilename(cls, filenamer, dataId):
+        """Return the name of the metrics table for dataId, alongside the plots made by filenamer"""
+        plotDir = os.path.dirname(filenamer(dataId, description="metrics", style="stats"))
+        return os.path.join(plotDir, "metrics-{:s}.sqlite3".format(cls.dataIdToString(dataId)))
+
+    def write(self, filename):
+        """Write the recorded statistics to the ``metrics`` table of an SQLite database
+
+        The table is written to a temporary file that is renamed on completion, so readers never
+        see a partially written table.
+        """
+        tempFilename = filename + ".tmp"
+        if os.path.exists(tempFilename):
+            os.remove(tempFilename)
+        connection = sqlite3.connect(tempFilename)
+        try:
+            connection.execute("CREATE TABLE metrics ({:s})".format(
+                ", ".join("{0:s} {1:s}".format(name, sqlType) for name, sqlType in self.columns)))
+            placeholders = ", ".join("?"*len(self.columns))
+            connection.executemany("INSERT INTO metrics VALUES ({:s})".format(placeholders), self.rows)
+            connection.commit()
+        finally:
+            connection.close()
+        os.rename(tempFilename, filename)
+
+
+class _ResolvedFilenamer(dict):
+    """Filenamer replacement returning the filenames (keyed by style) resolved in the main process"""
+    def __call__(self, dataId, description, style):
+        return self[style]
+
+
+_analysisMetrics = None
+
+
+def startAnalysisMetrics(statsOnly=False):
+    """Start collecting the statistics of all subsequent `Analysis.plotAll` calls
+
+    Parameters
+    ----------
+    statsOnly : `bool`
+       Skip all rendering while collecting?
+
+    Returns
+    -------
+    metrics : `AnalysisMetrics`
+       The collector.
+    """
+    global _analysisMetrics
+    _analysisMetrics = AnalysisMetrics(statsOnly=statsOnly)
+    return _analysisMetrics
+
+
+def getAnalysisMetrics():
+    """Return the current metrics collector (`None` if not collecting)"""
+    return _analysisMetrics
+
+
+def finishAnalysisMetrics(filenamer=None, dataId=None, log=None):
+    """Stop collecting statistics, optionally writing them out
+
+    Parameters
+    ----------
+    filenamer : `lsst.pipe.analysis.utils.Filenamer`, optional
+       Filenamer for the plots of dataId, used to place the metrics table.  Nothing is written if `None`.
+    dataId : `dict`, optional
+       Data identifier of the metrics table.
+    log : `lsst.log.Log`, optional
+       Logger for reporting the table written.
+
+    Returns
+    -------
+    metrics : `AnalysisMetrics`
+       The collector that was stopped (`None` if not collecting).
+    """
+    global _analysisMetrics
+    metrics = _analysisMetrics
+    _analysisMetrics = None
+    if metrics is not None and filenamer is not None:
+        filename = AnalysisMetrics.getFilename(filenamer, dataId)
+        metrics.write(filename)
+        if log is not None:
+            log.info("Wrote {0:d} rows of metrics to {1:s}".format(len(metrics.rows), filename))
+    return metrics
+
+
 class AnalysisConfig(Config):
     flags = ListField(dtype=str, doc="Flags of objects to ignore",
                       default=["base_SdssCentroid_flag", "slot_Centroid_flag", "base_PsfFlux_flag",
@@ -57,6 +189,14 @@ class AnalysisConfig(Config):
                                 doc="Flux ratio for visit level star/galaxy classifiaction")
     coaddClassFluxRatio = Field(dtype=float, default=0.985,
                                 doc="Flux ratio for coadd level star/galaxy classifiaction")
+    densityThreshold = Field(dtype=int, default=200000,
+                             doc=("Number of points above which scatter plots are rendered as a single image "
+                                  "of the points binned onto the output pixel grid (<= 0: never)"))
+    densityStatistic = ChoiceField(dtype=str, default="mean",
+                                   doc="Statistic by which to colour the pixels of density-rendered plots",
+                                   allowed={"mean": "Mean quantity in each pixel",
+                                            "median": "Median quantity in each pixel",
+                                            "count": "Number of points in each pixel"})
 
 
 class Analysis(object):
@@ -64,8 +204,9 @@ class Analysis(object):
 
     def __init__(self, catalog, func, quantityName, shortName, config, qMin=-0.2, qMax=0.2,
                  prefix="", flags=[], goodKeys=[], errFunc=None, labeller=AllLabeller(), flagsCat=None,
-                 magThreshold=21, forcedMean=None, unitScale=1.0):
+                 magThreshold=21, forcedMean=None, unitScale=1.0, log=None):
         self.catalog = catalog
+        self.log = log if log is not None else Log.getLogger("pipe.analysis")
         self.func = func
         self.quantityName = quantityName
         self.shortName = shortName
@@ -101,7 +242,7 @@ class Analysis(object):
             self.fluxColumn = self.config.fluxColumn
         else:
             self.fluxColumn = "flux_psf_flux"
-        self.mag = -2.5*np.log10(catalog[prefix + self.fluxColumn])
+        self.mag = magnitude(catalog, prefix + self.fluxColumn)
 
         self.good = np.isfinite(self.quantity) & np.isfinite(self.mag) if self.quantity is not None else None
         if errFunc is not None:
@@ -120,6 +261,7 @@ class Analysis(object):
         for kk in goodKeys:
             self.good &= flagsCat[prefix + kk]
 
+        self._statsCache = {}
         if labeller is not None:
             labels = labeller(catalog)
             self.data = {name: Data(catalog, self.quantity, self.mag, self.good & (labels == value),
@@ -283,21 +425,27 @@ class Analysis(object):
         axHistx.set_yscale("log", nonposy="clip")
         axHisty.set_xscale("log", nonposx="clip")
         nTotal = 0
-        fullSampleMag = []
-        fullSampleQuantity = []
+        # Histogram bin indices of each label, shared by the full sample and per-label histograms
+        xBinIndex = {}
+        yBinIndex = {}
+        numXBins, numYBins = len(xBins) - 1, len(yBins) - 1
+        fullSampleXCounts = np.zeros(numXBins)
+        fullSampleYCounts = np.zeros(numYBins)
         for name, data in self.data.items():
             if data.plot:
                 nTotal += len(data.mag)
-                fullSampleMag.extend(data.mag)
-                fullSampleQuantity.extend(data.quantity)
+                xBinIndex[name] = histogramBinIndices(data.mag, xBins)[0]
+                yBinIndex[name] = histogramBinIndices(data.quantity, yBins)[0]
+                fullSampleXCounts += binnedStatistics(xBinIndex[name], numXBins).count
+                fullSampleYCounts += binnedStatistics(yBinIndex[name], numYBins).count
         axScatterYlim = np.around(nTotal, -1*int(np.floor(np.log10(nTotal))))
         axHistx.set_ylim(0.8, axScatterYlim)
         axHisty.set_xlim(0.8, axScatterYlim)
 
         # Plot full sample histograms
-        axHistx.hist(fullSampleMag, bins=xBins, color="black", alpha=0.4, label="All")
-        axHisty.hist(fullSampleQuantity, bins=yBins, color="black", orientation="horizontal",
-                     alpha=0.4, label="All")
+        axHistx.hist(xBins[:-1], bins=xBins, weights=fullSampleXCounts, color="black", alpha=0.4, label="All")
+        axHisty.hist(yBins[:-1], bins=yBins, weights=fullSampleYCounts, color="black",
+                     orientation="horizontal", alpha=0.4, label="All")
 
         nxSyDecimal = int(-1.0*np.around(np.log10(0.05*abs(self.magThreshold - magMin)) - 0.5))
         xSyBinwidth = min(0.1, np.around(0.05*abs(self.magThreshold - magMin), nxSyDecimal))
@@ -331,17 +479,15 @@ class Analysis(object):
                 # compute running stats (just for plotting)
                 if self.calibUsedOnly == 0 and plotRunStats:
                     belowThresh = data.mag < magMax  # set lower if you want to truncate plotted running stats
-                    numHist, dataHist = np.histogram(data.mag[belowThresh], bins=len(xSyBins))
+                    runBinIndex, dataHist = histogramBinIndices(data.mag[belowThresh], len(xSyBins))
+                    runBinStats = binnedStatistics(runBinIndex, len(xSyBins), data.quantity[belowThresh])
+                    numHist = runBinStats.count
                     # Only plot running stats if there are a significant number of data points per bin.
                     # Computed here as the mean number in the brightest 20% of the bins which we require
                     # to be greater than 12.
                     if numHist[0:max(1, int(0.2*len(xSyBins)))].mean() > 12:
-                        syHist, dataHist = np.histogram(data.mag[belowThresh], bins=len(xSyBins),
-                                                        weights=data.quantity[belowThresh])
-                        syHist2, datahist = np.histogram(data.mag[belowThresh], bins=len(xSyBins),
-                                                         weights=data.quantity[belowThresh]**2)
-                        meanHist = syHist/numHist
-                        stdHist = np.sqrt(syHist2/numHist - meanHist*meanHist)
+                        meanHist = runBinStats.mean
+                        stdHist = runBinStats.stdev
                         runStats.append(axScatter.errorbar((dataHist[1:] + dataHist[:-1])/2, meanHist,
                                         yerr=stdHist, fmt="o", mfc=cornflowerBlue, mec="k",
                                         ms=2, ecolor="k", label="Running\nstats (all\nstars)"))
@@ -350,7 +496,7 @@ class Analysis(object):
                 # Make highlight as a background ring of larger size than the data point size
                 for flag, threshValue, color in highlightList:
                     label = flag.replace("merge_measurement", "ref")
-                    highlightSelection = data.catalog[flag] > threshValue
+                    highlightSelection = data.column(flag) > threshValue
                     if name == "star" or name == "all":
                         dataPoints.append(
                             axScatter.scatter(data.mag[highlightSelection],
@@ -362,19 +508,28 @@ class Analysis(object):
                                           s=1.3*ptSize, marker="o", facecolors="none", edgecolors=color)
 
             # Plot data.  Appending in dataPoints for the sake of the legend
-            dataPoints.append(axScatter.scatter(data.mag, data.quantity, s=ptSize, marker="o",
-                                                facecolors=data.color, edgecolors="none", label=name,
-                                                alpha=alpha))
-
-            axHistx.hist(data.mag, bins=xBins, color=histColor, alpha=0.6, label=name)
-            axHisty.hist(data.quantity, bins=yBins, color=histColor, alpha=0.6, orientation="horizontal",
-                         label=name)
+            if self.useDensity(len(data.mag)):
+                plotDensity(axScatter, data.mag, data.quantity, statistic="count", color=data.color,
+                            extent=axScatter.get_xlim() + axScatter.get_ylim())
+                dataPoints.append(axScatter.scatter([], [], s=ptSize, marker="o", facecolors=data.color,
+                                                    edgecolors="none", label=name))
+            else:
+                dataPoints.append(axScatter.scatter(data.mag, data.quantity, s=ptSize, marker="o",
+                                                    facecolors=data.color, edgecolors="none", label=name,
+                                                    alpha=alpha))
+
+            axHistx.hist(xBins[:-1], bins=xBins, weights=binnedStatistics(xBinIndex[name], numXBins).count,
+                         color=histColor, alpha=0.6, label=name)
+            axHisty.hist(yBins[:-1], bins=yBins, weights=binnedStatistics(yBinIndex[name], numYBins).count,
+                         color=histColor, alpha=0.6, orientation="horizontal", label=name)
         # Make sure stars used histogram is plotted last
         for name, data in self.data.items():
             if stats is not None and (name == "star" or name == "all"):
-                dataUsed = data.quantity[stats[name].dataUsed]
-                axHisty.hist(dataUsed, bins=yBins, color=data.color, orientation="horizontal", alpha=1.0,
-                             label="used in Stats")
+                if name not in yBinIndex:
+                    yBinIndex[name] = histogramBinIndices(data.quantity, yBins)[0]
+                usedBinIndex = yBinIndex[name][stats[name].dataUsed]
+                axHisty.hist(yBins[:-1], bins=yBins, weights=binnedStatistics(usedBinIndex, numYBins).count,
+                             color=data.color, orientation="horizontal", alpha=1.0, label="used in Stats")
         axHistx.tick_params(axis="x", which="major", direction="in", length=5)
         axHistx.xaxis.set_minor_locator(AutoMinorLocator(2))
         axHisty.tick_params(axis="y", which="major", direction="in", length=5)
@@ -405,7 +560,7 @@ class Analysis(object):
                 lenNameMax = len(name) if len(name) > lenNameMax else lenNameMax
         xLoc += 0.02*lenNameMax
 
-        plt.text(xLoc, yLoc, "N$_{all}$  = " + str(len(fullSampleMag)), ha="left", va="center",
+        plt.text(xLoc, yLoc, "N$_{all}$  = " + str(nTotal), ha="left", va="center",
                  fontsize=8, transform=axScatter.transAxes, color="black", alpha=0.6)
         for name, data in self.data.items():
             if not (data.mag.any() and data.plot):
@@ -429,6 +584,8 @@ class Analysis(object):
     def plotHistogram(self, filename, numBins=51, stats=None, hscRun=None, matchRadius=None, zpLabel=None,
                       forcedStr=None, camera=None, filterStr=None):
         """Plot histogram of quantity"""
+        if self.statsOnly:
+            return
         fig, axes = plt.subplots(1, 1)
         axes.axvline(0, linestyle="--", color="0.6")
         numMax = 0
@@ -547,6 +704,7 @@ class Analysis(object):
             plotPatchOutline(axes, tractInfo, patchList)
 
         stats0 = None
+        densityImage = None
         for name, data in self.data.items():
             if name is not dataName:
                 continue
@@ -554,7 +712,7 @@ class Analysis(object):
                 continue
             if ptSize is None:
                 ptSize = 0.7*setPtSize(len(data.mag))
-            stats0 = self.calculateStats(data.quantity, good[data.selection])
+            stats0 = self.labelStatistics(magThreshold)[name]
             selection = data.selection & good
             if highlightList is not None:
                 # Make highlight as a background ring of larger size than the data point size
@@ -565,8 +723,16 @@ class Analysis(object):
                     axes.scatter(ra[highlightSelection], dec[highlightSelection], s=1.4*ptSize,
                                  marker="o", facecolors="none", edgecolors="white", label=label)
 
-            axes.scatter(ra[selection], dec[selection], s=ptSize, marker="o", lw=0, label=name,
-                         c=data.quantity[good[data.selection]], cmap=cmap, vmin=vMin, vmax=vMax)
+            if self.useDensity(selection.sum()):
+                densityImage = plotDensity(axes, ra[selection], dec[selection],
+                                           values=data.quantity[good[data.selection]],
+                                           statistic=self.config.densityStatistic,
+                                           extent=(raMin, raMax, decMin, decMax), cmap=cmap, vmin=vMin,
+                                           vmax=vMax)
+                axes.scatter([], [], s=ptSize, marker="o", lw=0, label=name, color=cmap(0.5))
+            else:
+                axes.scatter(ra[selection], dec[selection], s=ptSize, marker="o", lw=0, label=name,
+                             c=data.quantity[good[data.selection]], cmap=cmap, vmin=vMin, vmax=vMax)
 
         if stats0 is None:  # No data to plot
             return
@@ -580,8 +746,11 @@ class Analysis(object):
 
         mappable = plt.cm.ScalarMappable(cmap=cmap, norm=plt.Normalize(vmin=vMin, vmax=vMax))
         mappable._A = []        # fake up the array of the scalar mappable. Urgh...
-        cb = plt.colorbar(mappable)
         colorbarLabel = self.quantityName + " " + filterLabelStr
+        if densityImage is not None and self.config.densityStatistic == "count":
+            mappable = densityImage
+            colorbarLabel = "Number per pixel " + filterLabelStr
+        cb = plt.colorbar(mappable)
         fontSize = min(10, max(6, 10 - int(np.log(max(1, len(colorbarLabel) - 55)))))
         cb.ax.tick_params(labelsize=max(6, fontSize - 1))
         cb.set_label(colorbarLabel, fontsize=fontSize, rotation=270, labelpad=15)
@@ -680,8 +849,17 @@ class Analysis(object):
 
     def plotQuiver(self, catalog, filename, log, cmap=plt.cm.Spectral, stats=None, dataId=None, butler=None,
                    camera=None, ccdList=None, tractInfo=None, patchList=None, hscRun=None,
-                   matchRadius=None, zpLabel=None, forcedStr=None, dataName="star", scale=1):
-        """Plot ellipticity residuals quiver plot"""
+                   matchRadius=None, zpLabel=None, forcedStr=None, dataName="star", scale=1,
+                   binning="none", cellsPerPatch=4, numCells=32):
+        """Plot ellipticity residuals quiver plot
+
+        The whiskers may be averaged in bins, so the plot remains legible (and quick to render) however
+        many stars there are: ``binning`` is "none" (one whisker per star), "cell" (``cellsPerPatch``
+        cells along each side of each patch if ``tractInfo`` is provided, otherwise ``numCells`` cells
+        along each side of the plot) or "ccd" (per CCD, requiring a ccdId column; "cell" otherwise).
+        """
+        if self.statsOnly:
+            return
 
         # Use HSM algorithm results if present, if not, use SDSS Shape
         if "ext_shapeHSM_HsmSourceMoments_xx" in catalog.schema:
@@ -749,14 +927,47 @@ class Analysis(object):
         e2 = e2(catalog)
         e = np.sqrt(e1**2 + e2**2)
 
+        if binning == "ccd" and "ccdId" not in catalog.schema:
+            log.warn("No ccdId column in catalog: binning quiver plot whiskers by cell rather than by CCD")
+            binning = "cell"
+        if binning == "ccd":
+            ccdIds, binIndex = np.unique(catalog["ccdId"], return_inverse=True)
+            numBins = len(ccdIds)
+            catStr += " (mean per CCD)"
+        elif binning == "cell":
+            if tractInfo is not None:
+                # Sub-cells of each patch, in tract pixel coordinates
+                tractBBox = tractInfo.getBBox()
+                patchDims = tractInfo.getPatchInnerDimensions()
+                numPatches = tractInfo.getNumPatches()
+                xBins = (tractBBox.getMinX() +
+                         np.arange(numPatches[0]*cellsPerPatch + 1)*patchDims[0]/cellsPerPatch)
+                yBins = (tractBBox.getMinY() +
+                         np.arange(numPatches[1]*cellsPerPatch + 1)*patchDims[1]/cellsPerPatch)
+                xIndex, xBins = histogramBinIndices(catalog.getX(), xBins)
+                yIndex, yBins = histogramBinIndices(catalog.getY(), yBins)
+                catStr += " (mean per 1/{:d} patch)".format(cellsPerPatch)
+            else:
+                xIndex, xBins = histogramBinIndices(ra, numCells, range=(raMin, raMax))
+                yIndex, yBins = histogramBinIndices(dec, numCells, range=(decMin, decMax))
+                catStr += " (mean per cell)"
+            numBins = (len(xBins) - 1)*(len(yBins) - 1)
+            binIndex = np.where((xIndex >= 0) & (yIndex >= 0), xIndex + (len(xBins) - 1)*yIndex, -1)
+        if binning == "none":
+            whiskers = Struct(x=ra, y=dec, e1=e1, e2=e2)
+        else:
+            whiskers = binWhiskers(ra, dec, e1, e2, binIndex, numBins)
+        eWhiskers = np.hypot(whiskers.e1, whiskers.e2)
+
         nz = matplotlib.colors.Normalize()
-        nz.autoscale(e)
+        nz.autoscale(eWhiskers)
         cax, _ = matplotlib.colorbar.make_axes(plt.gca())
         cb = matplotlib.colorbar.ColorbarBase(cax, cmap=plt.cm.jet, norm=nz)
         cb.set_label(
             r"ellipticity residual: $\delta_e$ = $\sqrt{(e1_{src}-e1_{psf})^2 + (e2_{src}-e2_{psf})^2}$")
 
-        getQuiver(ra, dec, e1, e2, axes, color=plt.cm.jet(nz(e)), scale=scale, width=0.002, label=catStr)
+        getQuiver(whiskers.x, whiskers.y, whiskers.e1, whiskers.e2, axes, color=plt.cm.jet(nz(eWhiskers)),
+                  scale=scale, width=0.002, label=catStr)
 
         filterStr = dataId['filter'] if dataId is not None else ''
         filterLabelStr = "[" + filterStr + "]"
@@ -802,7 +1013,8 @@ class Analysis(object):
 
     def plotInputCounts(self, catalog, filename, log, dataId, butler, tractInfo, patchList=None, camera=None,
                         forcedStr=None, cmap=plt.cm.viridis, alpha=0.5, doPlotTractImage=True,
-                        doPlotPatchOutline=True, sizeFactor=5.0, maxDiamPix=1000):
+                        doPlotPatchOutline=True, sizeFactor=5.0, maxDiamPix=1000, dpi=1200, numTiles=1,
+                        tractImageDir=None):
         """Plot grayscale image of tract with base_InputCounts_value overplotted
 
         Parameters
@@ -850,49 +1062,57 @@ class Analysis(object):
            that number strictly applies to the objects centroid pixel).  If a
            given object gets truncated to this size, an opaque blue outline
            will be plotted around its ellipse.  Default is 1000.
+        dpi : `int`, optional
+           Resolution of the (untiled) plot, which needs to be fairly high to
+           see enough detail.  Default is 1200.
+        numTiles : `int`, optional
+           Number of tiles along each side of the tract.  If greater than 1,
+           the plot is written at ``dpi/numTiles`` and each of the
+           ``numTiles**2`` tiles is additionally written (to ``filename`` with
+           a "-tile<x>-<y>" suffix) at that resolution, such that together
+           they keep the detail of the full resolution plot.  Default is 1.
+        tractImageDir : `str`, optional
+           Directory in which to cache the downsampled tract images (see
+           `lsst.pipe.analysis.plotUtils.TractImagePyramid`).  If `None`, the
+           images are not cached.  Default is `None`.
         """
+        if self.statsOnly:
+            return
         tractBbox = tractInfo.getBBox()
         tractWcs = tractInfo.getWcs()
 
         fig, axes = plt.subplots(1, 1)
         axes.tick_params(which="both", direction="in", top=True, right=True, labelsize=7)
         if doPlotTractImage:
-            image = buildTractImage(butler, dataId, tractInfo, patchList=patchList)
-            med = np.nanmedian(image.array)
-            mad = np.nanmedian(abs(image.array - med))
+            # Display the downsampled level of the tract image matching the output resolution
+            pyramid = TractImagePyramid(butler, dataId, tractInfo, patchList=patchList,
+                                        directory=tractImageDir, log=log)
+            window = axes.get_window_extent()
+            binning = pyramid.selectBinning(window.width*dpi/fig.dpi, window.height*dpi/fig.dpi)
+            imageArray = pyramid.getArray(binning)
+            med = np.nanmedian(imageArray)
+            mad = np.nanmedian(abs(imageArray - med))
             imMin = med - 3.0*1.4826*mad
             imMax = med + 10.0*1.4826*mad
             norm = AsinhNormalize(minimum=imMin, dataRange=imMax - imMin, Q=8)
-            extent = tractBbox.getMinX(), tractBbox.getMaxX(), tractBbox.getMinY(), tractBbox.getMaxY()
-            axes.imshow(image.array, extent=extent, cmap="gray_r", norm=norm)
+            axes.imshow(imageArray, extent=pyramid.getExtent(binning), origin="lower", cmap="gray_r",
+                        norm=norm)
 
         centStr = "slot_Centroid"
         shapeStr = "slot_Shape"
 
-        diamAs = []  # matplotlib.patches.Ellipse wants diameters for width and height
-        diamBs = []
-        thetas = []
-        edgeColors = []  # to outline any ellipses truncated at maxDiamPix
-
-        for src in catalog:
-            edgeColor = "None"
-            srcQuad = afwGeom.Quadrupole(src[shapeStr + "_xx"], src[shapeStr + "_yy"], src[shapeStr + "_xy"])
-            srcEllip = afwGeom.ellipses.Axes(srcQuad)
-            diamA = srcEllip.getA()*2.0*sizeFactor
-            diamB = srcEllip.getB()*2.0*sizeFactor
-            # Truncate ellipse size to a maximum width or height of maxDiamPix
-            if diamA > maxDiamPix or diamB > maxDiamPix:
-                edgeColor = "blue"
-                if diamA >= diamB:
-                    diamB = diamB*(maxDiamPix/diamA)
-                    diamA = maxDiamPix
-                else:
-                    diamA = diamA*(maxDiamPix/diamB)
-                    diamB = maxDiamPix
-            diamAs.append(diamA)
-            diamBs.append(diamB)
-            thetas.append(np.degrees(srcEllip.getTheta()))
-            edgeColors.append(edgeColor)
+        # matplotlib's EllipseCollection wants diameters for widths and heights
+        srcEllipses = ellipseAxes(catalog[shapeStr + "_xx"], catalog[shapeStr + "_yy"],
+                                  catalog[shapeStr + "_xy"])
+        diamAs = srcEllipses.a*2.0*sizeFactor
+        diamBs = srcEllipses.b*2.0*sizeFactor
+        thetas = np.degrees(srcEllipses.theta)
+        # Truncate ellipse size to a maximum width or height of maxDiamPix (and outline those truncated)
+        truncateScale = maxDiamPix/np.maximum(diamAs, maxDiamPix)
+        truncated = truncateScale < 1.0
+        diamAs *= truncateScale
+        diamBs *= truncateScale
+        edgeColors = np.where(truncated, "blue", "None")
 
         xyOffsets = np.stack((catalog[centStr + "_x"], catalog[centStr + "_y"]), axis=-1)
         inputCounts = catalog["base_InputCount_value"]
@@ -902,10 +1122,9 @@ class Analysis(object):
         norm = matplotlib.colors.BoundaryNorm(bounds, alphaCmap.N)
         alphaCmap.set_under("r")
 
-        ellipsePatchList = [matplotlib.patches.Ellipse(xy=xy, width=diamA, height=diamB, angle=theta)
-                            for xy, diamA, diamB, theta in zip(xyOffsets, diamAs, diamBs, thetas)]
-        ec = matplotlib.collections.PatchCollection(ellipsePatchList, cmap=alphaCmap, norm=norm,
-                                                    edgecolors=edgeColors, linewidth=0.1)
+        ec = matplotlib.collections.EllipseCollection(diamAs, diamBs, thetas, units="xy", offsets=xyOffsets,
+                                                      transOffset=axes.transData, cmap=alphaCmap, norm=norm,
+                                                      edgecolors=edgeColors, linewidth=0.1)
 
         ec.set_array(inputCounts)
         axes.add_collection(ec)
@@ -931,10 +1150,10 @@ class Analysis(object):
                                       tractBbox.getMinY()).getPosition(units=afwGeom.degrees)
 
         textKwargs = dict(ha="left", va="center", transform=axes.transAxes, fontsize=7, color="blue")
-        plt.text(-0.05, -0.07, str("{:.2f}".format(tract00.getX())), **textKwargs)
-        plt.text(-0.17, 0.00, str("{:.2f}".format(tract00.getY())), **textKwargs)
-        plt.text(0.96, -0.07, str("{:.2f}".format(tractN0.getX())), **textKwargs)
-        plt.text(-0.17, 0.97, str("{:.2f}".format(tract0N.getY())), **textKwargs)
+        cornerLabels = [plt.text(-0.05, -0.07, str("{:.2f}".format(tract00.getX())), **textKwargs),
+                        plt.text(-0.17, 0.00, str("{:.2f}".format(tract00.getY())), **textKwargs),
+                        plt.text(0.96, -0.07, str("{:.2f}".format(tractN0.getX())), **textKwargs),
+                        plt.text(-0.17, 0.97, str("{:.2f}".format(tract0N.getY())), **textKwargs)]
         textKwargs["fontsize"] = 8
         plt.text(0.45, -0.11, "RA (deg)", **textKwargs)
         plt.text(-0.19, 0.5, "DEC (deg)", rotation=90, **textKwargs)
@@ -947,7 +1166,20 @@ class Analysis(object):
         if forcedStr is not None:
             plotText(forcedStr, plt, axes, 0.99, -0.1, prefix="cat: ", fontSize=8, color="green")
 
-        fig.savefig(filename, dpi=1200)  # Needs to be fairly hi-res to see enough detail
+        numTiles = max(1, numTiles)
+        fig.savefig(filename, dpi=dpi//numTiles)
+        if numTiles > 1:
+            # The RA/Dec corner labels refer to the full tract
+            for label in cornerLabels:
+                label.set_visible(False)
+            xEdges = np.linspace(tractBbox.getMinX(), tractBbox.getMaxX(), numTiles + 1)
+            yEdges = np.linspace(tractBbox.getMinY(), tractBbox.getMaxY(), numTiles + 1)
+            base, ext = os.path.splitext(filename)
+            for ix in range(numTiles):
+                for iy in range(numTiles):
+                    axes.set_xlim(xEdges[ix], xEdges[ix + 1])
+                    axes.set_ylim(yEdges[iy], yEdges[iy + 1])
+                    fig.savefig("{0:s}-tile{1:d}-{2:d}{3:s}".format(base, ix, iy, ext), dpi=dpi//numTiles)
         plt.close(fig)
 
     def plotAll(self, dataId, filenamer, log, enforcer=None, butler=None, camera=None, ccdList=None,
@@ -955,6 +1187,65 @@ class Analysis(object):
                 postFix="", plotRunStats=True, highlightList=None, extraLabels=None):
         """Make all plots"""
         stats = self.stats
+        metrics = getAnalysisMetrics()
+        if metrics is not None:
+            metrics.record(dataId, self.shortName, stats, postFix=postFix)
+        if not self.statsOnly:
+            figureKwargs = dict(stats=stats, butler=butler, camera=camera, ccdList=ccdList,
+                                tractInfo=tractInfo, patchList=patchList, hscRun=hscRun,
+                                matchRadius=matchRadius, zpLabel=zpLabel, forcedStr=forcedStr,
+                                postFix=postFix, plotRunStats=plotRunStats, highlightList=highlightList,
+                                extraLabels=extraLabels)
+            scheduler = getRenderScheduler()
+            if scheduler is not None and scheduler.isParallel:
+                # Resolve the filenames and CCD outlines (and hence all butler access) here, in the main
+                # process: the workers then find the outlines in the (inherited) cache
+                if butler is not None and ccdList is not None:
+                    getCcdOutlines(butler, dataId, ccdList, zpLabel=zpLabel)
+                resolvedFilenamer = _ResolvedFilenamer(
+                    (style, filenamer(dataId, description=self.shortName, style=style))
+                    for style in self.figureStyles(postFix))
+                scheduler.submit(resolvedFilenamer["psfMagHist" + postFix], self.plotFigures, dataId,
+                                 resolvedFilenamer, log, **figureKwargs)
+            else:
+                self.plotFigures(dataId, filenamer, log, **figureKwargs)
+        log.info("Statistics from %s of %s: %s" % (dataId, self.quantityName, stats))
+        if enforcer:
+            enforcer(stats, dataId, log, self.quantityName)
+        return stats
+
+    @staticmethod
+    def figureStyles(postFix=""):
+        """Return the styles of all the figures plotFigures may write"""
+        return [style + postFix for style in ["psfMagHist", "psfMag", "hist", "sky-all", "sky-stars",
+                                              "sky-gals", "sky-split", "radec"]]
+
+    def render(self, name, func, *args, **kwargs):
+        """Render a figure through the current render scheduler (if any), or directly
+
+        Only arguments resolved in the main process (i.e. filenames rather than a filenamer, and no
+        butler) may be passed, as the rendering may be done in a worker process.
+        """
+        scheduler = getRenderScheduler()
+        if scheduler is not None:
+            scheduler.submit(name, func, *args, **kwargs)
+        else:
+            func(*args, **kwargs)
+
+    def useDensity(self, num):
+        """Are num points to be rendered binned onto the pixel grid, rather than as individual points?"""
+        return 0 < self.config.densityThreshold < num
+
+    @property
+    def statsOnly(self):
+        """Are only the statistics to be calculated (with all rendering skipped)?"""
+        metrics = getAnalysisMetrics()
+        return metrics is not None and metrics.statsOnly
+
+    def plotFigures(self, dataId, filenamer, log, stats=None, butler=None, camera=None, ccdList=None,
+                    tractInfo=None, patchList=None, hscRun=None, matchRadius=None, zpLabel=None,
+                    forcedStr=None, postFix="", plotRunStats=True, highlightList=None, extraLabels=None):
+        """Render all the figures of plotAll"""
         if "galacticExtinction" not in self.shortName:
             self.plotAgainstMagAndHist(log, filenamer(dataId, description=self.shortName,
                                                       style="psfMagHist" + postFix),
@@ -1003,58 +1294,61 @@ class Analysis(object):
             self.plotRaDec(filenamer(dataId, description=self.shortName, style="radec" + postFix),
                            stats=stats, hscRun=hscRun, matchRadius=matchRadius, zpLabel=zpLabel,
                            forcedStr=forcedStr)
-        log.info("Statistics from %s of %s: %s" % (dataId, self.quantityName, stats))
-        if enforcer:
-            enforcer(stats, dataId, log, self.quantityName)
-        return stats
 
     def statistics(self, forcedMean=None):
         """Calculate statistics on quantity"""
-        stats = {}
-        for name, data in self.data.items():
-            good = data.mag < self.magThreshold
-            stats[name] = self.calculateStats(data.quantity, good, forcedMean=forcedMean)
-            if self.quantityError is not None:
-                stats[name].sysErr = self.calculateSysError(data.quantity, data.error,
-                                                            good, forcedMean=forcedMean)
-            if not stats:
-                stats = None
+        stats = self.labelStatistics(self.magThreshold, forcedMean=forcedMean)
+        if self.quantityError is not None:
+            names = list(self.data.keys())
+            goodList = [self.data[name].mag < self.magThreshold for name in names]
+            quantityList = [self.data[name].quantity[good] for name, good in zip(names, goodList)]
+            errorList = [self.data[name].error[good] for name, good in zip(names, goodList)]
+            sysErrList = solveSysErrors(quantityList, errorList,
+                                        self.config.clip, forcedMean=forcedMean, log=self.log)
+            for name, sysErr in zip(names, sysErrList):
+                stats[name].sysErr = sysErr
+        if not stats:
+            stats = None
         return stats
 
+    def labelStatistics(self, magThreshold, forcedMean=None):
+        """Return the statistics of each label for sources brighter than magThreshold
+
+        The statistics of all labels are calculated in a single batched pass over the full quantity
+        array and memoized, so repeated requests (e.g. from each sky position plot) are lookups.
+
+        Parameters
+        ----------
+        magThreshold : `float`
+           Magnitude threshold; no threshold is applied if this is not positive.
+        forcedMean : `float`, optional
+           Mean about which to compute the rms, instead of the actual mean.
+
+        Returns
+        -------
+        stats : `dict` of `lsst.pipe.analysis.utils.Stats`
+           Statistics for each label, with ``dataUsed`` indexing the label's data.
+        """
+        key = (magThreshold, forcedMean)
+        if key not in self._statsCache:
+            names = list(self.data.keys())
+            bright = self.mag < magThreshold if magThreshold > 0 else np.ones(len(self.mag), dtype=bool)
+            selections = np.array([self.data[name].selection & bright for name in names])
+            statsList = calculateClippedStats(self.quantity, selections, self.config.clip,
+                                              forcedMean=forcedMean) if names else []
+            stats = {}
+            for name, labelStats in zip(names, statsList):
+                if labelStats.total > 0:
+                    labelStats.dataUsed = labelStats.dataUsed[self.data[name].selection]
+                stats[name] = labelStats
+            self._statsCache[key] = stats
+        return dict(self._statsCache[key])
+
     def calculateStats(self, quantity, selection, forcedMean=None):
-        total = selection.sum()  # Total number we're considering
-        if total == 0:
-            return Stats(dataUsed=0, num=0, total=0, mean=np.nan, stdev=np.nan, forcedMean=np.nan,
-                         median=np.nan, clip=np.nan)
-        quartiles = np.percentile(quantity[selection], [25, 50, 75])
-        assert len(quartiles) == 3
-        median = quartiles[1]
-        clip = self.config.clip*0.74*(quartiles[2] - quartiles[0])
-        good = selection & np.logical_not(np.abs(quantity - median) > clip)
-        actualMean = quantity[good].mean()
-        mean = actualMean if forcedMean is None else forcedMean
-        stdev = np.sqrt(((quantity[good].astype(np.float64) - mean)**2).mean())
-        return Stats(dataUsed=good, num=good.sum(), total=total, mean=actualMean, stdev=stdev,
-                     forcedMean=forcedMean, median=median, clip=clip)
+        return calculateClippedStats(quantity, selection, self.config.clip, forcedMean=forcedMean)
 
     def calculateSysError(self, quantity, error, selection, forcedMean=None, tol=1.0e-3):
-        import scipy.optimize
-
-        def function(sysErr2):
-            sigNoise = quantity/np.sqrt(error**2 + sysErr2)
-            stats = self.calculateStats(sigNoise, selection, forcedMean=forcedMean)
-            return stats.stdev - 1.0
-
-        if True:
-            result = scipy.optimize.root(function, 0.0, tol=tol)
-            if not result.success:
-                print("Warning: sysErr calculation failed: {:s}".format(result.message))
-                answer = np.nan
-            else:
-                answer = np.sqrt(result.x[0])
-        else:
-            answer = np.sqrt(scipy.optimize.newton(function, 0.0, tol=tol))
-        print("calculateSysError: {0:.4f}, {1:.4f}, {2:.4f}".format(function(answer**2),
-                                                                    function((answer+0.001)**2),
-                                                                    function((answer-0.001)**2)))
-        return answer
+        sysErr = solveSysErrors([quantity[selection]], [error[selection]], self.config.clip,
+                                forcedMean=forcedMean, tol=tol, log=self.log)[0]
+        self.log.debug("calculateSysError: {:.4f}".format(sysErr))
+        return sysErr
@@ -10,8 +10,9 @@ import functools
 from collections import defaultdict
 
 from lsst.daf.persistence.butler import Butler
+from lsst.daf.persistence.safeFileIo import safeMakeDir
 from lsst.pex.config import (Config, Field, ConfigField, ListField, DictField, ConfigDictField,
-                             ConfigurableField)
+                             ConfigurableField, ChoiceField)
 from lsst.pipe.base import CmdLineTask, ArgumentParser, TaskRunner, TaskError
 from lsst.coadd.utils import TractDataIdContainer
 from lsst.afw.table.catalogMatches import matchesToCatalog
@@ -19,20 +20,24 @@ from lsst.meas.astrom import AstrometryConfig
 from lsst.meas.extensions.astrometryNet import LoadAstrometryNetObjectsTask
 from lsst.pipe.tasks.colorterms import Colorterm, ColortermLibrary
 
-from lsst.meas.algorithms import LoadIndexedReferenceObjectsTask
-
-from .analysis import AnalysisConfig, Analysis
+from .renderScheduler import startRenderScheduler, finishRenderScheduler
+from .analysis import AnalysisConfig, Analysis, startAnalysisMetrics, finishAnalysisMetrics
+from .refCatCache import CachedLoadIndexedReferenceObjectsTask
 from .utils import (Filenamer, Enforcer, MagDiff, MagDiffMatches, MagDiffCompare,
                     AstrometryDiff, TraceSize, PsfTraceSizeDiff, TraceSizeCompare, PercentDiff,
                     E1Resids, E2Resids, E1ResidsHsmRegauss, E2ResidsHsmRegauss, FootNpixDiffCompare,
                     MagDiffErr, CentroidDiff, deconvMom,
-                    deconvMomStarGal, concatenateCatalogs, joinMatches, checkPatchOverlap,
+                    deconvMomStarGal, concatenateCatalogs, SkyMatcher, joinMatchIndices, checkPatchOverlap,
+                    getInnerPatchIndices, getPatchOverlapCandidates, purgeMatchesById, getSkyCircle,
+                    getBBoxSkyCircle, getAndCatalogFilenames,
+                    matchIds, MatchStore, getInputFilenames, isStageUpToDate, finishOutputKeys,
+                    invalidateDerivedQuantities,
                     addColumnsToSchema, addApertureFluxesHSC, addFpPoint,
                     addFootprintNPix, makeBadArray, addIntFloatOrStrColumn,
-                    calibrateCoaddSourceCatalog, backoutApCorr, matchJanskyToDn,
+                    calibrateCoaddSourceCatalog, backoutApCorr, catalogJanskyToDn, matchJanskyToDn,
                     fluxToPlotString, andCatalog, writeParquet, getRepoInfo, setAliasMaps)
 from .plotUtils import (CosmosLabeller, StarGalaxyLabeller, OverlapsStarGalaxyLabeller,
-                        MatchesStarGalaxyLabeller)
+                        MatchesStarGalaxyLabeller, clearBackgroundLayers)
 
 import lsst.afw.geom as afwGeom
 import lsst.afw.image as afwImage
@@ -58,7 +63,12 @@ class CoaddAnalysisConfig(Config):
     matchesMaxDistance = Field(dtype=float, default=0.15, doc="Maximum plotting distance for matches")
     externalCatalogs = ConfigDictField(keytype=str, itemtype=AstrometryConfig, default={},
                                        doc="Additional external catalogs for matching")
-    refObjLoader = ConfigurableField(target=LoadIndexedReferenceObjectsTask, doc="Reference object loader")
+    doTileExternalCatalogs = Field(dtype=bool, default=False,
+                                   doc=("Load external catalogs in one sky circle per patch (per CCD for "
+                                        "visits) rather than a single circle covering the whole catalog?"))
+    refObjLoader = ConfigurableField(target=CachedLoadIndexedReferenceObjectsTask,
+                                     doc="Reference object loader (caches reference catalog shards across "
+                                     "patches and visits)")
     doPlotMags = Field(dtype=bool, default=True, doc="Plot magnitudes?")
     doPlotSizes = Field(dtype=bool, default=True, doc="Plot PSF sizes?")
     doPlotCentroids = Field(dtype=bool, default=True, doc="Plot centroids?")
@@ -72,8 +82,26 @@ class CoaddAnalysisConfig(Config):
     doPlotCompareUnforced = Field(dtype=bool, default=True,
                                   doc="Plot difference between forced and unforced?")
     doPlotQuiver = Field(dtype=bool, default=True, doc="Plot ellipticity residuals quiver plot?")
+    quiverBinning = ChoiceField(dtype=str, default="cell",
+                                doc="Binning of the whiskers of the ellipticity residuals quiver plot",
+                                allowed={"none": "One whisker per star",
+                                         "cell": ("Mean residuals in cells (quiverCellsPerPatch along each "
+                                                  "side of each patch for coadds)"),
+                                         "ccd": "Mean residuals per CCD (visits; as cell for coadds)"})
+    quiverCellsPerPatch = Field(dtype=int, default=4,
+                                doc="Number of cells along each side of a patch for quiverBinning=cell")
     doPlotFootprintNpix = Field(dtype=bool, default=True, doc="Plot histogram of footprint nPix?")
     doPlotInputCounts = Field(dtype=bool, default=True, doc="Make input counts plot?")
+    inputCountsNumTiles = Field(dtype=int, default=1,
+                                doc=("Number of tiles along each side of the tract into which to "
+                                     "additionally write the input counts plot (each at a correspondingly "
+                                     "lower resolution)"))
+    doCacheTractImages = Field(dtype=bool, default=True,
+                               doc=("Cache the downsampled tract images of the input counts plot for reuse "
+                                    "by later runs on unchanged coadds?"))
+    tractImageCacheDir = Field(dtype=str, default=None, optional=True,
+                               doc=("Directory in which to cache downsampled tract images (default: a "
+                                    "tractImages subdirectory of the plot output directory)"))
     onlyReadStars = Field(dtype=bool, default=False, doc="Only read stars (to save memory)?")
     toMilli = Field(dtype=bool, default=True, doc="Print stats in milli units (i.e. mas, mmag)?")
     srcSchemaMap = DictField(keytype=str, itemtype=str, default=None, optional=True,
@@ -98,6 +126,26 @@ class CoaddAnalysisConfig(Config):
                                       "issued and table writing is skipped."))
     writeParquetOnly = Field(dtype=bool, default=False,
                              doc="Only write out Parquet tables (i.e. do not produce any plots)?")
+    statsOnly = Field(dtype=bool, default=False,
+                      doc=("Only calculate the selections and statistics of each analysis, skipping all plot "
+                           "rendering, and write the statistics to a metrics table?"))
+    doWriteMetrics = Field(dtype=bool, default=False,
+                           doc=("Write the statistics of each analysis to a metrics table (SQLite) alongside "
+                                "the plots?  Always done if statsOnly is True."))
+    numRenderWorkers = Field(dtype=int, default=1,
+                             doc=("Number of (forked) worker processes in which to render the figures, "
+                                  "overlapping rendering with the statistics of the following analyses "
+                                  "(1: render serially in the main process)"))
+    doSkipUpToDate = Field(dtype=bool, default=True,
+                           doc=("Skip a tract/filter if all its outputs were written from the current "
+                                "inputs, config and package version (checked before reading any catalogs)?"))
+    doPersistMatches = Field(dtype=bool, default=True,
+                             doc=("Persist the match indices (overlaps, forced vs. unforced, external "
+                                  "catalogs and compared reruns) for reuse by later stages and runs on "
+                                  "unchanged inputs?"))
+    matchStoreDir = Field(dtype=str, default=None, optional=True,
+                          doc=("Directory in which to persist match indices (default: a matchStore "
+                               "subdirectory of the plot output directory)"))
 
     def saveToStream(self, outfile, root="root"):
         """Required for loading colorterms from a Config outside the 'lsst' namespace"""
@@ -165,6 +213,43 @@ class CoaddAnalysisTask(CmdLineTask):
     def __init__(self, *args, **kwargs):
         CmdLineTask.__init__(self, *args, **kwargs)
         self.unitScale = 1000.0 if self.config.toMilli else 1.0
+        self._refObjLoader = None
+        self._refObjLoaderButler = None
+        self.matchStore = MatchStore()
+
+    def getRefObjLoader(self, butler):
+        """Return the reference object loader, constructing it once only per butler"""
+        if self._refObjLoader is None or self._refObjLoaderButler is not butler:
+            self._refObjLoader = self.config.refObjLoader.apply(butler=butler)
+            self._refObjLoaderButler = butler
+        return self._refObjLoader
+
+    def getRefCatFilenames(self, butler, circleList):
+        """Return the filenames of the reference catalog shards covering the given sky circles
+
+        Parameters
+        ----------
+        butler : `lsst.daf.persistence.Butler`
+           Butler of the reference catalog.
+        circleList : iterable of `tuple`
+           (center, radius) of each of the sky circles (see `lsst.pipe.analysis.utils.getSkyCircle`);
+           may be a generator, any failure in which is handled as for the shard lookup.
+
+        Returns
+        -------
+        filenames : `list` of `str` or `None`
+           Filenames of the shards, or `None` if these could not be determined (in which case the
+           stage should not be skipped, as its reference catalog inputs are unknown).
+        """
+        try:
+            refObjLoader = self.getRefObjLoader(butler)
+            filenames = set()
+            for center, radius in circleList:
+                filenames.update(refObjLoader.getShardFilenames(center, radius))
+        except Exception as e:
+            self.log.warn("Unable to determine the reference catalog inputs: {:}".format(e))
+            return None
+        return sorted(filenames)
 
     def runDataRef(self, patchRefList, cosmos=None):
         haveForced = False  # do forced datasets exits (may not for single band datasets)
@@ -186,6 +271,30 @@ class CoaddAnalysisTask(CmdLineTask):
         self.log.info("patchList size: {:d}".format(len(patchList)))
         repoInfo = getRepoInfo(patchRefList[0], coaddName=self.config.coaddName, coaddDataset=dataset)
         filenamer = Filenamer(repoInfo.butler, self.outputDataset, repoInfo.dataId)
+        inputFilenames = getInputFilenames(patchRefList, [self.config.coaddName + "Coadd_" + dataset for
+                                                          dataset in ["forced_src", "meas", "ref", "calexp"]])
+        if cosmos:
+            inputFilenames.append(cosmos)
+        doSkip = self.config.doSkipUpToDate
+        if self.config.doPlotMatches:
+            inputFilenames += getInputFilenames(patchRefList, [self.config.coaddName + "Coadd_measMatch"])
+            tractInfo = repoInfo.tractInfo
+            tractCircle = getBBoxSkyCircle(tractInfo.getBBox(), tractInfo.getWcs())
+            refCatFilenames = self.getRefCatFilenames(repoInfo.butler, [tractCircle])
+            if refCatFilenames is None:
+                doSkip = False
+            else:
+                inputFilenames += refCatFilenames
+        for cat in self.config.externalCatalogs:
+            inputFilenames += getAndCatalogFilenames(cat)
+        if isStageUpToDate(filenamer, repoInfo.dataId, self._DefaultName, inputFilenames, self.config,
+                           doSkip=doSkip, log=self.log):
+            return
+        self.matchStore = MatchStore.fromFilenamer(filenamer, repoInfo.dataId,
+                                                   directory=self.config.matchStoreDir,
+                                                   doPersist=self.config.doPersistMatches)
+        startAnalysisMetrics(statsOnly=self.config.statsOnly)
+        startRenderScheduler(self.config.numRenderWorkers, log=self.log)
         if (self.config.doPlotMags or self.config.doPlotStarGalaxy or self.config.doPlotOverlaps or
                 self.config.doPlotCompareUnforced or cosmos or self.config.externalCatalogs):
             if haveForced:
@@ -238,7 +347,8 @@ class CoaddAnalysisTask(CmdLineTask):
             else:
                 self.catLabel = "nChild = 0"
                 if haveForced:
-                    forcedOverlaps = self.overlaps(forced)
+                    forcedOverlaps = self.overlaps(forced, tractInfo=repoInfo.tractInfo, patchList=patchList,
+                                                   dataId=repoInfo.dataId, matchName="overlaps_forced")
                     if forcedOverlaps:
                         self.plotOverlaps(forcedOverlaps, filenamer, repoInfo.dataId, butler=repoInfo.butler,
                                           camera=repoInfo.camera, tractInfo=repoInfo.tractInfo,
@@ -248,7 +358,8 @@ class CoaddAnalysisTask(CmdLineTask):
                                           fluxToPlotList=["modelfit_CModel", ])
                     self.log.info("Number of forced overlap objects matched = {:d}".
                                   format(len(forcedOverlaps)))
-                unforcedOverlaps = self.overlaps(unforced)
+                unforcedOverlaps = self.overlaps(unforced, tractInfo=repoInfo.tractInfo, patchList=patchList,
+                                                 dataId=repoInfo.dataId, matchName="overlaps_unforced")
                 if unforcedOverlaps:
                     self.plotOverlaps(unforcedOverlaps, filenamer, repoInfo.dataId, butler=repoInfo.butler,
                                       camera=repoInfo.camera, tractInfo=repoInfo.tractInfo,
@@ -275,6 +386,9 @@ class CoaddAnalysisTask(CmdLineTask):
             writeParquet(unforced, tableFilenamer(repoInfo.dataId, description='unforced'), badArray=bad)
             if self.config.writeParquetOnly:
                 self.log.info("Exiting after writing Parquet tables.  No plots generated.")
+                invalidateDerivedQuantities()
+                clearBackgroundLayers()
+                finishOutputKeys(log=self.log)
                 return
 
         # Purge the catalogs of flagged sources
@@ -305,7 +419,8 @@ class CoaddAnalysisTask(CmdLineTask):
             self.plotQuiver(unforced, filenamer(repoInfo.dataId, description="ellipResids", style="quiver"),
                             dataId=repoInfo.dataId, butler=repoInfo.butler, camera=repoInfo.camera,
                             tractInfo=repoInfo.tractInfo, patchList=patchList, hscRun=repoInfo.hscRun,
-                            zpLabel=self.zpLabel, forcedStr="unforced", scale=2)
+                            zpLabel=self.zpLabel, forcedStr="unforced", scale=2,
+                            binning=self.config.quiverBinning, cellsPerPatch=self.config.quiverCellsPerPatch)
 
         if self.config.doPlotInputCounts:
             self.plotInputCounts(unforced, filenamer(repoInfo.dataId, description="inputCounts",
@@ -313,7 +428,9 @@ class CoaddAnalysisTask(CmdLineTask):
                                  dataId=repoInfo.dataId, butler=repoInfo.butler, tractInfo=repoInfo.tractInfo,
                                  patchList=patchList, camera=repoInfo.camera, hscRun=repoInfo.hscRun,
                                  forcedStr="unforced", alpha=0.5, doPlotTractImage=True,
-                                 doPlotPatchOutline=True, sizeFactor=5.0, maxDiamPix=1000)
+                                 doPlotPatchOutline=True, sizeFactor=5.0, maxDiamPix=1000,
+                                 numTiles=self.config.inputCountsNumTiles,
+                                 tractImageDir=self.getTractImageDir(filenamer, repoInfo.dataId))
 
         if self.config.doPlotMags:
             self.plotMags(unforced, filenamer, repoInfo.dataId, butler=repoInfo.butler,
@@ -375,12 +492,26 @@ class CoaddAnalysisTask(CmdLineTask):
 
         for cat in self.config.externalCatalogs:
             with andCatalog(cat):
-                matches = self.matchCatalog(forced, repoInfo.filterName, self.config.externalCatalogs[cat])
+                tileIds = None
+                if self.config.doTileExternalCatalogs:
+                    patchX, patchY, _, _ = getInnerPatchIndices(forced, repoInfo.tractInfo)
+                    nPatchX, nPatchY = repoInfo.tractInfo.getNumPatches()
+                    tileIds = patchX*nPatchY + patchY
+                matches = self.matchCatalog(forced, repoInfo.filterName, self.config.externalCatalogs[cat],
+                                            tileIds=tileIds, dataId=repoInfo.dataId,
+                                            matchName="external_" + cat)
                 self.plotMatches(matches, repoInfo.filterName, filenamer, repoInfo.dataId,
                                  butler=repoInfo.butler, camera=repoInfo.camera, tractInfo=repoInfo.tractInfo,
                                  patchList=patchList, hscRun=repoInfo.hscRun, zpLabel=self.zpLabel,
                                  forcedStr=forcedStr, matchRadius=self.config.matchRadius)
 
+        finishRenderScheduler()
+        finishAnalysisMetrics(filenamer if self.config.statsOnly or self.config.doWriteMetrics else None,
+                              repoInfo.dataId, log=self.log)
+        invalidateDerivedQuantities()
+        clearBackgroundLayers()
+        finishOutputKeys(log=self.log)
+
     def readCatalogs(self, patchRefList, dataset):
         """Read in and concatenate catalogs of type dataset in lists of data references
 
@@ -455,14 +586,9 @@ class CoaddAnalysisTask(CmdLineTask):
                 packedMatches = butler.get(dataset + "Match", dataRef.dataId)
 
             # Purge the match list of sources flagged in the catalog
-            badIds = catalog["id"][bad]
-            badMatch = np.zeros(len(packedMatches), dtype=bool)
-            for iMat, iMatch in enumerate(packedMatches):
-                if iMatch["second"] in badIds:
-                    badMatch[iMat] = True
+            packedMatches = purgeMatchesById(packedMatches, catalog["id"][bad])
             self.catLabel = "noDuplicates"
             self.zpLabel = self.zpLabel + " " + self.catLabel
-            packedMatches = packedMatches[~badMatch].copy(deep=True)
             if not packedMatches:
                 self.log.warn("No good matches for %s" % (dataRef.dataId,))
                 continue
@@ -474,7 +600,7 @@ class CoaddAnalysisTask(CmdLineTask):
             matchmeta = packedMatches.table.getMetadata()
             rad = matchmeta.getDouble("RADIUS")
             matchmeta.setDouble("RADIUS", rad*1.05, "field radius in degrees, approximate, padded")
-            refObjLoader = self.config.refObjLoader.apply(butler=butler)
+            refObjLoader = self.getRefObjLoader(butler)
             matches = refObjLoader.joinMatchListWithCatalog(packedMatches, catalog)
             if not hasattr(matches[0].first, "schema"):
                 raise RuntimeError("Unable to unpack matches.  "
@@ -837,8 +963,11 @@ class CoaddAnalysisTask(CmdLineTask):
             fluxToPlotList = self.config.fluxToPlotList
         unitStr = "mmag" if self.config.toMilli else "mag"
         enforcer = None
-        catalog = joinMatches(afwTable.matchRaDec(forced, unforced, matchRadius*afwGeom.arcseconds),
-                              "forced_", "unforced_")
+        index1, index2, distance = self.matchStore.match(
+            "compareUnforced", matchRadius, dataId, [forced, unforced],
+            lambda: SkyMatcher.fromCatalog(unforced).nearest(forced["coord_ra"], forced["coord_dec"],
+                                                             matchRadius*afwGeom.arcseconds))
+        catalog = joinMatchIndices(forced, unforced, index1, index2, distance, "forced_", "unforced_")
         for col in fluxToPlotList:
             shortName = "compareUnforced_" + col
             self.log.info("shortName = {:s}".format(shortName))
@@ -862,14 +991,31 @@ class CoaddAnalysisTask(CmdLineTask):
                 return True
         return False
 
-    def overlaps(self, catalog):
+    def overlaps(self, catalog, tractInfo=None, patchList=None, dataId=None, matchName="overlaps"):
+        """Match a coadd catalog against itself to find sources detected in more than one patch
+
+        If ``tractInfo`` and ``patchList`` are provided, only the sources lying in the overlap strips
+        shared by adjacent patches of ``patchList`` are considered, as only these can be duplicated.
+        If ``dataId`` is provided, the match is persisted in (or read from) the task's match store
+        under ``matchName``.
+        """
         badForOverlap = makeBadArray(catalog, flagList=self.config.analysis.flags,
                                      onlyReadStars=self.config.onlyReadStars, patchInnerOnly=False)
-        goodCat = catalog[~badForOverlap]
-        matches = afwTable.matchRaDec(goodCat, self.config.matchOverlapRadius*afwGeom.arcseconds)
-        if not matches:
+        if tractInfo is not None and patchList is not None:
+            pixelScale = tractInfo.getWcs().getPixelScale().asArcseconds()
+            candidates = getPatchOverlapCandidates(catalog, tractInfo, patchList,
+                                                   margin=self.config.matchOverlapRadius/pixelScale)
+            self.log.info("Number of overlap strip candidates = {0:d} of {1:d}".
+                          format(candidates.sum(), len(catalog)))
+            badForOverlap |= ~candidates
+        goodCat = catalog[~badForOverlap].copy(deep=True)
+        index1, index2, distance = self.matchStore.match(
+            matchName, self.config.matchOverlapRadius, dataId, [goodCat],
+            lambda: SkyMatcher.fromCatalog(goodCat).selfMatch(
+                self.config.matchOverlapRadius*afwGeom.arcseconds))
+        if len(index1) == 0:
             self.log.info("Did not find any overlapping matches")
-        return joinMatches(matches, "first_", "second_")
+        return joinMatchIndices(goodCat, goodCat, index1, index2, distance, "first_", "second_")
 
     def plotOverlaps(self, overlaps, filenamer, dataId, butler=None, camera=None, ccdList=None,
                      tractInfo=None, patchList=None, hscRun=None, matchRadius=None, zpLabel=None,
@@ -1071,25 +1217,75 @@ class CoaddAnalysisTask(CmdLineTask):
                                      zpLabel=zpLabel, forcedStr=forcedStr)
 
     def plotCosmos(self, catalog, filenamer, cosmos, dataId):
-        labeller = CosmosLabeller(cosmos, self.config.matchRadius*afwGeom.arcseconds)
+        cacheFilename = None
+        if self.matchStore.directory is not None:
+            cacheFilename = os.path.join(self.matchStore.directory,
+                                         os.path.splitext(os.path.basename(cosmos))[0] + ".npz")
+            safeMakeDir(self.matchStore.directory)
+        labeller = CosmosLabeller(cosmos, self.config.matchRadius*afwGeom.arcseconds,
+                                  cacheFilename=cacheFilename)
         self.AnalysisClass(catalog, deconvMom, "Deconvolved moments", "cosmos", self.config.analysis,
                            qMin=-1.0, qMax=6.0, labeller=labeller,
                            ).plotAll(dataId, filenamer, self.log,
                                      enforcer=Enforcer(requireLess={"star": {"stdev": 0.2}}))
 
-    def matchCatalog(self, catalog, filterName, astrometryConfig):
+    def matchCatalog(self, catalog, filterName, astrometryConfig, tileIds=None, dataId=None,
+                     matchName="external"):
+        """Match a catalog to an external reference catalog
+
+        Parameters
+        ----------
+        catalog : `lsst.afw.table.SourceCatalog`
+           The source catalog to match.
+        filterName : `str`
+           Name of the filter for which to load the reference catalog.
+        astrometryConfig : `lsst.meas.astrom.AstrometryConfig`
+           Configuration of the external catalog.
+        tileIds : `numpy.ndarray` of `int`, optional
+           Tile (e.g. patch or CCD) to which each source belongs.  If provided, the reference catalog is
+           loaded in one (small) sky circle per tile rather than a single circle covering the whole
+           catalog.
+        dataId : `dict`, optional
+           Data id of the catalog.  If provided, the match is persisted in (or read from) the task's
+           match store under ``matchName``.
+        matchName : `str`, optional
+           Name under which to persist the match.
+
+        Returns
+        -------
+        matches : `lsst.afw.table.BaseCatalog`
+           Joined catalog of matches with "ref_" and "src_" prefixed columns (or an empty `list` if
+           there were no matches).
+        """
         refObjLoader = LoadAstrometryNetObjectsTask(self.config.refObjLoaderConfig)
-        center = afwGeom.averageSpherePoint([src.getCoord() for src in catalog])
-        radius = max(center.separation(src.getCoord()) for src in catalog)
         filterName = afwImage.Filter(afwImage.Filter(filterName).getId()).getName()  # Get primary name
-        refs = refObjLoader.loadSkyCircle(center, radius, filterName).refCat
-        matches = afwTable.matchRaDec(refs, catalog, self.config.matchRadius*afwGeom.arcseconds)
-        matches = matchJanskyToDn(matches)
-        return joinMatches(matches, "ref_", "src_")
+        matchRadius = self.config.matchRadius*afwGeom.arcseconds
+        ra = catalog["coord_ra"]
+        dec = catalog["coord_dec"]
+        if tileIds is None:
+            center, radius = getSkyCircle(ra, dec)
+            refs = refObjLoader.loadSkyCircle(center, radius, filterName).refCat
+        else:
+            refList = []
+            for tileId in np.unique(tileIds):
+                inTile = tileIds == tileId
+                center, radius = getSkyCircle(ra[inTile], dec[inTile])
+                refList.append(refObjLoader.loadSkyCircle(center, radius + matchRadius, filterName).refCat)
+            refs = concatenateCatalogs(refList)
+            # Neighbouring tiles load some of the same reference objects: keep one copy of each
+            unique = np.zeros(len(refs), dtype=bool)
+            unique[np.unique(refs["id"], return_index=True)[1]] = True
+            refs = refs[unique].copy(deep=True)
+        index1, index2, distance = self.matchStore.match(
+            matchName, self.config.matchRadius, dataId, [refs, catalog],
+            lambda: SkyMatcher.fromCatalog(catalog).nearest(refs["coord_ra"], refs["coord_dec"], matchRadius))
+        matches = joinMatchIndices(refs, catalog, index1, index2, distance, "ref_", "src_")
+        # LSST reads in a_net catalogs with flux in "janskys", so must convert back to DN
+        return catalogJanskyToDn(matches, prefix="ref_")
 
     def plotQuiver(self, catalog, filenamer, dataId=None, butler=None, camera=None, ccdList=None,
                    tractInfo=None, patchList=None, hscRun=None, matchRadius=None, zpLabel=None,
-                   forcedStr=None, postFix="", flagsCat=None, scale=1):
+                   forcedStr=None, postFix="", flagsCat=None, scale=1, binning="none", cellsPerPatch=4):
         stats = None
         shortName = "quiver"
         self.log.info("shortName = {:s}".format(shortName))
@@ -1098,11 +1294,13 @@ class CoaddAnalysisTask(CmdLineTask):
                            ).plotQuiver(catalog, filenamer, self.log, stats=stats, dataId=dataId,
                                         butler=butler, camera=camera, ccdList=ccdList, tractInfo=tractInfo,
                                         patchList=patchList, hscRun=hscRun, zpLabel=zpLabel,
-                                        forcedStr=forcedStr, scale=scale)
+                                        forcedStr=forcedStr, scale=scale, binning=binning,
+                                        cellsPerPatch=cellsPerPatch)
 
     def plotInputCounts(self, catalog, filenamer, dataId, butler, tractInfo, patchList=None, camera=None,
                         hscRun=None, forcedStr=None, alpha=0.5, doPlotTractImage=True,
-                        doPlotPatchOutline=True, sizeFactor=5.0, maxDiamPix=1000):
+                        doPlotPatchOutline=True, sizeFactor=5.0, maxDiamPix=1000, numTiles=1,
+                        tractImageDir=None):
         shortName = "inputCounts"
         self.log.info("shortName = {:s}".format(shortName))
         self.AnalysisClass(catalog, None, "%s" % shortName, shortName,
@@ -1111,7 +1309,17 @@ class CoaddAnalysisTask(CmdLineTask):
                                              patchList=patchList, camera=camera, forcedStr=forcedStr,
                                              alpha=alpha, doPlotTractImage=doPlotTractImage,
                                              doPlotPatchOutline=doPlotPatchOutline,
-                                             sizeFactor=sizeFactor, maxDiamPix=maxDiamPix)
+                                             sizeFactor=sizeFactor, maxDiamPix=maxDiamPix,
+                                             numTiles=numTiles, tractImageDir=tractImageDir)
+
+    def getTractImageDir(self, filenamer, dataId):
+        """Return the directory in which to cache downsampled tract images (`None` if not caching)"""
+        if not self.config.doCacheTractImages:
+            return None
+        if self.config.tractImageCacheDir is not None:
+            return self.config.tractImageCacheDir
+        return os.path.join(os.path.dirname(filenamer(dataId, description="tractImages", style="npy")),
+                            "tractImages")
 
     def _getConfigName(self):
         return None
@@ -1124,6 +1332,17 @@ class CoaddAnalysisTask(CmdLineTask):
 
 
 class CompareCoaddAnalysisConfig(CoaddAnalysisConfig):
+    joinStrategy = ChoiceField(dtype=str, default="position",
+                               allowed={"auto": "Join on id if the fraction of sources with ids in common "
+                                                "within matchRadius is at least idJoinThreshold, otherwise "
+                                                "match by position",
+                                        "id": ("Join on id (for pairs within matchRadius), then match any "
+                                               "remaining sources by position"),
+                                        "position": "Match all sources by position"},
+                               doc="Strategy for joining the sources of the two catalogs being compared")
+    idJoinThreshold = Field(dtype=float, default=0.9,
+                            doc=("Minimum fraction of sources with ids in common within matchRadius "
+                                 "(relative to the smaller catalog) for joinStrategy=\"auto\" to join on id"))
 
     def setDefaults(self):
         CoaddAnalysisConfig.setDefaults(self)
@@ -1168,6 +1387,7 @@ class CompareCoaddAnalysisTask(CmdLineTask):
     def __init__(self, *args, **kwargs):
         CmdLineTask.__init__(self, *args, **kwargs)
         self.unitScale = 1000.0 if self.config.toMilli else 1.0
+        self.matchStore = MatchStore()
 
     def runDataRef(self, patchRefList1, patchRefList2):
         haveForced = True  # do forced datasets exits (may not for single band datasets)
@@ -1196,6 +1416,13 @@ class CompareCoaddAnalysisTask(CmdLineTask):
 
         repoInfo1 = getRepoInfo(patchRefList1[0], coaddName=self.config.coaddName, coaddDataset=dataset)
         repoInfo2 = getRepoInfo(patchRefList2[0], coaddName=self.config.coaddName, coaddDataset=dataset)
+        filenamer = Filenamer(repoInfo1.butler, "plotCompareCoadd", repoInfo1.dataId)
+        inputDatasets = [self.config.coaddName + "Coadd_" + dataset for dataset in ["forced_src", "meas"]]
+        if isStageUpToDate(filenamer, repoInfo1.dataId, self._DefaultName,
+                           (getInputFilenames(patchRefList1, inputDatasets) +
+                            getInputFilenames(patchRefList2, inputDatasets)), self.config,
+                           doSkip=self.config.doSkipUpToDate, log=self.log):
+            return
         if haveForced:
             forced1 = self.readCatalogs(patchRefList1, self.config.coaddName + "Coadd_forced_src")
             forced1 = self.calibrateCatalogs(forced1, wcs=repoInfo1.wcs)
@@ -1256,8 +1483,11 @@ class CompareCoaddAnalysisTask(CmdLineTask):
         else:
             forced1 = unforced1
             forced2 = unforced2
-        unforced = self.matchCatalogs(unforced1, unforced2)
-        forced = self.matchCatalogs(forced1, forced2)
+        self.matchStore = MatchStore.fromFilenamer(filenamer, repoInfo1.dataId,
+                                                   directory=self.config.matchStoreDir,
+                                                   doPersist=self.config.doPersistMatches)
+        unforced = self.matchCatalogs(unforced1, unforced2, dataId=repoInfo1.dataId, matchName="unforced")
+        forced = self.matchCatalogs(forced1, forced2, dataId=repoInfo1.dataId, matchName="forced")
 
         aliasDictList = aliasDictList0
         if hscRun is not None and self.config.srcSchemaMap is not None:
@@ -1269,8 +1499,9 @@ class CompareCoaddAnalysisTask(CmdLineTask):
         self.log.info("\nNumber of sources in forced catalogs: first = {0:d} and second = {1:d}".format(
                       len(forced1), len(forced2)))
 
-        filenamer = Filenamer(repoInfo1.butler, "plotCompareCoadd", repoInfo1.dataId)
         hscRun = repoInfo1.hscRun if repoInfo1.hscRun is not None else repoInfo2.hscRun
+        startAnalysisMetrics(statsOnly=self.config.statsOnly)
+        startRenderScheduler(self.config.numRenderWorkers, log=self.log)
         if self.config.doPlotMags:
             self.plotMags(forced, filenamer, repoInfo1.dataId, butler=repoInfo1.butler,
                           camera=repoInfo1.camera, tractInfo=repoInfo1.tractInfo, patchList=patchList1,
@@ -1303,6 +1534,13 @@ class CompareCoaddAnalysisTask(CmdLineTask):
                              hscRun=hscRun, matchRadius=self.config.matchRadius, zpLabel=self.zpLabel,
                              forcedStr=forcedStr)
 
+        finishRenderScheduler()
+        finishAnalysisMetrics(filenamer if self.config.statsOnly or self.config.doWriteMetrics else None,
+                              repoInfo1.dataId, log=self.log)
+        invalidateDerivedQuantities()
+        clearBackgroundLayers()
+        finishOutputKeys(log=self.log)
+
     def readCatalogs(self, patchRefList, dataset):
         catList = [patchRef.get(dataset, immediate=True, flags=afwTable.SOURCE_IO_NO_FOOTPRINTS) for
                    patchRef in patchRefList if patchRef.datasetExists(dataset)]
@@ -1310,11 +1548,70 @@ class CompareCoaddAnalysisTask(CmdLineTask):
             raise TaskError("No catalogs read: %s" % ([patchRef.dataId for patchRef in patchRefList]))
         return concatenateCatalogs(catList)
 
-    def matchCatalogs(self, catalog1, catalog2):
-        matches = afwTable.matchRaDec(catalog1, catalog2, self.config.matchRadius*afwGeom.arcseconds)
-        if not matches:
+    def matchCatalogs(self, catalog1, catalog2, dataId=None, matchName="compare"):
+        """Match the sources of two catalogs and join them into a single catalog
+
+        Depending on config.joinStrategy, the catalogs are joined on object id (exact and fast when
+        both reruns share the same detection and deblending), by position, or ("auto") on id if the
+        fraction of sources with ids in common that lie within config.matchRadius of each other is at
+        least config.idJoinThreshold and by position otherwise.  Id pairs further apart than the match
+        radius (e.g. the same sequential id given to different objects by different deblending) are
+        rejected, and the sources left unmatched are then matched by position.  If ``dataId`` is
+        provided, the match is persisted in (or read from) the task's match store under ``matchName``.
+        """
+        index1, index2, distance = self.matchStore.match(
+            "compare_" + matchName + "_" + self.config.joinStrategy, self.config.matchRadius, dataId,
+            [catalog1, catalog2], lambda: self.matchCatalogIndices(catalog1, catalog2),
+            params=dict(joinStrategy=self.config.joinStrategy, idJoinThreshold=self.config.idJoinThreshold))
+        if len(index1) == 0:
             raise TaskError("No matches found")
-        return joinMatches(matches, "first_", "second_")
+        return joinMatchIndices(catalog1, catalog2, index1, index2, distance, "first_", "second_")
+
+    def matchCatalogIndices(self, catalog1, catalog2):
+        """Return the (index1, index2, distance) arrays of the match performed by matchCatalogs"""
+        matchRadius = self.config.matchRadius*afwGeom.arcseconds
+        index1, index2 = np.array([], dtype=int), np.array([], dtype=int)
+        if self.config.joinStrategy in ("auto", "id"):
+            index1, index2 = matchIds(catalog1["id"], catalog2["id"])
+            distance = SkyMatcher.separation(catalog1["coord_ra"][index1], catalog1["coord_dec"][index1],
+                                             catalog2["coord_ra"][index2], catalog2["coord_dec"][index2])
+            # Ids are assigned sequentially, so also require the pairs to be within the match radius
+            within = distance <= matchRadius.asRadians()
+            idFraction = within.sum()/max(min(len(catalog1), len(catalog2)), 1)
+            if self.config.joinStrategy == "auto" and idFraction < self.config.idJoinThreshold:
+                self.log.info("Fraction of ids in common within the match radius ({0:.3f}) is below "
+                              "idJoinThreshold ({1:.3f}): matching by position".
+                              format(idFraction, self.config.idJoinThreshold))
+                within[:] = False
+            else:
+                self.log.info("Joined {0:d} sources on id ({1:.3f} of ids in common within the match "
+                              "radius; {2:d} pairs beyond it rejected)".
+                              format(within.sum(), idFraction, len(within) - within.sum()))
+            index1, index2, distance = index1[within], index2[within], distance[within]
+        else:
+            distance = np.array([])
+
+        # Match the remaining sources by position
+        remaining1 = np.ones(len(catalog1), dtype=bool)
+        remaining1[index1] = False
+        remaining2 = np.ones(len(catalog2), dtype=bool)
+        remaining2[index2] = False
+        if remaining1.any() and remaining2.any():
+            indices1 = np.flatnonzero(remaining1)
+            indices2 = np.flatnonzero(remaining2)
+            matcher = SkyMatcher(catalog2["coord_ra"][indices2], catalog2["coord_dec"][indices2])
+            posIndex1, posIndex2, posDistance = matcher.nearest(catalog1["coord_ra"][indices1],
+                                                                catalog1["coord_dec"][indices1], matchRadius)
+            if len(index1) > 0:
+                self.log.info("Matched {0:d} of the remaining {1:d} sources by position".
+                              format(len(posIndex1), len(indices1)))
+            index1 = np.concatenate((index1, indices1[posIndex1]))
+            index2 = np.concatenate((index2, indices2[posIndex2]))
+            distance = np.concatenate((distance, posDistance))
+            order = np.argsort(index1, kind="mergesort")
+            index1, index2, distance = index1[order], index2[order], distance[order]
+
+        return index1, index2, distance
 
     def calibrateCatalogs(self, catalog, wcs=None):
         self.zpLabel = "common (" + str(self.config.analysis.coaddZp) + ")"
@@ -1348,6 +1645,7 @@ class CompareCoaddAnalysisTask(CmdLineTask):
                          flags=[col + "_flag"], errFunc=MagDiffErr(col + "_instFlux",
                                                                    unitScale=self.unitScale),
                          labeller=OverlapsStarGalaxyLabeller(), flagsCat=flagsCat, unitScale=self.unitScale,
+                         log=self.log,
                          ).plotAll(dataId, filenamer, self.log, enforcer=enforcer, butler=butler,
                                    camera=camera, ccdList=ccdList, tractInfo=tractInfo, patchList=patchList,
                                    hscRun=hscRun, matchRadius=matchRadius, zpLabel=zpLabel,
@@ -14,14 +14,18 @@ from collections import defaultdict
 from lsst.pex.config import Config, Field, ConfigField, ListField, DictField, ConfigDictField
 from lsst.pipe.base import CmdLineTask, ArgumentParser, TaskRunner, TaskError
 from lsst.coadd.utils import TractDataIdContainer
-from .analysis import Analysis, AnalysisConfig
+from .renderScheduler import startRenderScheduler, finishRenderScheduler
+from .analysis import Analysis, AnalysisConfig, startAnalysisMetrics, finishAnalysisMetrics
 from .coaddAnalysis import CoaddAnalysisTask
 from .utils import (Filenamer, Enforcer, concatenateCatalogs, getFluxKeys, addColumnsToSchema,
                     makeBadArray, addFlag, addIntFloatOrStrColumn, calibrateCoaddSourceCatalog,
                     fluxToPlotString, writeParquet, getRepoInfo, orthogonalRegression,
                     distanceSquaredToPoly, p2p1CoeffsFromLinearFit, linesFromP2P1Coeffs,
-                    makeEqnStr, catColors)
-from .plotUtils import AllLabeller, OverlapsStarGalaxyLabeller, plotText, labelCamera, setPtSize
+                    makeEqnStr, catColors, getSfdDustMap, getSfdDustMapFilenames, invalidateDerivedQuantities,
+                    getInputFilenames,
+                    isStageUpToDate, finishOutputKeys)
+from .plotUtils import (AllLabeller, OverlapsStarGalaxyLabeller, plotText, labelCamera, setPtSize,
+                        clearBackgroundLayers)
 
 import lsst.afw.geom as afwGeom
 import lsst.afw.table as afwTable
@@ -226,12 +230,29 @@ class ColorAnalysisConfig(Config):
     correctForGalacticExtinction = Field(dtype=bool, default=True,
                                          doc="Correct flux fields for Galactic Extinction?  Must have "
                                          "extinctionCoeffs config setup.")
+    sfdDustMapDir = Field(dtype=str, default=None, optional=True,
+                          doc="Directory containing the SFD98 dust maps (SFD_dust_4096_[ns]gp.fits) used "
+                          "for the per-object Galactic Extinction correction.  If None, $SFD_DIR and "
+                          "$DUST_DIR/maps are searched, and lsst.sims.catUtils is used if no maps are found.")
     toMilli = Field(dtype=bool, default=True, doc="Print stats in milli units (i.e. mas, mmag)?")
     doPlotPrincipalColors = Field(dtype=bool, default=True,
                                   doc="Create the Ivezic Principal Color offset plots?")
     doPlotGalacticExtinction = Field(dtype=bool, default=True, doc="Create Galactic Extinction plots?")
     writeParquetOnly = Field(dtype=bool, default=False,
                              doc="Only write out Parquet tables (i.e. do not produce any plots)?")
+    statsOnly = Field(dtype=bool, default=False,
+                      doc=("Only calculate the selections and statistics of each analysis, skipping all plot "
+                           "rendering, and write the statistics to a metrics table?"))
+    doWriteMetrics = Field(dtype=bool, default=False,
+                           doc=("Write the statistics of each analysis to a metrics table (SQLite) alongside "
+                                "the plots?  Always done if statsOnly is True."))
+    numRenderWorkers = Field(dtype=int, default=1,
+                             doc=("Number of (forked) worker processes in which to render the figures, "
+                                  "overlapping rendering with the statistics of the following analyses "
+                                  "(1: render serially in the main process)"))
+    doSkipUpToDate = Field(dtype=bool, default=True,
+                           doc=("Skip a tract if all its outputs were written from the current inputs, "
+                                "config and package version (checked before reading any catalogs)?"))
     doWriteParquetTables = Field(dtype=bool, default=True,
                                  doc=("Write out Parquet tables (for subsequent interactive analysis)?"
                                       "\nNOTE: if True but fastparquet package is unavailable, a warning "
@@ -384,6 +405,15 @@ class ColorAnalysisTask(CmdLineTask):
             self.flags = [self.config.srcSchemaMap[flag] for flag in self.flags]
 
         filenamer = Filenamer(repoInfo.butler, "plotColor", repoInfo.dataId)
+        inputFilenames = [filename for patchRefList in patchRefsByFilter.values() for filename in
+                          getInputFilenames(patchRefList, [self.config.coaddName + "Coadd_forced_src"])]
+        if self.config.correctForGalacticExtinction:
+            inputFilenames += getSfdDustMapFilenames(self.config.sfdDustMapDir)
+        if isStageUpToDate(filenamer, repoInfo.dataId, self._DefaultName, inputFilenames, self.config,
+                           doSkip=self.config.doSkipUpToDate, log=self.log):
+            return
+        startAnalysisMetrics(statsOnly=self.config.statsOnly)
+        startRenderScheduler(self.config.numRenderWorkers, log=self.log)
         byFilterForcedCats = {filterName:
                               self.readCatalogs(patchRefList, self.config.coaddName + "Coadd_forced_src") for
                               filterName, patchRefList in patchRefsByFilter.items()}
@@ -393,11 +423,11 @@ class ColorAnalysisTask(CmdLineTask):
 
         geLabel = "None"
         doPlotGalacticExtinction = False
-        if self.correctForGalacticExtinction:
-            # The per-object Galactic Extinction correction currently requires sims_catUtils to be setup
-            # as it uses the EBVbase class to obtain E(B-V).  Putting this in a try/except to fall back
-            # to the per-field correction until we can access the EBVbase class from an lsst_distrib
-            # installation.
+        if self.config.correctForGalacticExtinction:
+            # The per-object Galactic Extinction correction requires either the SFD98 dust maps to be
+            # available locally (see the sfdDustMapDir config) or sims_catUtils to be setup (for the
+            # EBVbase class).  Putting this in a try/except to fall back to the per-field correction if
+            # neither is available.
             try:
                 byFilterForcedCats = self.correctForGalacticExtinction(byFilterForcedCats, repoInfo.tractInfo)
                 doPlotGalacticExtinction = True
@@ -423,6 +453,9 @@ class ColorAnalysisTask(CmdLineTask):
             writeParquet(principalColCats, tableFilenamer(repoInfo.dataId, description='forced'))
             if self.config.writeParquetOnly:
                 self.log.info("Exiting after writing Parquet tables.  No plots generated.")
+                invalidateDerivedQuantities()
+                clearBackgroundLayers()
+                finishOutputKeys(log=self.log)
                 return
 
         if self.config.doPlotPrincipalColors:
@@ -431,11 +464,19 @@ class ColorAnalysisTask(CmdLineTask):
                                          tractInfo=repoInfo.tractInfo, patchList=patchList,
                                          hscRun=repoInfo.hscRun, geLabel=geLabel)
 
-        for fluxColumn in ["base_PsfFlux_instFlux", "modelfit_CModel_instFlux"]:
-            self.plotStarColorColor(principalColCats, byFilterForcedCats, filenamer, repoInfo.dataId,
-                                    fluxColumn, camera=repoInfo.camera, tractInfo=repoInfo.tractInfo,
-                                    patchList=patchList, hscRun=repoInfo.hscRun, forcedStr=self.forcedStr,
-                                    geLabel=geLabel)
+        if not self.config.statsOnly:
+            for fluxColumn in ["base_PsfFlux_instFlux", "modelfit_CModel_instFlux"]:
+                self.plotStarColorColor(principalColCats, byFilterForcedCats, filenamer, repoInfo.dataId,
+                                        fluxColumn, camera=repoInfo.camera, tractInfo=repoInfo.tractInfo,
+                                        patchList=patchList, hscRun=repoInfo.hscRun,
+                                        forcedStr=self.forcedStr, geLabel=geLabel)
+
+        finishRenderScheduler()
+        finishAnalysisMetrics(filenamer if self.config.statsOnly or self.config.doWriteMetrics else None,
+                              repoInfo.dataId, log=self.log)
+        invalidateDerivedQuantities()
+        clearBackgroundLayers()
+        finishOutputKeys(log=self.log)
 
     def readCatalogs(self, patchRefList, dataset):
         """Read in and concatenate catalogs of type dataset in lists of data references
@@ -480,46 +521,43 @@ class ColorAnalysisTask(CmdLineTask):
     def correctForGalacticExtinction(self, catalog, tractInfo):
         """Correct all fluxes for each object for Galactic Extinction
 
-        This function uses the EBVbase class from lsst.sims.catUtils.dust.EBV, so lsst.sims.catUtils must
-        be setup and accessible for use.
+        E(B-V) is looked up in the locally stored SFD98 dust maps (see the sfdDustMapDir config and
+        `lsst.pipe.analysis.utils.SfdDustMap`).  If these cannot be found, the EBVbase class from
+        lsst.sims.catUtils.dust.EBV is used instead, so lsst.sims.catUtils must then be setup and
+        accessible for use.  The E(B-V) values are computed once and shared across all filters (the
+        forced catalogs have identical source lists).
 
         Parameters
         ----------
-        catalog : `lsst.afw.table.SourceCatalog`
-           The source catalog for which to apply the per-object Galactic Extinction correction to all fluxes.
-           Catalog is corrected in place and a Galactic Extinction applied and flag columns are added.
+        catalog : `dict` of `lsst.afw.table.SourceCatalog`
+           The source catalogs (one per filter) for which to apply the per-object Galactic Extinction
+           correction to all fluxes.  Catalogs are corrected in place and a Galactic Extinction applied
+           and flag columns are added.
         tractInfo : `lsst.skymap.tractInfo.ExplicitTractInfo`
            TractInfo object associated with catalog
 
         Raises
         ------
         `ImportError`
-           If lsst.sims.catUtils.dust.EBV could not be imported.
+           If the SFD98 maps could not be found and lsst.sims.catUtils.dust.EBV could not be imported.
 
         Returns
         -------
-        Updated `lsst.afw.table.source.source.SourceCatalog` catalog with fluxes corrected for
+        Updated `dict` of `lsst.afw.table.source.source.SourceCatalog` catalogs with fluxes corrected for
         Galactic Extinction with a column added indicating correction applied and a flag indicating
         if the correction failed (in the context having a non-np.isfinite value).
         """
-        try:
-            from lsst.sims.catUtils.dust.EBV import EBVbase as ebv
-        except ImportError:
-            raise ImportError("lsst.sims.catUtils.dust.EBV could not be imported.  Cannot use "
-                              "correctForGalacticExtinction function without it.")
+        template = catalog[list(catalog.keys())[0]]
+        ebvValues = self.getEbvValues(template["coord_ra"], template["coord_dec"])
 
         for filterName in catalog.keys():
             if filterName in self.config.extinctionCoeffs:
-                raList = catalog[filterName]["coord_ra"]
-                decList = catalog[filterName]["coord_dec"]
-                ebvObject = ebv()
-                ebvValues = ebvObject.calculateEbv(equatorialCoordinates=np.array([raList, decList]))
                 galacticExtinction = ebvValues*self.config.extinctionCoeffs[filterName]
                 bad = ~np.isfinite(galacticExtinction)
-                if ~np.isfinite(galacticExtinction).all():
+                if bad.any():
                     self.log.warn("Could not compute {0:s} band Galactic Extinction for "
                                   "{1:d} out of {2:d} sources.  Flag will be set.".
-                                  format(filterName, len(raList[bad]), len(raList)))
+                                  format(filterName, bad.sum(), len(bad)))
                 factor = 10.0**(0.4*galacticExtinction)
                 fluxKeys, errKeys = getFluxKeys(catalog[filterName].schema)
                 self.log.info("Applying per-object Galactic Extinction correction for filter {0:s}.  "
@@ -527,11 +565,13 @@ class ColorAnalysisTask(CmdLineTask):
                               format(filterName, galacticExtinction[~bad].mean()))
                 for name, key in list(fluxKeys.items()) + list(errKeys.items()):
                     catalog[filterName][key] *= factor
+                invalidateDerivedQuantities(catalog[filterName])
             else:
                 self.log.warn("Do not have A_X/E(B-V) for filter {0:s}.  "
                               "No Galactic Extinction correction applied for that filter.  "
                               "Flag will be set".format(filterName))
-                bad = np.ones(len(catalog[list(catalog.keys())[0]]), dtype=bool)
+                galacticExtinction = np.full(len(template), np.nan)
+                bad = np.ones(len(template), dtype=bool)
             # Add column of Galactic Extinction value applied to the catalog and a flag for the sources
             # for which it could not be computed
             catalog[filterName] = addIntFloatOrStrColumn(catalog[filterName], galacticExtinction,
@@ -543,6 +583,43 @@ class ColorAnalysisTask(CmdLineTask):
 
         return catalog
 
+    def getEbvValues(self, ra, dec):
+        """Return the SFD98 E(B-V) values at the given positions
+
+        The local memory-mapped SFD98 maps are used if available, otherwise the EBVbase class from
+        lsst.sims.catUtils.dust.EBV (instantiated once only).
+
+        Parameters
+        ----------
+        ra, dec : `numpy.ndarray`
+           Right Ascension and Declination (in radians).
+
+        Raises
+        ------
+        `ImportError`
+           If the SFD98 maps could not be found and lsst.sims.catUtils.dust.EBV could not be imported.
+
+        Returns
+        -------
+        ebvValues : `numpy.ndarray`
+           The E(B-V) values (in mags).
+        """
+        try:
+            sfdDustMap = getSfdDustMap(self.config.sfdDustMapDir)
+        except (IOError, RuntimeError) as e:
+            self.log.info("Local SFD dust maps unavailable ({0:s}).  Trying lsst.sims.catUtils.".
+                          format(str(e)))
+        else:
+            self.log.info("Using local SFD dust maps in {0:s}".format(sfdDustMap.mapDir))
+            return sfdDustMap.ebv(ra, dec)
+
+        try:
+            from lsst.sims.catUtils.dust.EBV import EBVbase as ebv
+        except ImportError:
+            raise ImportError("lsst.sims.catUtils.dust.EBV could not be imported and no local SFD dust maps "
+                              "were found.  Cannot use correctForGalacticExtinction function without them.")
+        return ebv().calculateEbv(equatorialCoordinates=np.array([ra, dec]))
+
     def correctFieldForGalacticExtinction(self, catalog, tractInfo):
         """Apply a per-field correction for Galactic Extinction using hard-wired values
 
@@ -580,6 +657,7 @@ class ColorAnalysisTask(CmdLineTask):
                     factor = 10.0**(0.4*galacticExtinction)
                     for name, key in list(fluxKeys.items()) + list(errKeys.items()):
                         catalog[filterName][key] *= factor
+                    invalidateDerivedQuantities(catalog[filterName])
                     # Add column of Galactic Extinction value applied to the catalog
                     catalog[filterName] = addIntFloatOrStrColumn(catalog[filterName], galacticExtinction,
                                                                  "A_" + str(filterName),
@@ -779,7 +857,7 @@ class ColorAnalysisTask(CmdLineTask):
                                          extraLabels=principalColorStrs)
 
             # Plot selections of stars for different criteria
-            if self.config.transforms == ivezicTransformsHSC:
+            if self.config.transforms == ivezicTransformsHSC and not self.config.statsOnly:
                 filename = filenamer(dataId,
                                      description=filtersStr + fluxToPlotString("base_PsfFlux_instFlux"),
                                      style=col + "Selections")
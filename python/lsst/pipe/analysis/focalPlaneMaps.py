@@ -0,0 +1,368 @@
+import fcntl
+import glob
+import os
+
+import matplotlib
+matplotlib.use("Agg")  # noqa E402
+import matplotlib.pyplot as plt
+import numpy as np
+
+from lsst.daf.persistence.safeFileIo import safeMakeDir
+from lsst.pipe.base import Struct
+
+from .plotUtils import plotCameraOutline, plotFocalPlaneMap, labelVisit, labelCamera
+from .renderScheduler import getRenderScheduler
+
+__all__ = ["FocalPlaneMaps", "startFocalPlaneMaps", "getFocalPlaneMaps", "finishFocalPlaneMaps",
+           "updateMultiVisitFocalPlaneMaps"]
+
+
+def _dataIdToString(dataId):
+    return "-".join("{0:s}{1:s}".format(str(key), str(dataId[key]).replace(",", "x"))
+                    for key in sorted(dataId))
+
+
+class FocalPlaneMaps(object):
+    """Running statistics of analysis quantities in a grid of cells on each CCD
+
+    For each named quantity, the number, sum and sum of squares of its values are accumulated in
+    ``numCells`` cells on each CCD, so a binned focal plane map of any number of sources (or visits)
+    costs only in proportion to the number of cells.  The accumulators may be saved, loaded, added
+    and subtracted, so maps over many visits can be updated incrementally.
+
+    Parameters
+    ----------
+    ccdIds : `list` of `int`
+       Ids of the CCDs of the camera.
+    ccdDims : `list` of `tuple` of `int`
+       Width and height (pixels) of each CCD.
+    numCells : `tuple` of `int`, optional
+       Number of cells along the x and y (pixel) axes of each CCD.
+    visits : iterable of `str`, optional
+       Keys of the visits contributing to the accumulators.
+    """
+    def __init__(self, ccdIds, ccdDims, numCells=(4, 8), visits=()):
+        order = np.argsort(ccdIds)
+        self.ccdIds = np.asarray(ccdIds, dtype=np.int64)[order]
+        self.ccdDims = np.asarray(ccdDims, dtype=np.float64).reshape(-1, 2)[order]
+        self.numCells = tuple(int(num) for num in numCells)
+        self.visits = set(visits)
+        self.accumulators = {}  # (count, sum, sumSq) arrays of shape self.shape, by name
+        self.camera = None
+
+    @classmethod
+    def fromCamera(cls, camera, numCells=(4, 8)):
+        """Construct empty accumulators for the CCDs of a camera"""
+        ccds = list(camera)
+        maps = cls([ccd.getId() for ccd in ccds],
+                   [(ccd.getBBox().getWidth(), ccd.getBBox().getHeight()) for ccd in ccds], numCells)
+        maps.camera = camera
+        return maps
+
+    @property
+    def shape(self):
+        return (len(self.ccdIds), self.numCells[1], self.numCells[0])
+
+    def copyEmpty(self):
+        """Return empty accumulators for the same CCDs and cells"""
+        maps = FocalPlaneMaps(self.ccdIds, self.ccdDims, self.numCells)
+        maps.camera = self.camera
+        return maps
+
+    def isCompatible(self, other):
+        """Are other's accumulators for the same CCDs and cells?"""
+        return (self.numCells == other.numCells and np.array_equal(self.ccdIds, other.ccdIds) and
+                np.array_equal(self.ccdDims, other.ccdDims))
+
+    def cellIndices(self, ccdIds, x, y):
+        """Return the flattened (CCD, cell) index of each position (-1 if not on a known CCD)
+
+        Parameters
+        ----------
+        ccdIds : `numpy.ndarray` of `int`
+           CCD (camera detector) id of each position.
+        x, y : `numpy.ndarray`
+           Pixel position on the CCD.
+        """
+        ccdIds = np.asarray(ccdIds, dtype=np.int64)
+        ccdIndex = np.clip(np.searchsorted(self.ccdIds, ccdIds), 0, len(self.ccdIds) - 1)
+        dims = self.ccdDims[ccdIndex]
+        with np.errstate(invalid="ignore"):
+            xCell = np.floor(np.asarray(x)/dims[:, 0]*self.numCells[0])
+            yCell = np.floor(np.asarray(y)/dims[:, 1]*self.numCells[1])
+            valid = ((self.ccdIds[ccdIndex] == ccdIds) & (xCell >= 0) & (xCell < self.numCells[0]) &
+                     (yCell >= 0) & (yCell < self.numCells[1]))
+        xCell = np.where(valid, xCell, 0).astype(np.int64)
+        yCell = np.where(valid, yCell, 0).astype(np.int64)
+        return np.where(valid, (ccdIndex*self.numCells[1] + yCell)*self.numCells[0] + xCell, -1)
+
+    def accumulate(self, name, ccdIds, x, y, values):
+        """Accumulate the values of a quantity at the given CCD pixel positions
+
+        Parameters
+        ----------
+        name : `str`
+           Name of the quantity.
+        ccdIds : `numpy.ndarray` of `int`
+           CCD id of each value.
+        x, y : `numpy.ndarray`
+           Pixel position on the CCD of each value.
+        values : `numpy.ndarray`
+           Values of the quantity; non-finite values are ignored.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        index = self.cellIndices(ccdIds, x, y)
+        good = (index >= 0) & np.isfinite(values)
+        index = index[good]
+        values = values[good]
+        size = int(np.prod(self.shape))
+        accumulator = self.accumulators.setdefault(name, np.zeros((3,) + self.shape))
+        for i, weights in enumerate((None, values, values**2)):
+            accumulator[i] += np.bincount(index, weights=weights, minlength=size).reshape(self.shape)
+
+    def add(self, other, sign=1):
+        """Add (or, with ``sign=-1``, subtract) other's accumulators and visits to these"""
+        if not self.isCompatible(other):
+            raise RuntimeError("Cannot combine focal plane maps of different CCDs or cells")
+        for name, accumulator in other.accumulators.items():
+            self.accumulators.setdefault(name, np.zeros((3,) + self.shape))
+            self.accumulators[name] += sign*accumulator
+        if sign > 0:
+            self.visits |= other.visits
+        else:
+            self.visits -= other.visits
+
+    def getMap(self, name):
+        """Return the statistics of a quantity in each cell
+
+        Returns
+        -------
+        result : `lsst.pipe.base.Struct`
+           Result struct with components (each a `numpy.ndarray` of shape ``shape``):
+
+           - ``count`` : number of values in each cell.
+           - ``mean`` : mean of the values in each cell (NaN if empty).
+           - ``stdev`` : rms about the mean in each cell (NaN if empty).
+        """
+        count, total, totalSq = self.accumulators[name]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            count = np.round(count)  # Guard against rounding errors of subtracted contributions
+            mean = np.where(count > 0, total/count, np.nan)
+            stdev = np.sqrt(np.clip(np.where(count > 0, totalSq/count, np.nan) - mean**2, 0.0, None))
+        return Struct(count=count, mean=mean, stdev=stdev)
+
+    def save(self, filename):
+        """Save the accumulators to a numpy (npz) file, written to a temporary file that is then renamed"""
+        names = sorted(self.accumulators)
+        safeMakeDir(os.path.dirname(filename))
+        tempFilename = filename[:-len(".npz")] + ".tmp.npz"
+        np.savez_compressed(tempFilename, ccdIds=self.ccdIds, ccdDims=self.ccdDims,
+                            numCells=np.array(self.numCells), visits=np.array(sorted(self.visits), dtype=str),
+                            names=np.array(names, dtype=str),
+                            accumulators=np.array([self.accumulators[name] for name in names]).reshape(
+                                (len(names), 3) + self.shape))
+        os.rename(tempFilename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Load accumulators saved by `save` (`None` if they cannot be read)"""
+        try:
+            with np.load(filename) as stored:
+                maps = cls(stored["ccdIds"], stored["ccdDims"], tuple(stored["numCells"]),
+                           visits=[str(visit) for visit in stored["visits"]])
+                for name, accumulator in zip(stored["names"], stored["accumulators"]):
+                    maps.accumulators[str(name)] = accumulator
+        except (IOError, KeyError, ValueError):
+            return None
+        return maps
+
+
+def writeFocalPlaneMap(filename, maps, name, camera, title=None, cmap=plt.cm.Spectral, fontSize=8):
+    """Render the map of the mean of a quantity in each cell of each CCD
+
+    Parameters
+    ----------
+    filename : `str`
+       Name of the file to which to write the map.
+    maps : `FocalPlaneMaps`
+       Accumulators of the quantity.
+    name : `str`
+       Name of the quantity.
+    camera : `lsst.afw.cameraGeom.Camera`
+       Camera of the CCDs.
+    title : `str`, optional
+       Title of the map.
+    """
+    cellMap = maps.getMap(name)
+    finite = np.isfinite(cellMap.mean)
+    if not finite.any():
+        return
+    vMin, vMax = np.percentile(cellMap.mean[finite], [2.0, 98.0])
+    if vMin == vMax:
+        vMin, vMax = vMin - 0.5, vMax + 0.5
+    fig, axes = plt.subplots(1, 1, subplot_kw=dict(facecolor="0.7"))
+    axes.tick_params(which="both", direction="in", top=True, right=True, labelsize=fontSize)
+    ccdList = [ccdId for ccdId, count in zip(maps.ccdIds, cellMap.count.sum(axis=(1, 2))) if count > 0]
+    plotCameraOutline(plt, axes, camera, ccdList, fontSize=fontSize)
+    collection = plotFocalPlaneMap(axes, camera, maps.ccdIds, cellMap.mean, cmap=cmap, vmin=vMin, vmax=vMax)
+    cb = fig.colorbar(collection)
+    cb.set_label("{:s} (mean per cell)".format(name), rotation=270, labelpad=15)
+    axes.set_xlabel("x_fpa (pixels)")
+    axes.set_ylabel("y_fpa (pixels)")
+    if title is not None:
+        axes.set_title(title, fontsize=fontSize + 1)
+    else:
+        labelVisit(filename, plt, axes, 0.5, 1.04)
+    labelCamera(camera, plt, axes, 0.5, 1.09)
+    axes.annotate("N = {:d}".format(int(cellMap.count.sum())), xy=(0.98, 0.02), xycoords="axes fraction",
+                  ha="right", va="bottom", fontsize=fontSize)
+    fig.savefig(filename)
+    plt.close(fig)
+
+
+def updateMultiVisitFocalPlaneMaps(maps, directory, dataId, visitKey="visit"):
+    """Add the accumulators of a visit to the multi-visit accumulators in a directory
+
+    The accumulators are combined over the visits sharing the data id (less the visit), e.g. per
+    (tract, filter).  The contribution of each visit is kept, so a rerun of a visit replaces (rather
+    than adds to) its earlier contribution, and the combined accumulators can be rebuilt from the
+    contributions should they be missing or incompatible.  Updates are serialized with a lock file.
+
+    Parameters
+    ----------
+    maps : `FocalPlaneMaps`
+       Accumulators of the visit.
+    directory : `str`
+       Directory of the multi-visit accumulators.
+    dataId : `dict`
+       Data id of the visit (without the CCD).
+    visitKey : `str`, optional
+       Key of the visit in ``dataId``.
+
+    Returns
+    -------
+    combined : `FocalPlaneMaps`
+       The updated multi-visit accumulators.
+    combinedKey : `str`
+       Key of the multi-visit accumulators (the data id less the visit).
+    """
+    combinedKey = _dataIdToString({key: value for key, value in dataId.items() if key != visitKey})
+    contributionDir = os.path.join(directory, combinedKey)
+    contributionFilename = os.path.join(contributionDir, "{:s}.npz".format(_dataIdToString(dataId)))
+    combinedFilename = os.path.join(directory, "focalPlaneMaps-{:s}.npz".format(combinedKey))
+    safeMakeDir(contributionDir)
+    maps.visits = {_dataIdToString(dataId)}
+    with open(combinedFilename + ".lock", "w") as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        combined = FocalPlaneMaps.load(combinedFilename) if os.path.exists(combinedFilename) else None
+        if combined is not None and not combined.isCompatible(maps):
+            combined = None
+        if combined is not None and maps.visits & combined.visits:
+            previous = FocalPlaneMaps.load(contributionFilename)
+            if previous is not None and previous.isCompatible(maps):
+                combined.add(previous, sign=-1)
+            else:
+                combined = None
+        if combined is None:
+            # Rebuild from the contributions of the other visits
+            combined = maps.copyEmpty()
+            for filename in glob.glob(os.path.join(contributionDir, "*.npz")):
+                if filename == contributionFilename or filename.endswith(".tmp.npz"):
+                    continue
+                contribution = FocalPlaneMaps.load(filename)
+                if contribution is not None and contribution.isCompatible(maps):
+                    combined.add(contribution)
+        combined.add(maps)
+        maps.save(contributionFilename)
+        combined.save(combinedFilename)
+    combined.camera = maps.camera
+    return combined, combinedKey
+
+
+_focalPlaneMaps = None
+
+
+def startFocalPlaneMaps(camera, numCells=(4, 8)):
+    """Start accumulating the quantities of all subsequent `CcdAnalysis.plotAll` calls in CCD cells
+
+    Parameters
+    ----------
+    camera : `lsst.afw.cameraGeom.Camera`
+       Camera of the visit.
+    numCells : `tuple` of `int`, optional
+       Number of cells along the x and y axes of each CCD.
+
+    Returns
+    -------
+    maps : `FocalPlaneMaps`
+       The accumulators.
+    """
+    global _focalPlaneMaps
+    _focalPlaneMaps = FocalPlaneMaps.fromCamera(camera, numCells)
+    return _focalPlaneMaps
+
+
+def getFocalPlaneMaps():
+    """Return the current focal plane map accumulators (`None` if not accumulating)"""
+    return _focalPlaneMaps
+
+
+def finishFocalPlaneMaps(filenamer=None, dataId=None, directory=None, doRender=True, log=None):
+    """Stop accumulating, saving the accumulators and rendering their maps
+
+    The accumulators of the visit are saved alongside the plots of ``filenamer``, and a map of each
+    quantity is rendered.  If ``directory`` is given, the accumulators are also added to the
+    multi-visit accumulators there (see `updateMultiVisitFocalPlaneMaps`), whose maps are rendered
+    alongside.  The maps are rendered by the render scheduler, if one is running.
+
+    Parameters
+    ----------
+    filenamer : `lsst.pipe.analysis.utils.Filenamer`, optional
+       Filenamer for the plots of dataId.  Nothing is saved or rendered if `None`.
+    dataId : `dict`, optional
+       Data id of the visit (without the CCD).
+    directory : `str`, optional
+       Directory of the multi-visit accumulators.
+    doRender : `bool`, optional
+       Render the maps (otherwise only the accumulators are saved)?
+    log : `lsst.log.Log`, optional
+       Logger for diagnostics.
+
+    Returns
+    -------
+    maps : `FocalPlaneMaps`
+       The accumulators that were stopped (`None` if not accumulating).
+    """
+    global _focalPlaneMaps
+    maps = _focalPlaneMaps
+    _focalPlaneMaps = None
+    if maps is None or filenamer is None or not maps.accumulators:
+        return maps
+    scheduler = getRenderScheduler()
+
+    def render(filename, *args, **kwargs):
+        if not doRender:
+            return
+        if scheduler is not None:
+            scheduler.submit(filename, writeFocalPlaneMap, filename, *args, **kwargs)
+        else:
+            writeFocalPlaneMap(filename, *args, **kwargs)
+
+    mapsFilename = os.path.join(os.path.dirname(filenamer(dataId, description="focalPlaneMaps", style="npz")),
+                                "focalPlaneMaps-{:s}.npz".format(_dataIdToString(dataId)))
+    maps.save(mapsFilename)
+    for name in sorted(maps.accumulators):
+        render(filenamer(dataId, description=name, style="fpaMap"), maps, name, maps.camera)
+    if log is not None:
+        log.info("Wrote focal plane map accumulators of {0:d} quantities to {1:s}".format(
+                 len(maps.accumulators), mapsFilename))
+    if directory is not None:
+        combined, combinedKey = updateMultiVisitFocalPlaneMaps(maps, directory, dataId)
+        title = "{0:s}: {1:d} visits".format(combinedKey, len(combined.visits))
+        for name in sorted(combined.accumulators):
+            render(os.path.join(directory, "focalPlaneMap-{0:s}-{1:s}.png".format(combinedKey, name)),
+                   combined, name, combined.camera, title=title)
+        if log is not None:
+            log.info("Updated multi-visit focal plane maps of {0:d} visits in {1:s}".format(
+                     len(combined.visits), directory))
+    return maps
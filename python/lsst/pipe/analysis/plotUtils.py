@@ -1,5 +1,10 @@
+import hashlib
+import os
+from collections import OrderedDict
+
 from matplotlib import pyplot as plt
-from matplotlib.colors import ListedColormap
+from matplotlib.collections import PolyCollection
+from matplotlib.colors import ListedColormap, LinearSegmentedColormap, LogNorm, Normalize, to_rgba
 import matplotlib.patches as patches
 import numpy as np
 
@@ -7,9 +12,11 @@ import lsst.afw.cameraGeom as cameraGeom
 import lsst.afw.geom as afwGeom
 import lsst.afw.image as afwImage
 import lsst.afw.table as afwTable
+from lsst.daf.persistence.safeFileIo import safeMakeDir
 from lsst.pipe.base import Struct
 
-from .utils import checkHscStack, findCcdKey
+from .utils import (checkHscStack, findCcdKey, getRepositoryId, SkyMatcher, histogramBinIndices,
+                    binnedStatistics)
 
 try:
     from lsst.meas.mosaic.updateExposure import applyMosaicResultsExposure
@@ -17,10 +24,14 @@ except ImportError:
     applyMosaicResultsExposure = None
 
 __all__ = ["AllLabeller", "StarGalaxyLabeller", "OverlapsStarGalaxyLabeller", "MatchesStarGalaxyLabeller",
-           "CosmosLabeller", "plotText", "annotateAxes", "labelVisit", "labelCamera",
-           "filterStrFromFilename", "plotCameraOutline", "plotTractOutline", "plotPatchOutline",
-           "plotCcdOutline", "rotatePixelCoords", "bboxToXyCoordLists", "getRaDecMinMaxPatchList",
-           "percent", "setPtSize", "getQuiver", "makeAlphaCmap", "buildTractImage"]
+           "loadCosmosCatalog", "CosmosLabeller", "plotText", "annotateAxes", "labelVisit", "labelCamera",
+           "filterStrFromFilename", "plotCameraOutline", "getFocalPlaneCellVertices", "plotFocalPlaneMap",
+           "plotTractOutline", "plotPatchOutline",
+           "drawBackgroundLayer", "clearBackgroundLayers", "getCcdOutlines", "clearCcdOutlineCache",
+           "plotCcdOutline", "rotatePixelCoords",
+           "bboxToXyCoordLists", "getRaDecMinMaxPatchList",
+           "percent", "setPtSize", "getQuiver", "binWhiskers", "makeAlphaCmap", "plotDensity",
+           "buildTractImage", "TractImagePyramid"]
 
 
 class AllLabeller(object):
@@ -58,27 +69,73 @@ class MatchesStarGalaxyLabeller(StarGalaxyLabeller):
     _column = "src_base_ClassificationExtendedness_value"
 
 
-class CosmosLabeller(StarGalaxyLabeller):
-    """Do star/galaxy classification using Alexie Leauthaud's Cosmos catalog"""
-    def __init__(self, filename, radius):
+_cosmosCatalogs = {}
+
+
+def loadCosmosCatalog(filename, cacheFilename=None):
+    """Load the clean stars of Alexie Leauthaud's Cosmos catalog into numpy arrays with a spatial index
+
+    The catalog is loaded once only per process (subsequent calls return the same object).  If
+    ``cacheFilename`` is provided, the arrays are also cached there in numpy (npz) format and read from
+    it (rather than from the FITS file) while it is newer than the FITS file.
+
+    Parameters
+    ----------
+    filename : `str`
+       Name of the Cosmos FITS catalog.
+    cacheFilename : `str` or `None`, optional
+       Name of the npz file in which to cache the catalog arrays.
+
+    Returns
+    -------
+    cosmos : `lsst.pipe.base.Struct`
+       Result struct with components:
+
+       - ``id`` : Cosmos object ids (`numpy.ndarray` of `int`).
+       - ``ra``, ``dec`` : positions (in radians) (`numpy.ndarray` of `float`).
+       - ``matcher`` : spatial index of the positions (`lsst.pipe.analysis.utils.SkyMatcher`).
+    """
+    if filename in _cosmosCatalogs:
+        return _cosmosCatalogs[filename]
+    arrays = None
+    if (cacheFilename is not None and os.path.exists(cacheFilename) and
+            os.path.getmtime(cacheFilename) >= os.path.getmtime(filename)):
+        with np.load(cacheFilename) as cached:
+            arrays = {name: cached[name] for name in ("id", "ra", "dec")}
+    if arrays is None:
         original = afwTable.BaseCatalog.readFits(filename)
         good = (original["CLEAN"] == 1) & (original["MU.CLASS"] == 2)
-        num = good.sum()
-        cosmos = afwTable.SimpleCatalog(afwTable.SimpleTable.makeMinimalSchema())
-        cosmos.reserve(num)
-        for ii in range(num):
-            cosmos.addNew()
-        cosmos["id"][:] = original["NUMBER"][good]
-        cosmos["coord_ra"][:] = original["ALPHA.J2000"][good]*(1.0*afwGeom.degrees).asRadians()
-        cosmos["coord_dec"][:] = original["DELTA.J2000"][good]*(1.0*afwGeom.degrees).asRadians()
-        self.cosmos = cosmos
+        arrays = {"id": original["NUMBER"][good].astype(np.int64),
+                  "ra": original["ALPHA.J2000"][good]*(1.0*afwGeom.degrees).asRadians(),
+                  "dec": original["DELTA.J2000"][good]*(1.0*afwGeom.degrees).asRadians()}
+        if cacheFilename is not None:
+            try:
+                np.savez(cacheFilename, **arrays)
+            except (IOError, OSError):
+                pass
+    cosmos = Struct(matcher=SkyMatcher(arrays["ra"], arrays["dec"]), **arrays)
+    _cosmosCatalogs[filename] = cosmos
+    return cosmos
+
+
+class CosmosLabeller(StarGalaxyLabeller):
+    """Do star/galaxy classification using Alexie Leauthaud's Cosmos catalog
+
+    The catalog is loaded (and spatially indexed) once only per process: see `loadCosmosCatalog`.
+    """
+    def __init__(self, filename, radius, cacheFilename=None):
+        self.cosmos = loadCosmosCatalog(filename, cacheFilename=cacheFilename)
         self.radius = radius
 
     def __call__(self, catalog):
-        # A kdTree would be better, but this is all we have right now
-        matches = afwTable.matchRaDec(self.cosmos, catalog, self.radius)
-        good = set(mm.second.getId() for mm in matches)
-        return np.array([0 if ii in good else 1 for ii in catalog["id"]])
+        # For each Cosmos object, the nearest source in catalog (within radius) is labelled a star
+        index1, index2, distance = self.cosmos.matcher.withinRadius(catalog["coord_ra"], catalog["coord_dec"],
+                                                                    self.radius)
+        order = np.lexsort((distance, index2))
+        first = np.unique(index2[order], return_index=True)[1]
+        good = np.zeros(len(catalog), dtype=bool)
+        good[index1[order][first]] = True
+        return np.where(good, 0, 1)
 
 
 def plotText(textStr, plt, axis, xLoc, yLoc, prefix="", fontSize=9, color="k", coordSys="axes", **kwargs):
@@ -250,6 +307,153 @@ def plotCameraOutline(plt, axes, camera, ccdList, color="k", fontSize=6):
               color=color)
 
 
+# Focal plane vertices of the cells of each CCD, by (camera name, number of cells)
+_focalPlaneCellVertices = {}
+
+
+def getFocalPlaneCellVertices(camera, numCells):
+    """Return the focal plane vertices of a grid of cells on each CCD of a camera
+
+    Parameters
+    ----------
+    camera : `lsst.afw.cameraGeom.Camera`
+       Camera whose CCDs are divided into cells.
+    numCells : `tuple` of `int`
+       Number of cells along the x and y (pixel) axes of each CCD.
+
+    Returns
+    -------
+    vertices : `dict`
+       Vertices (`numpy.ndarray` of shape (numCellsY, numCellsX, 4, 2)) of the cells, by CCD id.
+    """
+    key = (camera.getName(), tuple(numCells))
+    if key not in _focalPlaneCellVertices:
+        vertices = {}
+        for ccd in camera:
+            bbox = ccd.getBBox()
+            pixelsToFocalPlane = ccd.getTransform(cameraGeom.PIXELS, cameraGeom.FOCAL_PLANE)
+            xEdges = np.linspace(0.0, bbox.getWidth(), numCells[0] + 1)
+            yEdges = np.linspace(0.0, bbox.getHeight(), numCells[1] + 1)
+            corners = np.array([[list(pixelsToFocalPlane.applyForward(afwGeom.Point2D(x, y))) for
+                                 x in xEdges] for y in yEdges])
+            vertices[ccd.getId()] = np.stack([corners[:-1, :-1], corners[:-1, 1:], corners[1:, 1:],
+                                              corners[1:, :-1]], axis=2)
+        _focalPlaneCellVertices[key] = vertices
+    return _focalPlaneCellVertices[key]
+
+
+def plotFocalPlaneMap(axes, camera, ccdIds, cellValues, cmap=plt.cm.Spectral, vmin=None, vmax=None):
+    """Draw values in a grid of cells on each CCD as a focal plane map
+
+    The cost is proportional to the number of cells, however many sources contributed to the values.
+
+    Parameters
+    ----------
+    axes : `matplotlib.axes.Axes`
+       Axes on which to draw (in focal plane coordinates, e.g. following `plotCameraOutline`).
+    camera : `lsst.afw.cameraGeom.Camera`
+       Camera of the CCDs.
+    ccdIds : `numpy.ndarray` of `int`
+       Ids of the CCDs of ``cellValues``.
+    cellValues : `numpy.ndarray`
+       Values of shape (len(ccdIds), numCellsY, numCellsX); non-finite cells are not drawn.
+    cmap : `matplotlib.colors.Colormap`, optional
+       Colormap for the values.
+    vmin, vmax : `float`, optional
+       Limits of the colormap.
+
+    Returns
+    -------
+    collection : `matplotlib.collections.PolyCollection`
+       The cells drawn (for a colorbar).
+    """
+    numCellsY, numCellsX = cellValues.shape[1:]
+    vertices = getFocalPlaneCellVertices(camera, (numCellsX, numCellsY))
+    cellVertices = [np.zeros((0, 4, 2))]
+    values = [np.zeros(0)]
+    for ccdId, ccdValues in zip(ccdIds, cellValues):
+        if ccdId not in vertices:
+            continue
+        good = np.isfinite(ccdValues)
+        cellVertices.append(vertices[ccdId][good])
+        values.append(ccdValues[good])
+    collection = PolyCollection(np.concatenate(cellVertices), array=np.concatenate(values), cmap=cmap,
+                                norm=Normalize(vmin=vmin, vmax=vmax), edgecolors="none", zorder=3)
+    axes.add_collection(collection)
+    return collection
+
+
+class _RecordingAxes(object):
+    """Proxy for a matplotlib axes recording the method calls made on it, for replay on other axes"""
+    def __init__(self, axes):
+        self._axes = axes
+        self.calls = []
+
+    def __getattr__(self, name):
+        attr = getattr(self._axes, name)
+        if not callable(attr):
+            return attr
+
+        def record(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return attr(*args, **kwargs)
+        return record
+
+
+# Drawing calls of the static background layers (outlines of tracts, patches and CCDs), by key
+_backgroundLayers = OrderedDict()
+
+
+def drawBackgroundLayer(axes, key, drawFunc, *args, **kwargs):
+    """Draw a static background layer, replaying its drawing calls if it has been drawn before
+
+    The background layers of the sky plots (e.g. the tract, patch and CCD outlines) are the same for
+    all the plots of a tract or visit.  The first time a layer is drawn, the calls ``drawFunc`` makes
+    on the axes are recorded; subsequently they are replayed on the new axes, avoiding recomputing the
+    layer (the WCS evaluations, data reads, etc.).  The layers are cleared at the end of each task
+    stage (see `clearBackgroundLayers`).
+
+    The recordings are held in the process drawing the layer, so the cache only helps serial rendering:
+    with parallel rendering (see `lsst.pipe.analysis.renderScheduler`) each figure is drawn in its own
+    forked worker, whose recordings never reach the main process (the CCD outlines themselves are
+    resolved in the main process before forking; see `getCcdOutlines`).
+
+    Parameters
+    ----------
+    axes : `matplotlib.axes.Axes`
+       Axes on which to draw.
+    key : hashable
+       Key uniquely identifying the layer (and its drawing parameters).
+    drawFunc : callable
+       Function drawing the layer, called as ``drawFunc(axes, *args, **kwargs)``.  It must only draw
+       through methods of ``axes``, with arguments not referring to the axes (e.g. its transforms).
+    maxLayers : `int`, optional
+       Maximum number of layers retained (keyword only; default 64).
+    """
+    maxLayers = kwargs.pop("maxLayers", 64)
+    calls = _backgroundLayers.pop(key, None)
+    if calls is None:
+        recorder = _RecordingAxes(axes)
+        drawFunc(recorder, *args, **kwargs)
+        calls = recorder.calls
+    else:
+        for name, callArgs, callKwargs in calls:
+            getattr(axes, name)(*callArgs, **callKwargs)
+    _backgroundLayers[key] = calls
+    while len(_backgroundLayers) > maxLayers:
+        _backgroundLayers.popitem(last=False)
+
+
+def clearBackgroundLayers():
+    """Clear the cache of background layers used by `drawBackgroundLayer`"""
+    _backgroundLayers.clear()
+
+
+def _dataIdKey(dataId):
+    """Return a hashable key for a data id"""
+    return tuple(sorted((str(name), str(value)) for name, value in dataId.items()))
+
+
 def plotTractOutline(axes, tractInfo, patchList, fontSize=5, maxDegBeyondPatch=1.5):
     """Plot the the outline of the tract and patches highlighting those with data
 
@@ -269,6 +473,13 @@ def plotTractOutline(axes, tractInfo, patchList, fontSize=5, maxDegBeyondPatch=1
     maxDegBeyondPatch : `float`
        Maximum number of degrees to plot beyond the border defined by all patches with data to be plotted.
     """
+    drawBackgroundLayer(axes, ("tractOutline", tractInfo.getId(), tuple(patchList), fontSize,
+                               maxDegBeyondPatch),
+                        _plotTractOutline, tractInfo, patchList, fontSize=fontSize,
+                        maxDegBeyondPatch=maxDegBeyondPatch)
+
+
+def _plotTractOutline(axes, tractInfo, patchList, fontSize=5, maxDegBeyondPatch=1.5):
     buff = 0.02
     axes.tick_params(which="both", direction="in", labelsize=fontSize)
     axes.locator_params(nbins=6)
@@ -316,12 +527,94 @@ def plotTractOutline(axes, tractInfo, patchList, fontSize=5, maxDegBeyondPatch=1
     axes.set_ylim(ylim)
 
 
-def plotCcdOutline(axes, butler, dataId, ccdList, zpLabel=None, fontSize=8):
-    """!Plot outlines of CCDs in ccdList
+# Sky outlines of CCDs, keyed by (repository, data id, calibration mode); shared by the sky plots of a visit
+_ccdOutlines = {}
+
+
+def clearCcdOutlineCache():
+    """Clear the cache of CCD outlines used by `getCcdOutlines`"""
+    _ccdOutlines.clear()
+
+
+def _computeCcdOutline(butler, dataId, useMosaic=False):
+    """Compute the sky outline of a CCD from its WCS and bounding box
+
+    Only the calexp metadata (and the jointcal_wcs, if calibrating with meas_mosaic results) are read.
+    The full calexp is only read (and the meas_mosaic results applied to it) if no jointcal_wcs is
+    available or for HSC stack runs, for which the mosaic results may rotate the CCD.
+
+    Returns
+    -------
+    result : `lsst.pipe.base.Struct`
+       Result struct with components:
+
+       - ``ras``, ``decs`` : RA and Dec of the closed outline of the CCD (deg; `numpy.ndarray`).
+       - ``centerRa``, ``centerDec`` : RA and Dec of the center of the CCD (deg; `float`).
     """
+    # Check metadata to see if stack used was HSC
+    metadata = butler.get("calexp_md", dataId)
+    hscRun = checkHscStack(metadata)
+    bbox = afwImage.bboxFromMetadata(metadata)
+    w = bbox.getWidth()
+    h = bbox.getHeight()
+    wcs = None
+    if not useMosaic:
+        wcs = afwGeom.makeSkyWcs(metadata, strip=False)
+    elif not hscRun:
+        try:
+            wcs = butler.get("jointcal_wcs", dataId)
+        except Exception:
+            wcs = None
+    if wcs is None:
+        calexp = butler.get("calexp", dataId)
+        dataRef = butler.dataRef("raw", dataId=dataId)
+        applyMosaicResultsExposure(dataRef, calexp=calexp)
+        wcs = calexp.getWcs()
+        w = calexp.getWidth()
+        h = calexp.getHeight()
+        if hscRun:
+            nQuarter = calexp.getDetector().getOrientation().getNQuarter()
+            if nQuarter%2 != 0:
+                w = calexp.getHeight()
+                h = calexp.getWidth()
+
+    ras = []
+    decs = []
+    for x, y in zip([0, w, w, 0, 0, w/2], [0, 0, h, h, 0, h/2]):
+        coord = wcs.pixelToSky(afwGeom.Point2D(x, y))
+        ras.append(coord.getRa().asDegrees())
+        decs.append(coord.getDec().asDegrees())
+    return Struct(ras=np.array(ras[:-1]), decs=np.array(decs[:-1]), centerRa=ras[-1], centerDec=decs[-1])
+
+
+def getCcdOutlines(butler, dataId, ccdList, zpLabel=None):
+    """Return the (cached) sky outlines of the CCDs in ccdList
+
+    The outlines are computed from the WCS and bounding box of each CCD (see `_computeCcdOutline`)
+    and cached per (visit, ccd, repository, calibration mode), so all the sky plots of a visit reuse
+    them; `clearCcdOutlineCache` is called at the end of each visit stage.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.persistence.Butler`
+    dataId : `lsst.daf.persistence.DataId`
+       Data id of the visit.
+    ccdList : `list`
+       List of the CCDs.
+    zpLabel : `str`, optional
+       Label of the calibration; the meas_mosaic WCSs are used if "MEAS_MOSAIC".
+
+    Returns
+    -------
+    outlines : `list` of `tuple`
+       The (label, outline) of each CCD, with outline a struct as returned by `_computeCcdOutline`.
+    """
+    useMosaic = zpLabel is not None and (zpLabel == "MEAS_MOSAIC" or "MEAS_MOSAIC_1" in zpLabel)
+    repoId = getRepositoryId(butler)
     dataIdCopy = dataId.copy()
+    ccdKey = findCcdKey(dataId)
+    outlines = []
     for ccd in ccdList:
-        ccdKey = findCcdKey(dataId)
         ccdLabelStr = str(ccd)
         if "raft" in dataId:
             if len(ccd) != 4:
@@ -335,43 +628,36 @@ def plotCcdOutline(axes, butler, dataId, ccdList, zpLabel=None, fontSize=8):
             ccd = ccd[-2] + "," + ccd[-1]
             ccdLabelStr = "R" + str(raft) + "S" + str(ccd)
         dataIdCopy[ccdKey] = ccd
-        calexp = butler.get("calexp", dataIdCopy)
-        dataRef = butler.dataRef("raw", dataId=dataIdCopy)
-        # Check metadata to see if stack used was HSC
-        metadata = butler.get("calexp_md", dataIdCopy)
-        hscRun = checkHscStack(metadata)
-        if zpLabel is not None:
-            if zpLabel == "MEAS_MOSAIC" or "MEAS_MOSAIC_1" in zpLabel:
-                applyMosaicResultsExposure(dataRef, calexp=calexp)
+        key = (repoId, _dataIdKey(dataIdCopy), useMosaic)
+        if key not in _ccdOutlines:
+            _ccdOutlines[key] = _computeCcdOutline(butler, dataIdCopy, useMosaic=useMosaic)
+        outlines.append((ccdLabelStr, _ccdOutlines[key]))
+    return outlines
 
-        wcs = calexp.getWcs()
-        w = calexp.getWidth()
-        h = calexp.getHeight()
-        if zpLabel is not None:
-            if hscRun and (zpLabel == "MEAS_MOSAIC" or "MEAS_MOSAIC_1" in zpLabel):
-                nQuarter = calexp.getDetector().getOrientation().getNQuarter()
-                if nQuarter%2 != 0:
-                    w = calexp.getHeight()
-                    h = calexp.getWidth()
-
-        ras = list()
-        decs = list()
-        for x, y in zip([0, w, w, 0, 0], [0, 0, h, h, 0]):
-            xy = afwGeom.Point2D(x, y)
-            ra = np.rad2deg(np.float64(wcs.pixelToSky(xy)[0]))
-            dec = np.rad2deg(np.float64(wcs.pixelToSky(xy)[1]))
-            ras.append(ra)
-            decs.append(dec)
-        axes.plot(ras, decs, "k-", linewidth=1)
-        xy = afwGeom.Point2D(w/2, h/2)
-        centerX = np.rad2deg(np.float64(wcs.pixelToSky(xy)[0]))
-        centerY = np.rad2deg(np.float64(wcs.pixelToSky(xy)[1]))
-        axes.text(centerX, centerY, "%s" % str(ccdLabelStr), ha="center", va="center", fontsize=fontSize)
+
+def plotCcdOutline(axes, butler, dataId, ccdList, zpLabel=None, fontSize=8):
+    """!Plot outlines of CCDs in ccdList
+    """
+    drawBackgroundLayer(axes, ("ccdOutline", getRepositoryId(butler), _dataIdKey(dataId), tuple(ccdList),
+                               zpLabel, fontSize),
+                        _plotCcdOutline, butler, dataId, ccdList, zpLabel=zpLabel, fontSize=fontSize)
+
+
+def _plotCcdOutline(axes, butler, dataId, ccdList, zpLabel=None, fontSize=8):
+    for ccdLabelStr, outline in getCcdOutlines(butler, dataId, ccdList, zpLabel=zpLabel):
+        axes.plot(outline.ras, outline.decs, "k-", linewidth=1)
+        axes.text(outline.centerRa, outline.centerDec, "%s" % str(ccdLabelStr), ha="center", va="center",
+                  fontsize=fontSize)
 
 
 def plotPatchOutline(axes, tractInfo, patchList, plotUnits="deg", idFontSize=None):
     """!Plot outlines of patches in patchList
     """
+    drawBackgroundLayer(axes, ("patchOutline", tractInfo.getId(), tuple(patchList), plotUnits, idFontSize),
+                        _plotPatchOutline, tractInfo, patchList, plotUnits=plotUnits, idFontSize=idFontSize)
+
+
+def _plotPatchOutline(axes, tractInfo, patchList, plotUnits="deg", idFontSize=None):
     validWcsUnits = ["deg", "rad"]
     idFontSize = max(5, 9 - int(0.4*len(patchList))) if not idFontSize else idFontSize
     for ip, patch in enumerate(tractInfo):
@@ -417,6 +703,10 @@ def rotatePixelCoords(sources, width, height, nQuarter):
     return sources
 
 
+# Memo of bboxToXyCoordLists: (wcs, coordinate lists), by bbox, wcs and units
+_bboxCoordLists = OrderedDict()
+
+
 def bboxToXyCoordLists(bbox, wcs=None, wcsUnits="deg"):
     """Get the corners of a BBox and convert them to x and y coord lists.
 
@@ -442,12 +732,26 @@ def bboxToXyCoordLists(bbox, wcs=None, wcsUnits="deg"):
        The lists associated with the x and y coordinates in appropriate uints.
     """
     validWcsUnits = ["deg", "rad"]
+    if wcs and wcsUnits not in validWcsUnits:
+        raise RuntimeError("wcsUnits must be one of {:}".format(validWcsUnits))
+    # Memoize the WCS evaluations (of the same patches for every plot of a tract)
+    key = (bbox.getMinX(), bbox.getMinY(), bbox.getMaxX(), bbox.getMaxY(), id(wcs) if wcs else None,
+           wcsUnits if wcs else None)
+    entry = _bboxCoordLists.pop(key, None)
+    # Guard against id reuse of the wcs
+    if entry is None or entry[0] is not (wcs if wcs else None):
+        entry = (wcs if wcs else None, _bboxToXyCoordLists(bbox, wcs=wcs, wcsUnits=wcsUnits))
+    _bboxCoordLists[key] = entry
+    while len(_bboxCoordLists) > 4096:
+        _bboxCoordLists.popitem(last=False)
+    return entry[1]
+
+
+def _bboxToXyCoordLists(bbox, wcs=None, wcsUnits="deg"):
     corners = []
     for corner in bbox.getCorners():
         p = afwGeom.Point2D(corner.getX(), corner.getY())
         if wcs:
-            if wcsUnits not in validWcsUnits:
-                raise RuntimeError("wcsUnits must be one of {:}".format(validWcsUnits))
             coord = wcs.pixelToSky(p)
             if wcsUnits == "deg":
                 corners.append([coord.getRa().asDegrees(), coord.getDec().asDegrees()])
@@ -515,8 +819,10 @@ def setPtSize(num, ptSize=12):
 
 def getQuiver(x, y, e1, e2, ax, color=None, scale=3, width=0.005, label=''):
     """Return the quiver object for the given input parameters"""
-    theta = [np.math.atan2(a, b)/2.0 for a, b in zip(e1, e2)]
-    e = np.sqrt(e1**2 + e2**2)
+    e1 = np.asarray(e1)
+    e2 = np.asarray(e2)
+    theta = np.arctan2(e1, e2)/2.0
+    e = np.hypot(e1, e2)
     c1 = e*np.cos(theta)
     c2 = e*np.sin(theta)
     if color is None:
@@ -526,6 +832,44 @@ def getQuiver(x, y, e1, e2, ax, color=None, scale=3, width=0.005, label=''):
     return q
 
 
+def binWhiskers(x, y, e1, e2, binIndex, numBins):
+    """Average the positions and ellipticity components of whiskers in bins
+
+    Averaging the components (rather than the amplitudes and angles) of the spin-2 ellipticities
+    gives the mean whisker of each bin.
+
+    Parameters
+    ----------
+    x, y : `numpy.ndarray`
+       Positions of the whiskers.
+    e1, e2 : `numpy.ndarray`
+       Ellipticity components of the whiskers.
+    binIndex : `numpy.ndarray` of `int`
+       Bin index of each whisker (e.g. a spatial cell or CCD); negative indices are ignored, as are
+       whiskers with a non-finite position or ellipticity.
+    numBins : `int`
+       Number of bins.
+
+    Returns
+    -------
+    result : `lsst.pipe.base.Struct`
+       Result struct with components (for the occupied bins only):
+
+       - ``x``, ``y`` : mean position in each bin (`numpy.ndarray`).
+       - ``e1``, ``e2`` : mean ellipticity components in each bin (`numpy.ndarray`).
+       - ``num`` : number of whiskers in each bin (`numpy.ndarray`).
+    """
+    columns = [np.asarray(values, dtype=np.float64) for values in (x, y, e1, e2)]
+    finite = np.logical_and.reduce([np.isfinite(values) for values in columns])
+    binIndex = np.where(finite, binIndex, -1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = [binnedStatistics(binIndex, numBins, values).mean for values in columns]
+    num = np.bincount(binIndex[binIndex >= 0], minlength=numBins)
+    occupied = num > 0
+    return Struct(x=means[0][occupied], y=means[1][occupied], e1=means[2][occupied],
+                  e2=means[3][occupied], num=num[occupied])
+
+
 def makeAlphaCmap(cmap=plt.cm.viridis, alpha=1.0):
     """Given a matplotlib colormap, return it but with given alpha transparency
 
@@ -549,6 +893,75 @@ def makeAlphaCmap(cmap=plt.cm.viridis, alpha=1.0):
     return alphaCmap
 
 
+def plotDensity(axes, x, y, values=None, statistic="mean", extent=None, cmap=plt.cm.viridis, vmin=None,
+                vmax=None, color=None, zorder=None):
+    """Render points aggregated onto the output pixel grid of the axes as a single image
+
+    The large-N alternative to ``axes.scatter``: the points are binned (with `numpy.bincount`) onto the
+    grid of pixels the axes occupy in the figure, and each pixel is coloured by the mean or median of
+    ``values`` within it, or by the number of points.  Pixels containing no points are transparent.
+
+    Parameters
+    ----------
+    axes : `matplotlib.axes.Axes`
+       Axes on which to draw.
+    x, y : `numpy.ndarray`
+       Coordinates of the points.
+    values : `numpy.ndarray`, optional
+       Value of each point by which to colour the pixels; the pixels are coloured by the number of
+       points if `None`.
+    statistic : `str`
+       Statistic of the values in each pixel by which to colour it: "mean", "median" or "count".
+    extent : `tuple` of `float`, optional
+       Limits (xMin, xMax, yMin, yMax) of the region to render; the range of the points if `None`.
+    cmap : `matplotlib.colors.Colormap`
+       Colormap for the values.
+    vmin, vmax : `float`, optional
+       Limits of the colormap for the values (ignored for the counts, which are log scaled).
+    color : matplotlib color, optional
+       Colour in which to render the counts (with opacity scaling with the count), instead of ``cmap``.
+    zorder : `float`, optional
+       Drawing order of the image.
+
+    Returns
+    -------
+    image : `matplotlib.image.AxesImage`
+       The rendered image (usable as the mappable of a colorbar).
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if extent is None:
+        finite = np.isfinite(x) & np.isfinite(y)
+        extent = ((x[finite].min(), x[finite].max(), y[finite].min(), y[finite].max()) if finite.any() else
+                  (0.0, 1.0, 0.0, 1.0))
+    xMin, xMax = sorted(extent[:2])
+    yMin, yMax = sorted(extent[2:])
+    window = axes.get_window_extent()
+    numX = max(1, int(np.ceil(window.width)))
+    numY = max(1, int(np.ceil(window.height)))
+
+    xIndex = histogramBinIndices(x, numX, range=(xMin, xMax))[0]
+    yIndex = histogramBinIndices(y, numY, range=(yMin, yMax))[0]
+    pixelIndex = np.where((xIndex >= 0) & (yIndex >= 0), yIndex*numX + xIndex, -1)
+    if values is None or statistic == "count":
+        pixelStats = binnedStatistics(pixelIndex, numX*numY)
+        image = pixelStats.count.astype(np.float64)
+        norm = LogNorm(vmin=1.0, vmax=max(1.0, image.max()))
+        if color is not None:
+            cmap = LinearSegmentedColormap.from_list("density", [to_rgba(color, 0.2), to_rgba(color, 1.0)])
+    else:
+        values = np.asarray(values)
+        pixelIndex[~np.isfinite(values)] = -1
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pixelStats = binnedStatistics(pixelIndex, numX*numY, values, doMedian=(statistic == "median"))
+        image = pixelStats.median if statistic == "median" else pixelStats.mean
+        norm = Normalize(vmin=vmin, vmax=vmax)
+    image[pixelStats.count == 0] = np.nan
+    image = np.ma.masked_invalid(image.reshape(numY, numX))
+    return axes.imshow(image, origin="lower", extent=(xMin, xMax, yMin, yMax), aspect="auto",
+                       interpolation="nearest", cmap=cmap, norm=norm, zorder=zorder)
+
+
 def buildTractImage(butler, dataId, tractInfo, patchList=None, coaddName="deep"):
     """Build up an image of an entire tract or list of patches
 
@@ -602,3 +1015,208 @@ def buildTractImage(butler, dataId, tractInfo, patchList=None, coaddName="deep")
     image = afwImage.ImageF(afwGeom.ExtentI(tractBbox.getMaxX() + 1, tractBbox.getMaxY() + 1))
     image.array[:] = tractArray
     return image
+
+
+def _blockSum(array, x0, y0, binning):
+    """Sum the finite pixels of an image into blocks of binning x binning pixels
+
+    Parameters
+    ----------
+    array : `numpy.ndarray`
+       Image array, whose pixel (0, 0) is at position (``x0``, ``y0``) of the binned grid's origin.
+    x0, y0 : `int`
+       Position of the image on the (unbinned) grid.
+    binning : `int`
+       Binning factor.
+
+    Returns
+    -------
+    sums : `numpy.ndarray`
+       Sum of the finite pixels in each block overlapping the image.
+    counts : `numpy.ndarray`
+       Number of finite pixels in each block overlapping the image.
+    xBin0, yBin0 : `int`
+       Block indices of ``sums[0, 0]`` on the binned grid.
+    """
+    finite = np.isfinite(array)
+    values = np.where(finite, array, 0.0).astype(np.float32)
+    ny, nx = array.shape
+    yBin = (y0 + np.arange(ny))//binning
+    xBin = (x0 + np.arange(nx))//binning
+    yStarts = np.concatenate(([0], np.flatnonzero(np.diff(yBin)) + 1))
+    xStarts = np.concatenate(([0], np.flatnonzero(np.diff(xBin)) + 1))
+    sums = np.add.reduceat(np.add.reduceat(values, yStarts, axis=0), xStarts, axis=1)
+    counts = np.add.reduceat(np.add.reduceat(finite.astype(np.int32), yStarts, axis=0), xStarts, axis=1)
+    return sums, counts, xBin[0], yBin[0]
+
+
+def _downsampleSums(sums, counts):
+    """Sum 2 x 2 blocks of the sums and counts of a level of a `TractImagePyramid`"""
+    ny, nx = sums.shape
+    padding = ((0, ny % 2), (0, nx % 2))
+    sums = np.pad(sums, padding, mode="constant")
+    counts = np.pad(counts, padding, mode="constant")
+    shape = (sums.shape[0]//2, 2, sums.shape[1]//2, 2)
+    return sums.reshape(shape).sum(axis=(1, 3)), counts.reshape(shape).sum(axis=(1, 3))
+
+
+class TractImagePyramid(object):
+    """Block-averaged images of a tract at a series of downsampling factors, cached on disk
+
+    Rather than assembling the full resolution image of a tract (~30k x 30k pixels) as in
+    `buildTractImage`, each patch is block-averaged into the finest level of the pyramid as it is read,
+    and the coarser levels are binned by factors of two from it.  The levels are persisted (as numpy
+    files, which are then memory mapped) per (tract, filter), keyed by the list of patches and the
+    modification times of the patch images, so subsequent plots need not read any patch images.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.persistence.Butler`
+    dataId : `lsst.daf.persistence.DataId`
+       Data id from which to extract the filter name.
+    tractInfo : `lsst.skymap.tractInfo.ExplicitTractInfo`
+       Tract information object.
+    patchList : `list` of `str`, optional
+       A list of the patches to include.  If `None`, the full list of patches
+       in ``tractInfo`` will be included.
+    coaddName : `str`, optional
+       The base name of the coadd (e.g. "deep" or "goodSeeing").
+    directory : `str`, optional
+       Directory in which to cache the levels.  If `None`, the levels are only held in memory.
+    minBinning : `int`, optional
+       Binning factor of the finest level.
+    minSize : `int`, optional
+       The coarsest level is the first with no more than this number of pixels along either side.
+    log : `lsst.log.Log`, optional
+       Logger for diagnostics.
+    """
+    def __init__(self, butler, dataId, tractInfo, patchList=None, coaddName="deep", directory=None,
+                 minBinning=4, minSize=256, log=None):
+        self.butler = butler
+        self.filterName = dataId["filter"]
+        self.tractInfo = tractInfo
+        self.coaddName = coaddName
+        self.directory = directory
+        self.log = log
+        if not patchList:
+            nPatchX, nPatchY = tractInfo.getNumPatches()
+            patchList = ["%d,%d" % (iPatchX, iPatchY) for iPatchX in range(nPatchX)
+                         for iPatchY in range(nPatchY)]
+        self.patchList = sorted(patchList)
+        tractBbox = tractInfo.getBBox()
+        self.x0, self.y0 = tractBbox.getMinX(), tractBbox.getMinY()
+        self.width, self.height = tractBbox.getWidth(), tractBbox.getHeight()
+        self.binnings = [minBinning]
+        while max(self.width, self.height) > minSize*self.binnings[-1]:
+            self.binnings.append(2*self.binnings[-1])
+        self._levels = {}
+        self._key = None
+
+    def _getExpDataId(self, patch):
+        return {"filter": self.filterName, "tract": self.tractInfo.getId(), "patch": patch}
+
+    @property
+    def key(self):
+        """Hash of the inputs (patch images and their modification times) and the levels"""
+        if self._key is None:
+            sha = hashlib.sha1(repr((self.coaddName, self.tractInfo.getId(), self.filterName,
+                                     self.binnings)).encode())
+            for patch in self.patchList:
+                try:
+                    filename = self.butler.get(self.coaddName + "Coadd_calexp_filename",
+                                               self._getExpDataId(patch))[0]
+                    mtime = os.path.getmtime(filename)
+                except Exception:
+                    mtime = None
+                sha.update(repr((patch, mtime)).encode())
+            self._key = sha.hexdigest()
+        return self._key
+
+    def getFilename(self, binning):
+        """Return the filename in which to cache the level binned by the given factor"""
+        return os.path.join(self.directory, "tractImage_{0:s}_{1:d}_{2:s}_{3:s}_bin{4:d}.npy".format(
+            self.coaddName, self.tractInfo.getId(), self.filterName.replace(" ", "_"), self.key[:16],
+            binning))
+
+    def selectBinning(self, numPixelsX, numPixelsY):
+        """Return the coarsest binning factor providing at least the given number of pixels on each side"""
+        for binning in reversed(self.binnings):
+            if -(-self.width//binning) >= numPixelsX and -(-self.height//binning) >= numPixelsY:
+                return binning
+        return self.binnings[0]
+
+    def getExtent(self, binning):
+        """Return the (xMin, xMax, yMin, yMax) tract pixel extent of the level for imshow"""
+        array = self.getArray(binning)
+        return (self.x0, self.x0 + array.shape[1]*binning, self.y0, self.y0 + array.shape[0]*binning)
+
+    def getArray(self, binning):
+        """Return the image of the level binned by the given factor
+
+        The array is indexed [y, x] with y increasing with row number (i.e. for display with
+        ``origin="lower"``), and pixels with no data are NaN.
+
+        Raises
+        ------
+        `RuntimeError`
+           If no data was found for any of the patches.
+        """
+        if binning not in self.binnings:
+            raise RuntimeError("Binning {0:d} not in the pyramid levels: {1:}".format(binning, self.binnings))
+        if binning in self._levels:
+            return self._levels[binning]
+        if self.directory is not None:
+            filename = self.getFilename(binning)
+            if os.path.exists(filename):
+                self._levels[binning] = np.load(filename, mmap_mode="r")
+                return self._levels[binning]
+        self._build()
+        return self._levels[binning]
+
+    def _build(self):
+        """Read the patch images, block-averaging them into all the levels (and caching these)"""
+        minBinning = self.binnings[0]
+        sums = np.zeros((-(-self.height//minBinning), -(-self.width//minBinning)), dtype=np.float32)
+        counts = np.zeros(sums.shape, dtype=np.int32)
+        nPatches = 0
+        for patch in self.patchList:
+            expDataId = self._getExpDataId(patch)
+            try:
+                exp = self.butler.get(self.coaddName + "Coadd_calexp", expDataId, immediate=True)
+                bbox = self.butler.get(self.coaddName + "Coadd_calexp_bbox", expDataId, immediate=True)
+            except Exception:
+                continue
+            # Only use the inner region of each patch, so the pixels of the overlaps are not counted twice
+            innerBbox = self.tractInfo.getPatchInfo(tuple(int(index) for index in
+                                                          patch.split(","))).getInnerBBox()
+            xMin, xMax = max(bbox.getMinX(), innerBbox.getMinX()), min(bbox.getMaxX(), innerBbox.getMaxX())
+            yMin, yMax = max(bbox.getMinY(), innerBbox.getMinY()), min(bbox.getMaxY(), innerBbox.getMaxY())
+            if xMin > xMax or yMin > yMax:
+                continue
+            array = exp.maskedImage.image.array[yMin - bbox.getMinY():yMax - bbox.getMinY() + 1,
+                                                xMin - bbox.getMinX():xMax - bbox.getMinX() + 1]
+            patchSums, patchCounts, xBin0, yBin0 = _blockSum(array, xMin - self.x0, yMin - self.y0,
+                                                             minBinning)
+            del exp, array
+            ny, nx = patchSums.shape
+            sums[yBin0:yBin0 + ny, xBin0:xBin0 + nx] += patchSums
+            counts[yBin0:yBin0 + ny, xBin0:xBin0 + nx] += patchCounts
+            nPatches += 1
+        if nPatches == 0:
+            raise RuntimeError("No data found for tract {:}".format(self.tractInfo.getId()))
+        if self.log is not None:
+            self.log.info("Built tract image pyramid (binnings {0:}) from {1:d} patches".format(
+                self.binnings, nPatches))
+        if self.directory is not None:
+            safeMakeDir(self.directory)
+        for binning in self.binnings:
+            if binning != minBinning:
+                sums, counts = _downsampleSums(sums, counts)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                level = (sums/counts).astype(np.float32)
+            self._levels[binning] = level
+            if self.directory is not None:
+                filename = self.getFilename(binning)
+                tempFilename = filename + ".tmp.npy"
+                np.save(tempFilename, level)
+                os.rename(tempFilename, filename)
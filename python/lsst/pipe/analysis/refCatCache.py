@@ -0,0 +1,146 @@
+import os
+from collections import OrderedDict
+
+from lsst.pex.config import Field
+from lsst.meas.algorithms import LoadIndexedReferenceObjectsTask, LoadIndexedReferenceObjectsConfig
+
+from .utils import getRepositoryId
+
+__all__ = ["RefCatShardCache", "getRefCatShardCache", "CachedLoadIndexedReferenceObjectsConfig",
+           "CachedLoadIndexedReferenceObjectsTask"]
+
+
+class RefCatShardCache(object):
+    """Least-recently-used cache of reference catalog shards with a memory cap
+
+    Parameters
+    ----------
+    maxSize : `float`
+       Maximum total size (in MB) of the shards held in the cache.  The least recently used shards are
+       evicted to keep the total below this.  A single shard larger than this is never cached.
+    """
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self._shards = OrderedDict()
+        self._sizes = {}
+        self.size = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def shardSize(shardList):
+        """Return the approximate size (in MB) of a list of shard catalogs"""
+        return sum(len(shard)*shard.schema.getRecordSize() for shard in shardList
+                   if shard is not None)/2.0**20
+
+    def __contains__(self, key):
+        return key in self._shards
+
+    def __len__(self):
+        return len(self._shards)
+
+    def get(self, key):
+        """Return the cached shards for key (marking them as most recently used), or None"""
+        if key not in self._shards:
+            self.misses += 1
+            return None
+        self.hits += 1
+        shardList = self._shards.pop(key)
+        self._shards[key] = shardList
+        return shardList
+
+    def put(self, key, shardList):
+        """Add the shards for key to the cache, evicting the least recently used as required"""
+        size = self.shardSize(shardList)
+        if size > self.maxSize:
+            return
+        if key in self._shards:
+            self._shards.pop(key)
+            self.size -= self._sizes.pop(key)
+        while self._shards and self.size + size > self.maxSize:
+            oldKey, _ = self._shards.popitem(last=False)
+            self.size -= self._sizes.pop(oldKey)
+        self._shards[key] = shardList
+        self._sizes[key] = size
+        self.size += size
+
+    def clear(self):
+        self._shards.clear()
+        self._sizes.clear()
+        self.size = 0.0
+
+
+_refCatShardCache = None
+
+
+def getRefCatShardCache(maxSize):
+    """Return the process-wide reference catalog shard cache
+
+    The cache is shared by all loaders in the process (i.e. across patches, visits and tasks), so
+    each shard is read only once while it remains in the cache.
+
+    Parameters
+    ----------
+    maxSize : `float`
+       Maximum total size (in MB) of the cache.  If the cache already exists, its cap is updated.
+    """
+    global _refCatShardCache
+    if _refCatShardCache is None:
+        _refCatShardCache = RefCatShardCache(maxSize)
+    _refCatShardCache.maxSize = maxSize
+    return _refCatShardCache
+
+
+class CachedLoadIndexedReferenceObjectsConfig(LoadIndexedReferenceObjectsConfig):
+    shardCacheSize = Field(dtype=float, default=2048.0,
+                           doc="Maximum memory (MB) of the process-wide reference catalog shard cache.  "
+                           "Set to 0 to disable caching.")
+
+
+class CachedLoadIndexedReferenceObjectsTask(LoadIndexedReferenceObjectsTask):
+    """Load indexed reference objects, caching the shards read across calls
+
+    Neighbouring patches and CCDs cover mostly the same reference catalog shards, so each shard (keyed
+    by the repository of the butler it is read from, reference dataset name and index pixel id) is kept
+    in a process-wide LRU cache and only read through the butler the first time it is needed.  Copies of
+    the cached shards are returned, so downstream in-place modifications (e.g. flux unit conversions)
+    never alter the cache.
+    """
+    ConfigClass = CachedLoadIndexedReferenceObjectsConfig
+    _DefaultName = "cachedLoadIndexedReferenceObjects"
+
+    def getShardFilenames(self, ctrCoord, radius):
+        """Return the filenames of the reference catalog shards covering a sky circle
+
+        Used to identify the reference catalog inputs of a task stage (see
+        `lsst.pipe.analysis.utils.computeInputKey`); the catalog's config file is included.
+
+        Parameters
+        ----------
+        ctrCoord : `lsst.afw.geom.SpherePoint`
+           Center of the circle.
+        radius : `lsst.afw.geom.Angle`
+           Radius of the circle.
+        """
+        shardIds, _ = self.indexer.getShardIds(ctrCoord, radius)
+        filenames = [self.butler.get("ref_cat_filename",
+                                     dataId=self.indexer.makeDataId(pixelId, self.config.ref_dataset_name))[0]
+                     for pixelId in shardIds]
+        if filenames:
+            filenames.append(os.path.join(os.path.dirname(filenames[0]), "config.py"))
+        return filenames
+
+    def get_shards(self, id_list):
+        if self.config.shardCacheSize <= 0:
+            return LoadIndexedReferenceObjectsTask.get_shards(self, id_list)
+        cache = getRefCatShardCache(self.config.shardCacheSize)
+        repoId = getRepositoryId(self.butler)
+        shards = []
+        for pixelId in id_list:
+            key = (repoId, self.config.ref_dataset_name, pixelId)
+            shardList = cache.get(key)
+            if shardList is None:
+                shardList = LoadIndexedReferenceObjectsTask.get_shards(self, [pixelId])
+                cache.put(key, shardList)
+            shards.extend(shard.copy(deep=True) if shard is not None else None for shard in shardList)
+        return shards
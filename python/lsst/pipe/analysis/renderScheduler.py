@@ -0,0 +1,143 @@
+import multiprocessing
+import multiprocessing.connection
+import traceback
+
+__all__ = ["RenderScheduler", "startRenderScheduler", "getRenderScheduler", "finishRenderScheduler"]
+
+
+def _renderJob(sender, func, args, kwargs):
+    """Run a rendering job in a worker process, reporting any failure back through sender"""
+    error = None
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        error = traceback.format_exc()
+    sender.send(error)
+    sender.close()
+
+
+class RenderScheduler(object):
+    """Render figures in a bounded pool of worker processes
+
+    Each job is run in a forked worker process, so the (large, and generally unpicklable) catalogs,
+    cameras and Analysis objects a job refers to are inherited from the main process rather than
+    serialized.  All filenames and any butler reads must be resolved in the main process before a job
+    is submitted.  Failures in the workers are collected and raised by `finish`.
+
+    Parameters
+    ----------
+    numWorkers : `int`
+       Maximum number of concurrent worker processes.  Jobs are run serially in the main process if
+       this is 1 or less, or if the platform does not support forking.
+    log : `lsst.log.Log`, optional
+       Logger for diagnostics.
+    """
+    def __init__(self, numWorkers=1, log=None):
+        self.numWorkers = numWorkers
+        self.log = log
+        self._context = None
+        if numWorkers > 1:
+            try:
+                self._context = multiprocessing.get_context("fork")
+            except ValueError:
+                if log is not None:
+                    log.warn("Forked processes are not available: rendering serially")
+        self._running = []
+        self.errors = []
+        self.numSubmitted = 0
+
+    @property
+    def isParallel(self):
+        return self._context is not None
+
+    def submit(self, name, func, *args, **kwargs):
+        """Submit a rendering job
+
+        Parameters
+        ----------
+        name : `str`
+           Name of the job (e.g. the figure filename), used in error reports.
+        func : callable
+           Function rendering and writing the figure(s); called as ``func(*args, **kwargs)``.
+        """
+        self.numSubmitted += 1
+        if not self.isParallel:
+            func(*args, **kwargs)
+            return
+        while len(self._running) >= self.numWorkers:
+            self._collect()
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=_renderJob, args=(sender, func, args, kwargs))
+        process.start()
+        sender.close()
+        self._running.append((name, process, receiver))
+
+    def _collect(self):
+        """Wait for at least one running job to complete, recording any failure"""
+        ready = multiprocessing.connection.wait([receiver for _, _, receiver in self._running])
+        stillRunning = []
+        for name, process, receiver in self._running:
+            if receiver not in ready:
+                stillRunning.append((name, process, receiver))
+                continue
+            try:
+                error = receiver.recv()
+            except EOFError:
+                error = "Worker exited without reporting a result"
+            receiver.close()
+            process.join()
+            if error is None and process.exitcode != 0:
+                error = "Worker exited with code {}".format(process.exitcode)
+            if error is not None:
+                self.errors.append((name, error))
+        self._running = stillRunning
+
+    def finish(self):
+        """Wait for all submitted jobs to complete
+
+        Raises
+        ------
+        RuntimeError
+           If any of the jobs failed.
+        """
+        while self._running:
+            self._collect()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise RuntimeError("Rendering failed for {0:d} of {1:d} job(s):\n{2:s}".format(
+                len(errors), self.numSubmitted,
+                "\n".join("{0:s}:\n{1:s}".format(name, error) for name, error in errors)))
+
+
+_renderScheduler = None
+
+
+def startRenderScheduler(numWorkers=1, log=None):
+    """Start the process-wide render scheduler used by `Analysis.plotAll`
+
+    Any jobs left running by a previous scheduler are waited for first.
+    """
+    global _renderScheduler
+    if _renderScheduler is not None:
+        try:
+            _renderScheduler.finish()
+        except RuntimeError as error:
+            if log is not None:
+                log.warn("Ignoring failures of a previous render scheduler: {}".format(error))
+    _renderScheduler = RenderScheduler(numWorkers=numWorkers, log=log)
+    return _renderScheduler
+
+
+def getRenderScheduler():
+    """Return the current render scheduler (`None` if not started)"""
+    return _renderScheduler
+
+
+def finishRenderScheduler():
+    """Wait for all rendering jobs of the current scheduler, raising if any failed"""
+    global _renderScheduler
+    scheduler = _renderScheduler
+    _renderScheduler = None
+    if scheduler is not None:
+        scheduler.finish()
+    return scheduler
@@ -1,11 +1,19 @@
 from __future__ import print_function
 
+import glob
+import hashlib
+import json
 import os
 import re
+import time
+import weakref
+
+from collections import OrderedDict
 
 import numpy as np
 import scipy.odr as scipyOdr
 import scipy.optimize as scipyOptimize
+import scipy.spatial as scipySpatial
 import scipy.stats as scipyStats
 try:
     import fastparquet
@@ -30,16 +38,29 @@ try:
 except ImportError:
     applyMosaicResultsCatalog = None
 
-__all__ = ["Filenamer", "Data", "Stats", "Enforcer", "MagDiff", "MagDiffMatches", "MagDiffCompare",
+__all__ = ["getRepositoryId", "Filenamer", "getInputFilenames", "computeInputKey", "OutputKeys",
+           "startOutputKeys", "getOutputKeys", "finishOutputKeys", "isStageUpToDate",
+           "Data", "Stats", "calculateClippedStats", "solveSysErrors", "Enforcer",
+           "histogramBinIndices", "binnedStatistics",
+           "DerivedQuantityCache", "getDerivedQuantity", "invalidateDerivedQuantities", "magnitude",
+           "traceSize", "ellipticityE1", "ellipticityE2", "ellipseAxes",
+           "MagDiff", "MagDiffMatches", "MagDiffCompare",
            "AstrometryDiff", "TraceSize", "PsfTraceSizeDiff", "TraceSizeCompare", "PercentDiff",
            "E1Resids", "E2Resids", "E1ResidsHsmRegauss", "E2ResidsHsmRegauss", "FootNpixDiffCompare",
            "MagDiffErr", "ApCorrDiffErr", "CentroidDiff", "CentroidDiffErr", "deconvMom",
-           "deconvMomStarGal", "concatenateCatalogs", "joinMatches", "checkIdLists", "checkPatchOverlap",
+           "deconvMomStarGal", "concatenateCatalogs", "joinMatches", "SkyMatcher", "joinMatchIndices",
+           "getSkyCircle", "getBBoxSkyCircle", "matchIds", "MatchStore", "idsInList", "purgeMatchesById",
+           "checkIdLists",
+           "getAdjacentPatchPairs", "checkPatchOverlap", "getInnerPatchIndices", "getPatchOverlapCandidates",
            "joinCatalogs", "getFluxKeys", "addColumnsToSchema", "addApertureFluxesHSC", "addFpPoint",
            "addFootprintNPix", "addRotPoint", "makeBadArray", "addFlag", "addIntFloatOrStrColumn",
            "calibrateSourceCatalogMosaic", "calibrateSourceCatalog", "calibrateCoaddSourceCatalog",
-           "backoutApCorr", "matchJanskyToDn", "checkHscStack", "fluxToPlotString", "andCatalog",
-           "writeParquet", "getRepoInfo", "findCcdKey", "getCcdNameRefList", "getDataExistsRefList",
+           "backoutApCorr", "catalogJanskyToDn", "matchJanskyToDn", "checkHscStack", "fluxToPlotString",
+           "andCatalog",
+           "getAndCatalogFilenames",
+           "writeParquet", "equatorialToGalactic", "SfdDustMap", "findSfdDustMapDir",
+           "getSfdDustMapFilenames", "getSfdDustMap", "getRepoInfo",
+           "findCcdKey", "getCcdNameRefList", "getDataExistsRefList",
            "orthogonalRegression", "distanceSquaredToPoly", "p1CoeffsFromP2x0y0", "p2p1CoeffsFromLinearFit",
            "lineFromP2Coeffs", "linesFromP2P1Coeffs", "makeEqnStr", "catColors", "setAliasMaps"]
 
@@ -83,14 +104,108 @@ def writeParquet(table, path, badArray=None):
     fastparquet.write(path, df)
 
 
+# Repository identities, by butler
+_repositoryIds = weakref.WeakKeyDictionary()
+
+
+def getRepositoryId(butler):
+    """Return a string identifying the repositories of a butler
+
+    The identity (the roots of the butler's output and input repositories) is resolved once per butler
+    from its repository configurations, without any dataset lookups, so it may be used in cache keys
+    in the main process and in forked rendering workers alike.
+    """
+    try:
+        return _repositoryIds[butler]
+    except (KeyError, TypeError):
+        pass
+    try:
+        roots = [str(repoData.cfg.root if repoData.cfg.root is not None else repoData.cfgRoot) for
+                 repoData in butler._repos.all()]
+    except Exception:
+        roots = []
+    repoId = "|".join(roots) if roots else "butler-{:d}".format(id(butler))
+    try:
+        _repositoryIds[butler] = repoId
+    except TypeError:
+        pass  # butler cannot be weakly referenced
+    return repoId
+
+
+# Output directories already created by a Filenamer
+_madeDirs = set()
+
+
 class Filenamer(object):
-    """Callable that provides a filename given a style"""
+    """Callable that provides a filename given a style
+
+    The filename template of the dataset and dataId is resolved by the butler once for each set of
+    keyword arguments (e.g. description and style), with placeholder values that are then substituted
+    for each call; the template is only used once it has been checked against a filename resolved by
+    the butler.  The filenames are also cached by keyword arguments, and each output directory is
+    created once.
+    """
     def __init__(self, butler, dataset, dataId={}):
         self.butler = butler
         self.dataset = dataset
         self.dataId = dataId
+        self._templates = {}  # Filename template (None if unusable) by keyword argument names
+        self._filenames = {}
 
     def __call__(self, dataId, **kwargs):
+        key = tuple(sorted(kwargs.items()))
+        filename = self._filenames.get(key)
+        if filename is None:
+            filename = self._fromTemplate(kwargs)
+            if filename is None:
+                filename = self._resolve(**kwargs)
+            self._filenames[key] = filename
+        directory = os.path.dirname(filename)
+        if directory not in _madeDirs:
+            safeMakeDir(directory)
+            _madeDirs.add(directory)
+        outputKeys = getOutputKeys()
+        if outputKeys is not None:
+            outputKeys.record(filename)
+        return filename
+
+    @staticmethod
+    def _placeholder(name):
+        return "@{:s}@".format(name)
+
+    def _fromTemplate(self, kwargs):
+        """Return the filename rendered from the template for the keyword arguments
+
+        Returns `None` if there is no usable template (in which case the filename is to be resolved by
+        the butler).
+        """
+        names = tuple(sorted(kwargs))
+        if not all(isinstance(value, str) for value in kwargs.values()):
+            return None
+        if names not in self._templates:
+            try:
+                template = self._resolve(**{name: self._placeholder(name) for name in names})
+            except Exception:
+                template = None
+            if template is not None and any(template.count(self._placeholder(name)) != 1 for name in names):
+                template = None
+            self._templates[names] = template
+            if template is not None:
+                # Check the template against the butler before relying on it
+                filename = self._resolve(**kwargs)
+                if self._render(template, kwargs) != filename:
+                    self._templates[names] = None
+                return filename
+        template = self._templates[names]
+        return self._render(template, kwargs) if template is not None else None
+
+    def _render(self, template, kwargs):
+        for name, value in kwargs.items():
+            template = template.replace(self._placeholder(name), value)
+        return template
+
+    def _resolve(self, **kwargs):
+        """Resolve the filename for the keyword arguments with the butler"""
         filename = self.butler.get(self.dataset + "_filename", self.dataId, **kwargs)[0]
         # When trying to write to a different rerun (or output), if the given dataset exists in the _parent
         # rerun (or input) directory, _parent is added to the filename, and thus the output files
@@ -100,15 +215,249 @@ class Filenamer(object):
         if "_parent/" in filename:
             print("Note: stripping _parent from filename: ", filename)
             filename = filename.replace("_parent/", "")
-        safeMakeDir(os.path.dirname(filename))
         return filename
 
 
+def getInputFilenames(dataRefList, datasets):
+    """Return the filenames of the given datasets of each of the data references
+
+    Datasets whose filename cannot be determined (e.g. not defined for the mapper) are ignored;
+    the filenames of datasets that do not exist are included (they are then recorded as missing).
+    """
+    filenames = []
+    for dataRef in dataRefList:
+        for dataset in datasets:
+            try:
+                filenames.append(dataRef.get(dataset + "_filename")[0])
+            except Exception:
+                continue
+    return filenames
+
+
+def computeInputKey(inputFilenames, config=None, name="", ignoreConfig=()):
+    """Compute a key identifying the inputs of a task stage
+
+    The key is a hash of the identities (filenames, modification times and sizes) of the input files,
+    the config (less any fields not affecting the outputs) and the version of this package (for which
+    the modification times of its modules are also included).
+
+    Parameters
+    ----------
+    inputFilenames : `list` of `str`
+       Filenames of the inputs.
+    config : `lsst.pex.config.Config`, optional
+       Task config.
+    name : `str`, optional
+       Name of the stage.
+    ignoreConfig : iterable of `str`, optional
+       Names of the config fields not affecting the outputs.
+
+    Returns
+    -------
+    key : `str`
+       Hex digest of the key.
+    """
+    sha = hashlib.sha1(name.encode())
+    sha.update(getPackageVersion().encode())
+    if config is not None:
+        configDict = config.toDict()
+        for field in ignoreConfig:
+            configDict.pop(field, None)
+        sha.update(json.dumps(configDict, sort_keys=True, default=repr).encode())
+    moduleFilenames = glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py"))
+    for filename in sorted(set(inputFilenames)) + sorted(moduleFilenames):
+        try:
+            stat = os.stat(filename)
+            identity = (filename, stat.st_mtime, stat.st_size)
+        except OSError:
+            identity = (filename, None, None)
+        sha.update(repr(identity).encode())
+    return sha.hexdigest()
+
+
+class OutputKeys(object):
+    """Record of the input key with which each output of a task stage was written
+
+    Each output (as named by a `Filenamer` while this is the current record; see `startOutputKeys`)
+    is given a sidecar file (``<output>.inputKey``) holding the key of the inputs (see
+    `computeInputKey`) it was written with, and the list of outputs of the stage is written to a
+    manifest.  A rerun of the stage with the same input key can then be skipped if all the outputs
+    listed in the manifest exist with that key.
+
+    Parameters
+    ----------
+    manifestFilename : `str`
+       Filename of the manifest of the stage's outputs.
+    inputKey : `str`
+       Key of the stage's inputs.
+    """
+    sidecarSuffix = ".inputKey"
+
+    def __init__(self, manifestFilename, inputKey):
+        self.manifestFilename = manifestFilename
+        self.inputKey = inputKey
+        self.startTime = time.time()
+        self.filenames = []
+
+    @classmethod
+    def fromFilenamer(cls, filenamer, dataId, name, inputKey):
+        """Construct for a stage writing its manifest alongside the outputs of filenamer"""
+        outputDir = os.path.dirname(filenamer(dataId, description="inputKeys", style="manifest"))
+        dataIdStr = "-".join("{0:s}{1:s}".format(str(key), str(dataId[key]).replace(",", "x"))
+                             for key in sorted(dataId))
+        return cls(os.path.join(outputDir, "inputKeys-{0:s}-{1:s}.txt".format(name, dataIdStr)), inputKey)
+
+    def record(self, filename):
+        """Record a filename the stage may write to"""
+        if filename not in self.filenames:
+            self.filenames.append(filename)
+
+    def _readKey(self, filename):
+        try:
+            with open(filename) as keyFile:
+                return keyFile.readline().strip()
+        except (IOError, OSError):
+            return None
+
+    def isCurrent(self):
+        """Were all the outputs of the stage written with the current input key?"""
+        try:
+            with open(self.manifestFilename) as manifest:
+                lines = manifest.read().splitlines()
+        except (IOError, OSError):
+            return False
+        if not lines or lines[0] != self.inputKey or len(lines) < 2:
+            return False
+        return all(os.path.exists(filename) and
+                   self._readKey(filename + self.sidecarSuffix) == self.inputKey for filename in lines[1:])
+
+    def write(self):
+        """Write the sidecar key of each output written by the stage, and the manifest"""
+        written = [filename for filename in self.filenames if
+                   os.path.isfile(filename) and os.path.getmtime(filename) >= self.startTime - 1.0]
+        for filename in written:
+            with open(filename + self.sidecarSuffix, "w") as sidecar:
+                sidecar.write(self.inputKey + "\n")
+        tempFilename = self.manifestFilename + ".tmp"
+        with open(tempFilename, "w") as manifest:
+            manifest.write("\n".join([self.inputKey] + written) + "\n")
+        os.rename(tempFilename, self.manifestFilename)
+        return written
+
+
+_outputKeys = None
+
+
+def startOutputKeys(filenamer, dataId, name, inputKey):
+    """Start recording the outputs of a task stage (see `OutputKeys`), returning the record"""
+    global _outputKeys
+    _outputKeys = None  # So the manifest filename itself is not recorded
+    _outputKeys = OutputKeys.fromFilenamer(filenamer, dataId, name, inputKey)
+    return _outputKeys
+
+
+def getOutputKeys():
+    """Return the current record of the outputs of a task stage (`None` if not started)"""
+    return _outputKeys
+
+
+# Config fields affecting only how (not which) outputs are produced
+_outputIndependentConfig = ("doSkipUpToDate", "numRenderWorkers", "doPersistMatches", "matchStoreDir",
+                            "doCacheTractImages", "tractImageCacheDir")
+
+
+def isStageUpToDate(filenamer, dataId, name, inputFilenames, config, doSkip=True, log=None):
+    """Start recording the outputs of a task stage, returning whether they are all up to date
+
+    To be called before any catalogs are read.  If the stage is up to date (and ``doSkip``), the
+    recording is finished (without rewriting any keys) and the stage may be skipped entirely;
+    otherwise `finishOutputKeys` is to be called once all the outputs of the stage have been written.
+
+    Parameters
+    ----------
+    filenamer : `lsst.pipe.analysis.utils.Filenamer`
+       Filenamer for the outputs of the stage.
+    dataId : `dict`
+       Data id of the stage.
+    name : `str`
+       Name of the stage (e.g. the task name).
+    inputFilenames : `list` of `str`
+       Filenames of the inputs of the stage (see `getInputFilenames`).
+    config : `lsst.pex.config.Config`
+       Task config.
+    doSkip : `bool`, optional
+       Allow the stage to be skipped?  If `False`, the outputs are only recorded.
+    log : `lsst.log.Log`, optional
+       Logger for diagnostics.
+
+    Returns
+    -------
+    upToDate : `bool`
+       Can the stage be skipped?
+    """
+    inputKey = computeInputKey(inputFilenames, config, name=name, ignoreConfig=_outputIndependentConfig)
+    outputKeys = startOutputKeys(filenamer, dataId, name, inputKey)
+    if doSkip and outputKeys.isCurrent():
+        finishOutputKeys(doWrite=False)
+        if log is not None:
+            log.info("All outputs of {0:s} for {1:} are up to date: skipping".format(name, dataId))
+        return True
+    return False
+
+
+def finishOutputKeys(doWrite=True, log=None):
+    """Finish recording the outputs of a task stage, writing their keys and manifest if doWrite"""
+    global _outputKeys
+    outputKeys = _outputKeys
+    _outputKeys = None
+    if outputKeys is not None and doWrite:
+        written = outputKeys.write()
+        if log is not None:
+            log.info("Wrote input keys of {0:d} outputs to {1:s}".format(len(written),
+                                                                         outputKeys.manifestFilename))
+    return outputKeys
+
+
 class Data(Struct):
+    """Selected subset of the quantities of an analysis catalog
+
+    Only the selection mask and a reference to the parent catalog are held; columns of the selected
+    records are available as views through ``column``, and a record copy is only made if the
+    ``catalog`` attribute is explicitly accessed.
+    """
     def __init__(self, catalog, quantity, mag, selection, color, error=None, plot=True):
-        Struct.__init__(self, catalog=catalog[selection].copy(deep=True), quantity=quantity[selection],
-                        mag=mag[selection], selection=selection, color=color, plot=plot,
-                        error=error[selection] if error is not None else None)
+        Struct.__init__(self, quantity=quantity[selection], mag=mag[selection], selection=selection,
+                        color=color, plot=plot, error=error[selection] if error is not None else None)
+        self._parent = catalog
+        self._catalog = None
+        self._columns = {}
+
+    @property
+    def catalog(self):
+        """Deep copy of the selected records (materialized on first access)"""
+        if self._catalog is None:
+            self._catalog = self._parent[self.selection].copy(deep=True)
+        return self._catalog
+
+    def column(self, name):
+        """Return the values of column ``name`` for the selected records
+
+        Parameters
+        ----------
+        name : `str`
+           Name of the column in the parent catalog schema.
+
+        Returns
+        -------
+        values : `numpy.ndarray`
+           Column values for the selected records.
+        """
+        if name not in self._columns:
+            if self._catalog is None and self._parent.isContiguous():
+                self._columns[name] = self._parent[name][self.selection]
+            else:
+                self._columns[name] = self.catalog[name]
+        return self._columns[name]
 
 
 class Stats(Struct):
@@ -121,6 +470,274 @@ class Stats(Struct):
             "median={0.median:.4f}; clip={0.clip:.4f}; forcedMean={0.forcedMean:})".format(self)
 
 
+def _quartilesFromSorted(values):
+    """Return the 25th, 50th and 75th percentiles (linear interpolation) of sorted values"""
+    num = len(values)
+    if np.isnan(values[-1]):  # NaNs sort to the end; np.percentile returns NaN in this case
+        return np.full(3, np.nan)
+    rank = np.array([0.25, 0.5, 0.75])*(num - 1)
+    lower = np.floor(rank).astype(int)
+    upper = np.minimum(lower + 1, num - 1)
+    frac = rank - lower
+    return values[lower] + (values[upper] - values[lower])*frac
+
+
+def _quartiles(values):
+    """Return the 25th, 50th and 75th percentiles of unsorted values using a partial sort"""
+    num = len(values)
+    rank = np.array([0.25, 0.5, 0.75])*(num - 1)
+    kth = np.unique(np.concatenate((np.floor(rank), np.minimum(np.floor(rank) + 1, num - 1))).astype(int))
+    partitioned = np.partition(values, kth)
+    if np.isnan(partitioned[kth[-1]:]).any():
+        return np.full(3, np.nan)
+    lower = np.floor(rank).astype(int)
+    upper = np.minimum(lower + 1, num - 1)
+    frac = rank - lower
+    return partitioned[lower] + (partitioned[upper] - partitioned[lower])*frac
+
+
+def _clippedStats(quantity, selection, clipFactor, forcedMean=None, order=None):
+    total = selection.sum()  # Total number we're considering
+    if total == 0:
+        return Stats(dataUsed=0, num=0, total=0, mean=np.nan, stdev=np.nan, forcedMean=np.nan,
+                     median=np.nan, clip=np.nan)
+    if order is None:
+        quartiles = _quartiles(quantity[selection])
+    else:
+        quartiles = _quartilesFromSorted(quantity[order][selection[order]])
+    median = quartiles[1]
+    clip = clipFactor*0.74*(quartiles[2] - quartiles[0])
+    good = selection & np.logical_not(np.abs(quantity - median) > clip)
+    actualMean = quantity[good].mean()
+    mean = actualMean if forcedMean is None else forcedMean
+    stdev = np.sqrt(((quantity[good].astype(np.float64) - mean)**2).mean())
+    return Stats(dataUsed=good, num=good.sum(), total=total, mean=actualMean, stdev=stdev,
+                 forcedMean=forcedMean, median=median, clip=clip)
+
+
+def calculateClippedStats(quantities, selections, clipFactor, forcedMean=None):
+    """Calculate clipped statistics for several quantities and selections in one pass
+
+    The median and clipping range are derived from the quartiles of each selection, and the mean and
+    rms from the points within ``clipFactor*0.74*IQR`` of the median.  When several selections are
+    requested, each quantity is sorted once and the sorted order shared between all selections, so
+    the quartiles of each selection are read off its (already sorted) subset; a single selection
+    uses a partial sort instead.
+
+    Parameters
+    ----------
+    quantities : `numpy.ndarray`
+       Quantity array of shape ``(N,)``, or a matrix of shape ``(M, N)`` of quantities sharing the
+       same rows.
+    selections : `numpy.ndarray`
+       Boolean selection array of shape ``(N,)`` or matrix of shape ``(K, N)``.
+    clipFactor : `float`
+       Rejection threshold (in units of the IQR-derived standard deviation).
+    forcedMean : `float`, optional
+       Mean about which to compute the rms, instead of the actual mean.
+
+    Returns
+    -------
+    stats : `Stats`, `list` of `Stats` or `list` of `list` of `Stats`
+       Stats for each quantity (outer list, if ``quantities`` is a matrix) and selection (inner list,
+       if ``selections`` is a matrix).
+    """
+    quantities = np.asarray(quantities)
+    selections = np.asarray(selections, dtype=bool)
+    quantityList = quantities[np.newaxis, :] if quantities.ndim == 1 else quantities
+    selectionList = selections[np.newaxis, :] if selections.ndim == 1 else selections
+    results = []
+    for quantity in quantityList:
+        order = np.argsort(quantity, kind="mergesort") if len(selectionList) > 1 else None
+        results.append([_clippedStats(quantity, selection, clipFactor, forcedMean=forcedMean, order=order)
+                        for selection in selectionList])
+    if quantities.ndim == 1:
+        return results[0] if selections.ndim > 1 else results[0][0]
+    return results if selections.ndim > 1 else [row[0] for row in results]
+
+
+def histogramBinIndices(values, bins, range=None):
+    """Return the histogram bin index of each value, following the `numpy.histogram` conventions
+
+    Parameters
+    ----------
+    values : `numpy.ndarray`
+       Values to bin.
+    bins : `int` or `numpy.ndarray`
+       Number of equal-width bins spanning ``range`` (or the range of the values), or the bin edges.
+    range : `tuple` of `float`, optional
+       Lower and upper range of the bins, if ``bins`` is a number.
+
+    Returns
+    -------
+    binIndex : `numpy.ndarray` of `int`
+       Bin index of each value; -1 for values outside the bins (the last bin includes its upper edge).
+    edges : `numpy.ndarray`
+       Bin edges.
+    """
+    values = np.asarray(values)
+    if np.ndim(bins) == 0:
+        if range is None:
+            range = (values.min(), values.max()) if len(values) > 0 else (0.0, 1.0)
+        first, last = float(range[0]), float(range[1])
+        if first == last:
+            first, last = first - 0.5, last + 0.5
+        edges = np.linspace(first, last, int(bins) + 1)
+    else:
+        edges = np.asarray(bins)
+    numBins = len(edges) - 1
+    binIndex = np.searchsorted(edges, values, side="right") - 1
+    binIndex[values == edges[-1]] = numBins - 1
+    binIndex[(binIndex < 0) | (binIndex >= numBins) | ~np.isfinite(values)] = -1
+    return binIndex, edges
+
+
+def binnedStatistics(binIndex, numBins, values=None, doMedian=False):
+    """Calculate the count, mean, rms and (optionally) median of values in each bin in a single pass
+
+    Parameters
+    ----------
+    binIndex : `numpy.ndarray` of `int`
+       Bin index of each value (e.g. from `histogramBinIndices`); negative indices are ignored.
+    numBins : `int`
+       Number of bins.
+    values : `numpy.ndarray`, optional
+       Values of which to calculate the statistics; only the counts are calculated if `None`.
+    doMedian : `bool`
+       Calculate the median in each bin?
+
+    Returns
+    -------
+    result : `lsst.pipe.base.Struct`
+       Result struct with components:
+
+       - ``count`` : number of values in each bin (`numpy.ndarray`).
+       - ``mean`` : mean of the values in each bin (`numpy.ndarray`, or `None`).
+       - ``stdev`` : rms about the mean in each bin (`numpy.ndarray`, or `None`).
+       - ``median`` : median in each bin (`numpy.ndarray`, or `None`).
+    """
+    inBins = binIndex >= 0
+    binIndex = binIndex[inBins]
+    count = np.bincount(binIndex, minlength=numBins)
+    mean = stdev = median = None
+    if values is not None:
+        values = np.asarray(values, dtype=np.float64)[inBins]
+        mean = np.bincount(binIndex, weights=values, minlength=numBins)/count
+        meanSq = np.bincount(binIndex, weights=values**2, minlength=numBins)/count
+        stdev = np.sqrt(meanSq - mean*mean)
+        if doMedian:
+            median = np.full(numBins, np.nan)
+            if len(values) > 0:
+                # Sort by bin, then value: each bin is then a contiguous sorted run
+                sortedValues = values[np.lexsort((values, binIndex))]
+                start = np.concatenate(([0], np.cumsum(count)[:-1]))
+                filled = count > 0
+                lower = start[filled] + (count[filled] - 1)//2
+                upper = start[filled] + count[filled]//2
+                median[filled] = 0.5*(sortedValues[lower] + sortedValues[upper])
+    return Struct(count=count, mean=mean, stdev=stdev, median=median)
+
+
+def solveSysErrors(quantities, errors, clipFactor, forcedMean=None, tol=1.0e-3, maxIter=50, log=None):
+    """Solve for the systematic error making the clipped rms of quantity/error unity
+
+    For each sample, finds ``sysErr`` such that the clipped rms of ``quantity/sqrt(error**2 + sysErr**2)``
+    is 1.  The rms decreases monotonically with ``sysErr**2``, so the root is bracketed between zero
+    and a geometrically expanded upper bound, then refined with the Illinois variant of regula falsi.
+    All samples are iterated in lockstep with a bounded number of iterations, and ``error**2`` is
+    computed only once per sample.
+
+    Parameters
+    ----------
+    quantities : `list` of `numpy.ndarray`
+       Selected quantity for each sample.
+    errors : `list` of `numpy.ndarray`
+       Corresponding errors for each sample.
+    clipFactor : `float`
+       Rejection threshold (in units of the IQR-derived standard deviation).
+    forcedMean : `float`, optional
+       Mean about which to compute the rms, instead of the actual mean.
+    tol : `float`
+       Tolerance on the rms deviation from unity.
+    maxIter : `int`
+       Maximum number of iterations for each of the bracketing and refinement stages.
+    log : `lsst.log.Log`, optional
+       Logger for diagnostics.
+
+    Returns
+    -------
+    sysErr : `numpy.ndarray`
+       Systematic error for each sample; NaN where there is no data, the rms is already below unity
+       without a systematic error, or the solution did not converge.
+    """
+    quantities = [np.asarray(quantity, dtype=np.float64) for quantity in quantities]
+    errorSq = [np.asarray(error, dtype=np.float64)**2 for error in errors]
+    num = len(quantities)
+
+    def residual(i, sysErr2):
+        sigNoise = quantities[i]/np.sqrt(errorSq[i] + sysErr2)
+        allSelected = np.ones(len(sigNoise), dtype=bool)
+        return _clippedStats(sigNoise, allSelected, clipFactor, forcedMean=forcedMean).stdev - 1.0
+
+    sysErr2 = np.full(num, np.nan)
+    lower = np.zeros(num)
+    upper = np.zeros(num)
+    fLower = np.full(num, np.nan)
+    fUpper = np.full(num, np.nan)
+    active = np.zeros(num, dtype=bool)
+    for i in range(num):
+        if len(quantities[i]) == 0:
+            continue
+        fLower[i] = residual(i, 0.0)
+        if not np.isfinite(fLower[i]):
+            continue
+        if abs(fLower[i]) < tol:
+            sysErr2[i] = 0.0
+            continue
+        if fLower[i] < 0.0:
+            if log is not None:
+                log.debug("sysErr: rms of sample {:d} is {:.4f} with no systematic error".
+                          format(i, fLower[i] + 1.0))
+            continue
+        # Expand the upper bracket until the rms drops below unity
+        upper[i] = max(np.median(errorSq[i]), np.finfo(np.float64).tiny)
+        fUpper[i] = residual(i, upper[i])
+        for _ in range(maxIter):
+            if not fUpper[i] > 0.0:
+                break
+            lower[i], fLower[i] = upper[i], fUpper[i]
+            upper[i] *= 4.0
+            fUpper[i] = residual(i, upper[i])
+        active[i] = fUpper[i] <= 0.0
+
+    side = np.zeros(num, dtype=int)
+    for _ in range(maxIter):
+        if not active.any():
+            break
+        indices = np.where(active)[0]
+        trial = ((lower[indices]*fUpper[indices] - upper[indices]*fLower[indices])/
+                 (fUpper[indices] - fLower[indices]))
+        for i, x in zip(indices, trial):
+            fx = residual(i, x)
+            if abs(fx) < tol or (upper[i] - lower[i]) <= tol*upper[i]:
+                sysErr2[i] = x
+                active[i] = False
+            elif fx > 0.0:
+                lower[i], fLower[i] = x, fx
+                if side[i] == 1:
+                    fUpper[i] /= 2.0
+                side[i] = 1
+            else:
+                upper[i], fUpper[i] = x, fx
+                if side[i] == -1:
+                    fLower[i] /= 2.0
+                side[i] = -1
+    if active.any() and log is not None:
+        log.warn("sysErr calculation did not converge in {:d} iterations for {:d} sample(s)".
+                 format(maxIter, active.sum()))
+    return np.sqrt(sysErr2)
+
+
 class Enforcer(object):
     """Functor for enforcing limits on statistics"""
     def __init__(self, requireGreater={}, requireLess={}, doRaise=False):
@@ -149,6 +766,138 @@ class Enforcer(object):
                         raise AssertionError(text)
 
 
+class DerivedQuantityCache(object):
+    """Memo of arrays derived from the columns of catalogs
+
+    Values are held per catalog (keyed by the catalog object itself) and, within a catalog, by a
+    hashable key describing the computation, e.g. ``("magnitude", column)``.  Only the most recently
+    used ``maxCatalogs`` catalogs are retained, and the tasks drop all entries at the end of each stage
+    (see `invalidateDerivedQuantities`) so no catalogs are held beyond it.  The cached arrays are
+    shared between all callers, so they are returned read-only.
+
+    Parameters
+    ----------
+    maxCatalogs : `int`
+       Maximum number of catalogs for which derived quantities are retained.
+    """
+    def __init__(self, maxCatalogs=4):
+        self.maxCatalogs = maxCatalogs
+        self._entries = OrderedDict()
+
+    def _getEntry(self, catalog):
+        key = id(catalog)
+        entry = self._entries.pop(key, None)
+        # Guard against id reuse and against records having been added or removed
+        if entry is None or entry.catalog is not catalog or entry.length != len(catalog):
+            entry = Struct(catalog=catalog, length=len(catalog), values={})
+        self._entries[key] = entry
+        while len(self._entries) > self.maxCatalogs:
+            self._entries.popitem(last=False)
+        return entry
+
+    def get(self, catalog, key, func):
+        """Return the derived quantity for key, computing it with ``func(catalog)`` if required"""
+        values = self._getEntry(catalog).values
+        if key not in values:
+            value = func(catalog)
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+            values[key] = value
+        return values[key]
+
+    def invalidate(self, catalog=None):
+        """Drop the derived quantities of catalog (or of all catalogs if None)"""
+        if catalog is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(id(catalog), None)
+
+
+_derivedQuantityCache = DerivedQuantityCache()
+
+
+def getDerivedQuantity(catalog, key, func):
+    """Return a derived quantity of catalog from the process-wide cache
+
+    Parameters
+    ----------
+    catalog : `lsst.afw.table.SourceCatalog`
+       Catalog from which the quantity is derived.
+    key : hashable
+       Identifier of the computation, including all of its parameters (e.g. the column names).
+    func : callable
+       Function computing the quantity from the catalog if it is not cached.
+
+    Returns
+    -------
+    value : `numpy.ndarray`
+       The (read-only) derived quantity.
+    """
+    return _derivedQuantityCache.get(catalog, key, func)
+
+
+def invalidateDerivedQuantities(catalog=None):
+    """Drop cached derived quantities; must be called when catalog values are modified in place"""
+    _derivedQuantityCache.invalidate(catalog)
+
+
+def magnitude(catalog, column):
+    """Return (cached) -2.5*log10 of the flux column"""
+    return getDerivedQuantity(catalog, ("magnitude", column), lambda cat: -2.5*np.log10(cat[column]))
+
+
+def traceSize(catalog, column):
+    """Return (cached) trace radius size of the shape column"""
+    return getDerivedQuantity(catalog, ("traceSize", column),
+                              lambda cat: np.sqrt(0.5*(cat[column + "_xx"] + cat[column + "_yy"])))
+
+
+def ellipticityE1(catalog, column):
+    """Return (cached) e1 ellipticity of the shape column"""
+    return getDerivedQuantity(catalog, ("e1", column),
+                              lambda cat: ((cat[column + "_xx"] - cat[column + "_yy"])/
+                                           (cat[column + "_xx"] + cat[column + "_yy"])))
+
+
+def ellipticityE2(catalog, column):
+    """Return (cached) e2 ellipticity of the shape column"""
+    return getDerivedQuantity(catalog, ("e2", column),
+                              lambda cat: 2.0*cat[column + "_xy"]/(cat[column + "_xx"] + cat[column + "_yy"]))
+
+
+def ellipseAxes(ixx, iyy, ixy):
+    """Return the semi-major and semi-minor axes and position angles of the ellipses of the given moments
+
+    The vectorized equivalent of constructing an `lsst.afw.geom.ellipses.Axes` from an
+    `lsst.afw.geom.Quadrupole` for each element, using the closed-form eigen-decomposition of the
+    second moments matrix.
+
+    Parameters
+    ----------
+    ixx, iyy, ixy : `numpy.ndarray`
+       Second moments of the ellipses.
+
+    Returns
+    -------
+    result : `lsst.pipe.base.Struct`
+       Result struct with components:
+
+       - ``a`` : semi-major axes (`numpy.ndarray`).
+       - ``b`` : semi-minor axes (`numpy.ndarray`).
+       - ``theta`` : position angles of the major axes, counter-clockwise from the x-axis, in radians
+         (`numpy.ndarray`).
+    """
+    ixx = np.asarray(ixx, dtype=np.float64)
+    iyy = np.asarray(iyy, dtype=np.float64)
+    ixy = np.asarray(ixy, dtype=np.float64)
+    halfTrace = 0.5*(ixx + iyy)
+    root = np.hypot(0.5*(ixx - iyy), ixy)
+    a = np.sqrt(halfTrace + root)
+    b = np.sqrt(np.maximum(halfTrace - root, 0.0))
+    theta = 0.5*np.arctan2(2.0*ixy, ixx - iyy)
+    return Struct(a=a, b=b, theta=theta)
+
+
 class MagDiff(object):
     """Functor to calculate magnitude difference"""
     def __init__(self, col1, col2, unitScale=1.0):
@@ -157,7 +906,9 @@ class MagDiff(object):
         self.unitScale = unitScale
 
     def __call__(self, catalog):
-        return -2.5*np.log10(catalog[self.col1]/catalog[self.col2])*self.unitScale
+        magDiff = getDerivedQuantity(catalog, ("MagDiff", self.col1, self.col2),
+                                     lambda cat: -2.5*np.log10(cat[self.col1]/cat[self.col2]))
+        return magDiff*self.unitScale
 
 
 class MagDiffMatches(object):
@@ -169,10 +920,10 @@ class MagDiffMatches(object):
         self.unitScale = unitScale
 
     def __call__(self, catalog):
-        ref1 = -2.5*np.log10(catalog["ref_" + self.colorterm.primary + "_flux"])
-        ref2 = -2.5*np.log10(catalog["ref_" + self.colorterm.secondary + "_flux"])
+        ref1 = magnitude(catalog, "ref_" + self.colorterm.primary + "_flux")
+        ref2 = magnitude(catalog, "ref_" + self.colorterm.secondary + "_flux")
         ref = self.colorterm.transformMags(ref1, ref2)
-        src = self.zp - 2.5*np.log10(catalog["src_" + self.column])
+        src = self.zp + magnitude(catalog, "src_" + self.column)
         return (src - ref)*self.unitScale
 
 
@@ -186,8 +937,8 @@ class MagDiffCompare(object):
         self.unitScale = unitScale
 
     def __call__(self, catalog):
-        src1 = -2.5*np.log10(catalog["first_" + self.column])
-        src2 = -2.5*np.log10(catalog["second_" + self.column])
+        src1 = magnitude(catalog, "first_" + self.column)
+        src2 = magnitude(catalog, "second_" + self.column)
         return (src1 - src2)*self.unitScale
 
 
@@ -214,8 +965,7 @@ class TraceSize(object):
         self.column = column
 
     def __call__(self, catalog):
-        srcSize = np.sqrt(0.5*(catalog[self.column + "_xx"] + catalog[self.column + "_yy"]))
-        return np.array(srcSize)
+        return np.array(traceSize(catalog, self.column))
 
 
 class PsfTraceSizeDiff(object):
@@ -225,8 +975,8 @@ class PsfTraceSizeDiff(object):
         self.psfColumn = psfColumn
 
     def __call__(self, catalog):
-        srcSize = np.sqrt(0.5*(catalog[self.column + "_xx"] + catalog[self.column + "_yy"]))
-        psfSize = np.sqrt(0.5*(catalog[self.psfColumn + "_xx"] + catalog[self.psfColumn + "_yy"]))
+        srcSize = traceSize(catalog, self.column)
+        psfSize = traceSize(catalog, self.psfColumn)
         sizeDiff = 100*(srcSize - psfSize)/(0.5*(srcSize + psfSize))
         return np.array(sizeDiff)
 
@@ -237,10 +987,8 @@ class TraceSizeCompare(object):
         self.column = column
 
     def __call__(self, catalog):
-        srcSize1 = np.sqrt(0.5*(catalog["first_" + self.column + "_xx"] +
-                                catalog["first_" + self.column + "_yy"]))
-        srcSize2 = np.sqrt(0.5*(catalog["second_" + self.column + "_xx"] +
-                                catalog["second_" + self.column + "_yy"]))
+        srcSize1 = traceSize(catalog, "first_" + self.column)
+        srcSize2 = traceSize(catalog, "second_" + self.column)
         sizeDiff = 100.0*(srcSize1 - srcSize2)/(0.5*(srcSize1 + srcSize2))
         return np.array(sizeDiff)
 
@@ -265,10 +1013,8 @@ class E1Resids(object):
         self.unitScale = unitScale
 
     def __call__(self, catalog):
-        srcE1 = ((catalog[self.column + "_xx"] - catalog[self.column + "_yy"])/
-                 (catalog[self.column + "_xx"] + catalog[self.column + "_yy"]))
-        psfE1 = ((catalog[self.psfColumn + "_xx"] - catalog[self.psfColumn + "_yy"])/
-                 (catalog[self.psfColumn + "_xx"] + catalog[self.psfColumn + "_yy"]))
+        srcE1 = ellipticityE1(catalog, self.column)
+        psfE1 = ellipticityE1(catalog, self.psfColumn)
         e1Resids = srcE1 - psfE1
         return np.array(e1Resids)*self.unitScale
 
@@ -281,10 +1027,8 @@ class E2Resids(object):
         self.unitScale = unitScale
 
     def __call__(self, catalog):
-        srcE2 = (2.0*catalog[self.column + "_xy"]/
-                 (catalog[self.column + "_xx"] + catalog[self.column + "_yy"]))
-        psfE2 = (2.0*catalog[self.psfColumn + "_xy"]/
-                 (catalog[self.psfColumn + "_xx"] + catalog[self.psfColumn + "_yy"]))
+        srcE2 = ellipticityE2(catalog, self.column)
+        psfE2 = ellipticityE2(catalog, self.psfColumn)
         e2Resids = srcE2 - psfE2
         return np.array(e2Resids)*self.unitScale
 
@@ -296,8 +1040,7 @@ class E1ResidsHsmRegauss(object):
 
     def __call__(self, catalog):
         srcE1 = catalog["ext_shapeHSM_HsmShapeRegauss_e1"]
-        psfE1 = ((catalog["ext_shapeHSM_HsmPsfMoments_xx"] - catalog["ext_shapeHSM_HsmPsfMoments_yy"])/
-                 (catalog["ext_shapeHSM_HsmPsfMoments_xx"] + catalog["ext_shapeHSM_HsmPsfMoments_yy"]))
+        psfE1 = ellipticityE1(catalog, "ext_shapeHSM_HsmPsfMoments")
         e1Resids = srcE1 - psfE1
         return np.array(e1Resids)*self.unitScale
 
@@ -309,8 +1052,7 @@ class E2ResidsHsmRegauss(object):
 
     def __call__(self, catalog):
         srcE2 = catalog["ext_shapeHSM_HsmShapeRegauss_e2"]
-        psfE2 = (2.0*catalog["ext_shapeHSM_HsmPsfMoments_xy"]/
-                 (catalog["ext_shapeHSM_HsmPsfMoments_xx"] + catalog["ext_shapeHSM_HsmPsfMoments_yy"]))
+        psfE2 = ellipticityE2(catalog, "ext_shapeHSM_HsmPsfMoments")
         e2Resids = srcE2 - psfE2
         return np.array(e2Resids)*self.unitScale
 
@@ -392,6 +1134,10 @@ class CentroidDiffErr(CentroidDiff):
 
 def deconvMom(catalog):
     """Calculate deconvolved moments"""
+    return getDerivedQuantity(catalog, ("deconvMom",), _deconvMom)
+
+
+def _deconvMom(catalog):
     if "ext_shapeHSM_HsmSourceMoments_xx" in catalog.schema:
         hsm = catalog["ext_shapeHSM_HsmSourceMoments_xx"] + catalog["ext_shapeHSM_HsmSourceMoments_yy"]
     else:
@@ -411,6 +1157,10 @@ def deconvMom(catalog):
 
 def deconvMomStarGal(catalog):
     """Calculate P(star) from deconvolved moments"""
+    return getDerivedQuantity(catalog, ("deconvMomStarGal",), _deconvMomStarGal)
+
+
+def _deconvMomStarGal(catalog):
     rTrace = deconvMom(catalog)
     snr = catalog["base_PsfFlux_instFlux"]/catalog["base_PsfFlux_instFluxErr"]
     poly = (-4.2759879274 + 0.0713088756641*snr + 0.16352932561*rTrace - 4.54656639596e-05*snr*snr -
@@ -430,35 +1180,419 @@ def concatenateCatalogs(catalogList):
     return catalog
 
 
-def joinMatches(matches, first="first_", second="second_"):
-    if not matches:
-        return []
-
-    mapperList = afwTable.SchemaMapper.join([matches[0].first.schema, matches[0].second.schema],
-                                            [first, second])
-    firstAliases = matches[0].first.schema.getAliasMap()
-    secondAliases = matches[0].second.schema.getAliasMap()
+def _makeJoinedCatalog(schema1, schema2, first, second):
+    # Create an empty catalog holding the fields of both schemas (prefixed) plus a distance column
+    mapperList = afwTable.SchemaMapper.join([schema1, schema2], [first, second])
     schema = mapperList[0].getOutputSchema()
     distanceKey = schema.addField("distance", type="Angle",
                                   doc="Distance between {0:s} and {1:s}".format(first, second))
     catalog = afwTable.BaseCatalog(schema)
+    # make sure aliases get persisted to match catalog
     aliases = catalog.schema.getAliasMap()
+    for k, v in schema1.getAliasMap().items():
+        aliases.set(first + k, first + v)
+    for k, v in schema2.getAliasMap().items():
+        aliases.set(second + k, second + v)
+    return catalog, mapperList, distanceKey
+
+
+def joinMatches(matches, first="first_", second="second_"):
+    if not matches:
+        return []
+
+    catalog, mapperList, distanceKey = _makeJoinedCatalog(matches[0].first.schema, matches[0].second.schema,
+                                                          first, second)
     catalog.reserve(len(matches))
     for mm in matches:
         row = catalog.addNew()
         row.assign(mm.first, mapperList[0])
         row.assign(mm.second, mapperList[1])
         row.set(distanceKey, mm.distance*afwGeom.radians)
-    # make sure aliases get persisted to match catalog
-    for k, v in firstAliases.items():
-        aliases.set(first + k, first + v)
-    for k, v in secondAliases.items():
-        aliases.set(second + k, second + v)
     return catalog
 
 
+def joinMatchIndices(catalog1, catalog2, index1, index2, distance, first="first_", second="second_"):
+    """Join two catalogs row-by-row according to index arrays of matches
+
+    This is the index-array equivalent of `joinMatches`, for use with the output of `SkyMatcher`.
+
+    Parameters
+    ----------
+    catalog1, catalog2 : `lsst.afw.table.SourceCatalog` or `lsst.afw.table.SimpleCatalog`
+       The catalogs that were matched.
+    index1, index2 : `numpy.ndarray` of `int`
+       Indices into ``catalog1`` and ``catalog2`` of the matched pairs.
+    distance : `numpy.ndarray` of `float`
+       Angular separation of each matched pair (in radians).
+    first, second : `str`, optional
+       Prefixes for the columns from ``catalog1`` and ``catalog2`` in the joined catalog.
+
+    Returns
+    -------
+    catalog : `lsst.afw.table.BaseCatalog`
+       The joined catalog with a "distance" column added, or an empty `list` if there are no matches
+       (as for `joinMatches`).
+    """
+    if len(index1) == 0:
+        return []
+
+    catalog, mapperList, distanceKey = _makeJoinedCatalog(catalog1.schema, catalog2.schema, first, second)
+    catalog.reserve(len(index1))
+    for i1, i2 in zip(index1.tolist(), index2.tolist()):
+        row = catalog.addNew()
+        row.assign(catalog1[i1], mapperList[0])
+        row.assign(catalog2[i2], mapperList[1])
+    catalog[distanceKey][:] = distance
+    return catalog
+
+
+def getSkyCircle(ra, dec):
+    """Return the center and radius of a circle enclosing all of the given positions
+
+    The center is the (normalized) mean of the unit vectors of the positions and the radius is the
+    largest separation from it, both computed with vectorized unit-vector math.
+
+    Parameters
+    ----------
+    ra, dec : `numpy.ndarray`
+       Right Ascension and Declination (in radians).
+
+    Returns
+    -------
+    center : `lsst.afw.geom.SpherePoint`
+       Center of the enclosing circle.
+    radius : `lsst.afw.geom.Angle`
+       Radius of the enclosing circle.
+    """
+    vectors = SkyMatcher.toVectors(ra, dec)
+    vectors = vectors[np.isfinite(vectors).all(axis=1)]
+    if len(vectors) == 0:
+        raise RuntimeError("Cannot compute the sky circle of an empty set of positions")
+    mean = vectors.sum(axis=0)
+    mean /= np.sqrt((mean**2).sum())
+    center = afwGeom.SpherePoint(np.arctan2(mean[1], mean[0]), np.arcsin(np.clip(mean[2], -1.0, 1.0)),
+                                 afwGeom.radians)
+    radius = np.arccos(np.clip(np.dot(vectors, mean).min(), -1.0, 1.0))
+    return center, radius*afwGeom.radians
+
+
+def getBBoxSkyCircle(bbox, wcs, padding=1.05):
+    """Return the center and radius of a circle enclosing the corners of a pixel bounding box
+
+    The radius is scaled by ``padding`` (as is the persisted match radius when the matches are
+    unpacked), so the circle covers the reference objects loaded for the box.
+    """
+    corners = [wcs.pixelToSky(corner) for corner in afwGeom.Box2D(bbox).getCorners()]
+    center, radius = getSkyCircle(np.array([corner.getRa().asRadians() for corner in corners]),
+                                  np.array([corner.getDec().asRadians() for corner in corners]))
+    return center, radius*padding
+
+
+class SkyMatcher(object):
+    """Spatial index for matching positions on the sky
+
+    The positions are converted to unit vectors and placed in a KD-tree, so the index is built once
+    (in N log N time) and can then be queried repeatedly for nearest neighbours, all neighbours within
+    a radius, or all pairs within a radius of each other.  Matches are returned as index arrays
+    rather than lists of match objects.
+
+    Parameters
+    ----------
+    ra, dec : `numpy.ndarray`
+       Right Ascension and Declination (in radians) of the positions to index.
+    """
+    def __init__(self, ra, dec):
+        self.vectors = self.toVectors(ra, dec)
+        self.tree = scipySpatial.cKDTree(self.vectors)
+
+    @classmethod
+    def fromCatalog(cls, catalog):
+        """Build a SkyMatcher from the coord_ra and coord_dec columns of a catalog"""
+        return cls(catalog["coord_ra"], catalog["coord_dec"])
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @staticmethod
+    def toVectors(ra, dec):
+        """Convert ra, dec (in radians) to an (N, 3) array of unit vectors"""
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        cosDec = np.cos(dec)
+        return np.column_stack((cosDec*np.cos(ra), cosDec*np.sin(ra), np.sin(dec)))
+
+    @staticmethod
+    def chordFromAngle(radius):
+        """Convert an angular radius (`lsst.afw.geom.Angle` or radians) to a unit-sphere chord length"""
+        if hasattr(radius, "asRadians"):
+            radius = radius.asRadians()
+        return 2.0*np.sin(0.5*np.minimum(radius, np.pi))
+
+    @staticmethod
+    def angleFromChord(chord):
+        """Convert unit-sphere chord lengths to angular separations (in radians)"""
+        return 2.0*np.arcsin(np.clip(0.5*chord, 0.0, 1.0))
+
+    @classmethod
+    def separation(cls, ra1, dec1, ra2, dec2):
+        """Return the angular separations (in radians) between pairs of positions (all in radians)"""
+        chord = np.sqrt(((cls.toVectors(ra1, dec1) - cls.toVectors(ra2, dec2))**2).sum(axis=1))
+        return cls.angleFromChord(chord)
+
+    def nearest(self, ra, dec, radius):
+        """Find the nearest indexed position within radius of each of the given positions
+
+        Parameters
+        ----------
+        ra, dec : `numpy.ndarray`
+           Right Ascension and Declination (in radians) of the query positions.
+        radius : `lsst.afw.geom.Angle` or `float`
+           Maximum match radius (`float` values are in radians).
+
+        Returns
+        -------
+        index1 : `numpy.ndarray` of `int`
+           Indices into the query positions of those with a match.
+        index2 : `numpy.ndarray` of `int`
+           Indices into the indexed positions of the nearest match.
+        distance : `numpy.ndarray` of `float`
+           Angular separation of each match (in radians).
+        """
+        vectors = self.toVectors(ra, dec)
+        if len(vectors) == 0 or len(self.vectors) == 0:
+            return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+        chord, index2 = self.tree.query(vectors, k=1, distance_upper_bound=self.chordFromAngle(radius))
+        found = index2 < len(self.vectors)
+        return np.flatnonzero(found), index2[found], self.angleFromChord(chord[found])
+
+    def withinRadius(self, ra, dec, radius):
+        """Find all indexed positions within radius of each of the given positions
+
+        Parameters are as for `nearest`.  Returned pairs are sorted by query index, then indexed index.
+        """
+        vectors = self.toVectors(ra, dec)
+        if len(vectors) == 0 or len(self.vectors) == 0:
+            return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+        other = scipySpatial.cKDTree(vectors)
+        pairs = other.sparse_distance_matrix(self.tree, self.chordFromAngle(radius), output_type="ndarray")
+        pairs.sort(order=["i", "j"])
+        return pairs["i"].astype(int), pairs["j"].astype(int), self.angleFromChord(pairs["v"])
+
+    def selfMatch(self, radius, symmetric=True):
+        """Find all pairs of indexed positions within radius of each other
+
+        Parameters
+        ----------
+        radius : `lsst.afw.geom.Angle` or `float`
+           Maximum match radius (`float` values are in radians).
+        symmetric : `bool`, optional
+           Return both (i, j) and (j, i) for each pair (as `lsst.afw.table.matchRaDec` does for a
+           self-match)?  Otherwise only pairs with i < j are returned.
+
+        Returns
+        -------
+        index1, index2 : `numpy.ndarray` of `int`
+           Indices of the members of each matched pair.
+        distance : `numpy.ndarray` of `float`
+           Angular separation of each pair (in radians).
+        """
+        if len(self.vectors) == 0:
+            return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+        pairs = self.tree.query_pairs(self.chordFromAngle(radius), output_type="ndarray")
+        if len(pairs) == 0:
+            return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+        index1, index2 = pairs[:, 0].astype(int), pairs[:, 1].astype(int)
+        chord = np.sqrt(((self.vectors[index1] - self.vectors[index2])**2).sum(axis=1))
+        distance = self.angleFromChord(chord)
+        if symmetric:
+            index1, index2 = np.concatenate((index1, index2)), np.concatenate((index2, index1))
+            distance = np.concatenate((distance, distance))
+        order = np.lexsort((index2, index1))
+        return index1[order], index2[order], distance[order]
+
+
+def matchIds(ids1, ids2):
+    """Join two arrays of (unique) object ids with a sorted merge
+
+    Parameters
+    ----------
+    ids1, ids2 : `numpy.ndarray` of `int`
+       The ids to join.
+
+    Returns
+    -------
+    index1, index2 : `numpy.ndarray` of `int`
+       Indices into ``ids1`` and ``ids2`` of the entries with identical ids, sorted by ``index1``.
+    """
+    ids1 = np.asarray(ids1)
+    ids2 = np.asarray(ids2)
+    if len(ids1) == 0 or len(ids2) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    order2 = np.argsort(ids2, kind="mergesort")
+    sorted2 = ids2[order2]
+    position = np.clip(np.searchsorted(sorted2, ids1), 0, len(sorted2) - 1)
+    found = sorted2[position] == ids1
+    return np.flatnonzero(found), order2[position[found]]
+
+
+class MatchStore(object):
+    """Persist match index arrays so that matching need not be repeated
+
+    The (index1, index2, distance) arrays of a match between catalogs are written to a compressed numpy
+    (npz) file per (match name, radius, dataId), along with a fingerprint of the ids and positions of
+    the matched catalogs.  Subsequent requests for the same match (in a later plotting stage or a later
+    run on the same inputs) are then served from the file if the fingerprint is unchanged.
+
+    Parameters
+    ----------
+    directory : `str` or `None`
+       Directory in which to persist the matches.  If `None`, nothing is persisted and every request
+       is simply passed through to the matching function.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+
+    @classmethod
+    def fromFilenamer(cls, filenamer, dataId, directory=None, doPersist=True):
+        """Construct a MatchStore persisting to a "matchStore" subdirectory of the filenamer outputs
+
+        Parameters
+        ----------
+        filenamer : `lsst.pipe.analysis.utils.Filenamer`
+           Filenamer for the task outputs.
+        dataId : `dict`
+           Data id for the task outputs.
+        directory : `str` or `None`, optional
+           Directory in which to persist the matches, overriding the filenamer output directory.
+        doPersist : `bool`, optional
+           Persist matches?  If `False`, a pass-through MatchStore is returned.
+        """
+        if not doPersist:
+            return cls()
+        if directory is None:
+            directory = os.path.join(os.path.dirname(filenamer(dataId, description="matchStore",
+                                                               style="npz")), "matchStore")
+        return cls(directory)
+
+    def getFilename(self, name, radius, dataId):
+        """Return the filename in which to persist the given match"""
+        dataIdStr = "-".join("{0:s}{1:s}".format(str(key), str(dataId[key]).replace(",", "x"))
+                             for key in sorted(dataId))
+        return os.path.join(self.directory, "{0:s}_{1:s}_{2:.4f}.npz".format(name, dataIdStr, radius))
+
+    @staticmethod
+    def fingerprint(catalogList, radius, params=None):
+        """Return a hash of the ids and positions of the catalogs, the match radius and any parameters"""
+        sha = hashlib.sha1(repr(radius).encode())
+        if params is not None:
+            sha.update(repr(sorted(params.items())).encode())
+        for catalog in catalogList:
+            sha.update(str(len(catalog)).encode())
+            for column in ("id", "coord_ra", "coord_dec"):
+                if column in catalog.schema:
+                    sha.update(np.ascontiguousarray(catalog[column]).tobytes())
+        return sha.hexdigest()
+
+    def match(self, name, radius, dataId, catalogList, matchFunc, params=None):
+        """Return the persisted match indices, running and persisting the match if required
+
+        Parameters
+        ----------
+        name : `str`
+           Name of the match (e.g. "overlaps_forced"), unique for the matched datasets.
+        radius : `float`
+           Match radius (arcseconds).
+        dataId : `dict` or `None`
+           Data id (e.g. tract and filter) of the matched catalogs.  If `None`, the match is not persisted.
+        catalogList : `list` of `lsst.afw.table.BaseCatalog`
+           The catalogs being matched (used to check that a persisted match is still valid).
+        matchFunc : callable
+           Function taking no arguments and returning the (index1, index2, distance) arrays.
+        params : `dict`, optional
+           Any other parameters (e.g. config values) on which the match depends; a persisted match
+           made with different parameters is not reused.
+
+        Returns
+        -------
+        index1, index2 : `numpy.ndarray` of `int`
+           Indices of the matched pairs.
+        distance : `numpy.ndarray` of `float`
+           Angular separation of each pair (in radians).
+        """
+        if self.directory is None or dataId is None:
+            return matchFunc()
+        filename = self.getFilename(name, radius, dataId)
+        fingerprint = self.fingerprint(catalogList, radius, params=params)
+        if os.path.exists(filename):
+            try:
+                with np.load(filename) as stored:
+                    if str(stored["fingerprint"]) == fingerprint:
+                        return stored["index1"], stored["index2"], stored["distance"]
+            except (IOError, KeyError, ValueError):
+                pass
+        index1, index2, distance = matchFunc()
+        safeMakeDir(self.directory)
+        tempFilename = filename[:-len(".npz")] + ".tmp.npz"
+        np.savez_compressed(tempFilename, index1=index1, index2=index2, distance=distance,
+                            fingerprint=np.array(fingerprint))
+        os.rename(tempFilename, filename)
+        return index1, index2, distance
+
+
+def idsInList(ids, idList):
+    """Return a boolean array indicating which of ids are present in idList
+
+    This uses a sorted (rather than per-element linear) membership test, so is O((N + M) log M).
+
+    Parameters
+    ----------
+    ids : `numpy.ndarray` of `int`
+       The ids to test (e.g. the "second" column of a packed match list).
+    idList : `numpy.ndarray` of `int`
+       The ids to test against (e.g. the ids of sources flagged as bad).
+
+    Returns
+    -------
+    inList : `numpy.ndarray` of `bool`
+       True for each element of ids that is present in idList.
+    """
+    return np.isin(np.asarray(ids), np.asarray(idList))
+
+
+def purgeMatchesById(packedMatches, badIds, idColumn="second"):
+    """Remove entries of a packed (normalized) match list whose source id is in badIds
+
+    Parameters
+    ----------
+    packedMatches : `lsst.afw.table.BaseCatalog`
+       Packed match list, as persisted by the butler (with "first", "second" and "distance" columns).
+    badIds : `numpy.ndarray` of `int`
+       Ids of the sources to purge.
+    idColumn : `str`, optional
+       Name of the column in packedMatches holding the source ids.
+
+    Returns
+    -------
+    packedMatches : `lsst.afw.table.BaseCatalog`
+       Deep copy of the packed match list with the bad sources removed.
+    """
+    badMatch = idsInList(packedMatches[idColumn], badIds)
+    return packedMatches[~badMatch].copy(deep=True)
+
+
 def checkIdLists(catalog1, catalog2, prefix=""):
     # Check to see if two catalogs have an identical list of objects by id
+    if catalog1 is catalog2:
+        return True
+    # Keep a reference to catalog2 with the result, so its id cannot be reused while cached
+    cached = getDerivedQuantity(catalog1, ("checkIdLists", id(catalog2), prefix),
+                                lambda cat: (catalog2, len(catalog2), _checkIdLists(cat, catalog2, prefix)))
+    if cached[0] is catalog2 and cached[1] == len(catalog2):
+        return cached[2]
+    return _checkIdLists(catalog1, catalog2, prefix)
+
+
+def _checkIdLists(catalog1, catalog2, prefix=""):
     idStrList = ["", ""]
     for i, cat in enumerate((catalog1, catalog2)):
         if "id" in cat.schema:
@@ -476,24 +1610,116 @@ def checkIdLists(catalog1, catalog2, prefix=""):
     return np.all(catalog1[idStrList[0]] == catalog2[idStrList[1]])
 
 
+def _patchIndexSet(patchList):
+    # Convert a list of patch dataId strings (e.g. "1,2") to a set of (x, y) index tuples
+    return set(tuple(int(val) for val in patch.split(",")) for patch in patchList)
+
+
+def getAdjacentPatchPairs(patchList, tractInfo):
+    """Return the pairs of patches in patchList whose outer bounding boxes overlap
+
+    Patches are laid out on a regular grid, so only grid neighbours (including diagonal ones) can
+    overlap.  Each patch is therefore compared with its (up to) four "forward" neighbours only,
+    rather than with every other patch in the list.
+
+    Parameters
+    ----------
+    patchList : `list` of `str`
+       List of patch dataIds, e.g. ["1,2", "2,2"].
+    tractInfo : `lsst.skymap.tractInfo.ExplicitTractInfo`
+       TractInfo object associated with the patches.
+
+    Returns
+    -------
+    patchPairs : `list` of `tuple`
+       List of pairs of (x, y) patch index tuples with overlapping outer bounding boxes.
+    """
+    patchIndices = _patchIndexSet(patchList)
+    patchPairs = []
+    for patch0 in sorted(patchIndices):
+        for dx, dy in ((1, -1), (1, 0), (1, 1), (0, 1)):
+            patch1 = (patch0[0] + dx, patch0[1] + dy)
+            if patch1 in patchIndices:
+                patchBBox0 = tractInfo.getPatchInfo(patch0).getOuterBBox()
+                patchBBox1 = tractInfo.getPatchInfo(patch1).getOuterBBox()
+                if patchBBox0.overlaps(patchBBox1):
+                    patchPairs.append((patch0, patch1))
+    return patchPairs
+
+
 def checkPatchOverlap(patchList, tractInfo):
     # Given a list of patch dataIds along with the associated tractInfo, check if any of the patches overlap
-    for i, patch0 in enumerate(patchList):
-        overlappingPatches = False
-        patchIndex = [int(val) for val in patch0.split(",")]
-        patchInfo = tractInfo.getPatchInfo(patchIndex)
-        patchBBox0 = patchInfo.getOuterBBox()
-        for j, patch1 in enumerate(patchList):
-            if patch1 != patch0 and j > i:
-                patchIndex = [int(val) for val in patch1.split(",")]
-                patchInfo = tractInfo.getPatchInfo(patchIndex)
-                patchBBox1 = patchInfo.getOuterBBox()
-                if patchBBox0.overlaps(patchBBox1):
-                    overlappingPatches = True
-                    break
-        if overlappingPatches:
-            break
-    return overlappingPatches
+    return len(getAdjacentPatchPairs(patchList, tractInfo)) > 0
+
+
+def getInnerPatchIndices(catalog, tractInfo):
+    """Return the index of the patch whose inner region contains each source
+
+    Parameters
+    ----------
+    catalog : `lsst.afw.table.SourceCatalog`
+       Coadd source catalog, with centroids in tract pixel coordinates.
+    tractInfo : `lsst.skymap.tractInfo.ExplicitTractInfo`
+       TractInfo object associated with catalog.
+
+    Returns
+    -------
+    patchX, patchY : `numpy.ndarray` of `int`
+       The x and y patch indices.
+    fracX, fracY : `numpy.ndarray` of `float`
+       The position (in pixels) of each source relative to the origin of its patch inner region.
+    """
+    innerWidth, innerHeight = tractInfo.getPatchInnerDimensions()
+    origin = tractInfo.getPatchInfo((0, 0)).getInnerBBox().getMin()
+    x = catalog.getX() - origin.getX()
+    y = catalog.getY() - origin.getY()
+    patchX = np.floor(x/innerWidth).astype(np.int64)
+    patchY = np.floor(y/innerHeight).astype(np.int64)
+    return patchX, patchY, x - patchX*innerWidth, y - patchY*innerHeight
+
+
+def getPatchOverlapCandidates(catalog, tractInfo, patchList, margin=0.0):
+    """Identify sources that lie in an overlap strip shared with another patch in patchList
+
+    Only sources in the regions where the outer bounding boxes of adjacent patches overlap can have been
+    detected (and measured) more than once, so only these need be considered when matching a coadd
+    catalog against itself.
+
+    Parameters
+    ----------
+    catalog : `lsst.afw.table.SourceCatalog`
+       Coadd source catalog, with centroids in tract pixel coordinates.
+    tractInfo : `lsst.skymap.tractInfo.ExplicitTractInfo`
+       TractInfo object associated with catalog.
+    patchList : `list` of `str`
+       List of patch dataIds included in catalog.
+    margin : `float`, optional
+       Additional width (in pixels) by which to grow the overlap strips (e.g. the match radius), so that
+       both members of a duplicated pair are selected.
+
+    Returns
+    -------
+    candidates : `numpy.ndarray` of `bool`
+       True for sources lying in an overlap strip that is shared with a patch in patchList.
+    """
+    patchIndices = _patchIndexSet(patchList)
+    innerWidth, innerHeight = tractInfo.getPatchInnerDimensions()
+    border = tractInfo.getPatchBorder() + margin
+
+    # Index of the patch whose inner region contains each source, the position within that patch, and
+    # the direction (-1, 0, +1) of any neighbouring patch whose outer region also contains the source
+    patchX, patchY, fracX, fracY = getInnerPatchIndices(catalog, tractInfo)
+    dx = np.where(fracX < border, -1, np.where(fracX >= innerWidth - border, 1, 0))
+    dy = np.where(fracY < border, -1, np.where(fracY >= innerHeight - border, 1, 0))
+
+    # Encode the (x, y) patch indices as single integers for vectorized set membership
+    codeScale = 1 << 20
+    patchCodes = np.array([index[0]*codeScale + index[1] for index in patchIndices], dtype=np.int64)
+    candidates = np.zeros(len(catalog), dtype=bool)
+    for offsetX, offsetY, shifted in ((dx, 0, dx != 0), (0, dy, dy != 0), (dx, dy, (dx != 0) & (dy != 0))):
+        codes = (patchX + offsetX)*codeScale + patchY + offsetY
+        candidates |= shifted & np.isin(codes, patchCodes)
+    return candidates
 
 
 def joinCatalogs(catalog1, catalog2, prefix1="cat1_", prefix2="cat2_"):
@@ -896,6 +2122,7 @@ def calibrateSourceCatalogMosaic(dataRef, catalog, fluxKeys=None, errKeys=None,
         if len(catalog[key].shape) > 1:
             continue
         catalog[key] /= factor
+    invalidateDerivedQuantities(catalog)
     return catalog
 
 
@@ -909,6 +2136,7 @@ def calibrateSourceCatalog(catalog, zp):
     factor = 10.0**(0.4*zp)
     for name, key in list(fluxKeys.items()) + list(errKeys.items()):
         catalog[key] /= factor
+    invalidateDerivedQuantities(catalog)
     return catalog
 
 
@@ -922,6 +2150,7 @@ def calibrateCoaddSourceCatalog(catalog, zp):
     factor = 10.0**(0.4*zp)
     for name, key in list(fluxKeys.items()) + list(errKeys.items()):
         catalog[key] /= factor
+    invalidateDerivedQuantities(catalog)
     return catalog
 
 
@@ -935,14 +2164,48 @@ def backoutApCorr(catalog):
                 print("Backing out aperture corrections to fluxes")
                 ii += 1
             catalog[k] /= catalog[k[:-5] + "_apCorr"]
+    invalidateDerivedQuantities(catalog)
+    return catalog
+
+
+# LSST reads in a_net catalogs with flux in "janskys", so must convert back to DN
+JANSKYS_PER_AB_FLUX = 3631.0
+
+
+def _janskyFluxNames(schema, prefix=""):
+    """Return the names of the flux fields (in janskys) of a reference schema, with the given prefix"""
+    return [name for name in schema.getNames() if name.startswith(prefix) and "_flux" in name[len(prefix):]]
+
+
+def catalogJanskyToDn(catalog, prefix=""):
+    """Convert the reference fluxes of a catalog from janskys to DN, in place
+
+    Parameters
+    ----------
+    catalog : `lsst.afw.table.BaseCatalog`
+       Contiguous catalog of reference objects (or of joined matches, see ``prefix``).
+    prefix : `str`, optional
+       Prefix of the reference fields (e.g. "ref_" for the catalogs returned by `joinMatchIndices`).
+
+    Returns
+    -------
+    catalog : `lsst.afw.table.BaseCatalog`
+       The converted catalog.
+    """
+    if len(catalog) > 0:
+        for name in _janskyFluxNames(catalog.schema, prefix):
+            catalog[name][:] /= JANSKYS_PER_AB_FLUX
     return catalog
 
 
 def matchJanskyToDn(matches):
-    # LSST reads in a_net catalogs with flux in "janskys", so must convert back to DN
-    JANSKYS_PER_AB_FLUX = 3631.0
+    """Convert the reference fluxes of a list of matches from janskys to DN, in place
+
+    The records of a match list need not be contiguous, so they are converted one by one (see
+    `catalogJanskyToDn` for contiguous catalogs).
+    """
     schema = matches[0].first.schema
-    keys = [schema[kk].asKey() for kk in schema.getNames() if "_flux" in kk]
+    keys = [schema[name].asKey() for name in _janskyFluxNames(schema)]
 
     for m in matches:
         for k in keys:
@@ -994,6 +2257,244 @@ def getEups():
     return _eups
 
 
+def getPackageVersion(package="pipe_analysis"):
+    """Return the setup version of package ("unknown" if it cannot be determined)"""
+    try:
+        return getEups().findSetupVersion(package)[0] or "unknown"
+    except Exception:
+        return "unknown"
+
+
+# Rotation matrix from ICRS (J2000) to Galactic unit vectors
+_EQUATORIAL_TO_GALACTIC = np.array([[-0.0548755604162154, -0.8734370902348850, -0.4838350155487132],
+                                    [+0.4941094278755837, -0.4448296299600112, +0.7469822444972189],
+                                    [-0.8676661490190047, -0.1980763734312015, +0.4559837761750669]])
+
+
+def equatorialToGalactic(ra, dec):
+    """Convert ICRS (J2000) equatorial coordinates to Galactic coordinates
+
+    Parameters
+    ----------
+    ra, dec : `numpy.ndarray`
+       Right Ascension and Declination (in radians).
+
+    Returns
+    -------
+    l, b : `numpy.ndarray`
+       Galactic longitude (in the range [0, 2pi)) and latitude (in radians).
+    """
+    ra = np.asarray(ra, dtype=np.float64)
+    dec = np.asarray(dec, dtype=np.float64)
+    cosDec = np.cos(dec)
+    vec = np.array([cosDec*np.cos(ra), cosDec*np.sin(ra), np.sin(dec)])
+    galVec = np.dot(_EQUATORIAL_TO_GALACTIC, vec.reshape(3, -1)).reshape(vec.shape)
+    gl = np.arctan2(galVec[1], galVec[0]) % (2.0*np.pi)
+    gb = np.arcsin(np.clip(galVec[2], -1.0, 1.0))
+    return gl, gb
+
+
+def _memmapFitsImage(filename):
+    """Memory-map the primary image HDU of a FITS file
+
+    Only the header keywords needed to locate and interpret the data are parsed, so the (potentially
+    large) pixel array is never read into memory in full.
+
+    Parameters
+    ----------
+    filename : `str`
+       Name of the FITS file.
+
+    Returns
+    -------
+    image : `numpy.memmap`
+       Two-dimensional memory-mapped array of the primary HDU data, indexed as [y, x].
+    header : `dict`
+       Dictionary of the (keyword, value) pairs in the primary header.
+    """
+    blockSize = 2880
+    header = {}
+    nBlocks = 0
+    with open(filename, "rb") as fitsFile:
+        done = False
+        while not done:
+            block = fitsFile.read(blockSize)
+            if len(block) < blockSize:
+                raise RuntimeError("Unexpected end of file while reading FITS header of %s" % filename)
+            nBlocks += 1
+            for iCard in range(0, blockSize, 80):
+                card = block[iCard:iCard + 80].decode("ascii")
+                keyword = card[:8].strip()
+                if keyword == "END":
+                    done = True
+                    break
+                if card[8:10] != "= ":
+                    continue
+                value = card[10:].split("/")[0].strip().strip("'").strip()
+                try:
+                    value = float(value) if any(c in value for c in ".EeDd") else int(value)
+                except ValueError:
+                    pass
+                header[keyword] = value
+    dtypes = {8: ">u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4", -64: ">f8"}
+    if header.get("NAXIS") != 2 or header.get("BITPIX") not in dtypes:
+        raise RuntimeError("Unsupported FITS image in %s (NAXIS=%s, BITPIX=%s)" %
+                           (filename, header.get("NAXIS"), header.get("BITPIX")))
+    image = np.memmap(filename, dtype=dtypes[header["BITPIX"]], mode="r", offset=nBlocks*blockSize,
+                      shape=(header["NAXIS2"], header["NAXIS1"]))
+    return image, header
+
+
+class SfdDustMap(object):
+    """Provide E(B-V) from locally stored Schlegel, Finkbeiner & Davis (1998; SFD98) dust maps
+
+    The SFD98 maps are stored as a pair of Lambert zenithal equal-area projections of the northern
+    and southern Galactic hemispheres (SFD_dust_4096_ngp.fits and SFD_dust_4096_sgp.fits).  The
+    files are memory-mapped, so only the pixels actually required are paged in, and lookups are
+    fully vectorized (Galactic coordinate conversion and bilinear interpolation).
+
+    Parameters
+    ----------
+    mapDir : `str`
+       Directory containing the SFD98 map files.
+    mapNames : `dict` of `str`
+       File names of the north (key "ngp") and south (key "sgp") Galactic hemisphere maps.
+    """
+    mapNames = {"ngp": "SFD_dust_4096_ngp.fits", "sgp": "SFD_dust_4096_sgp.fits"}
+
+    def __init__(self, mapDir, mapNames=None):
+        self.mapDir = mapDir
+        if mapNames is not None:
+            self.mapNames = mapNames
+        self._maps = {}
+        for hemisphere, mapName in self.mapNames.items():
+            filename = os.path.join(mapDir, mapName)
+            if not os.path.exists(filename):
+                raise IOError("SFD dust map %s does not exist" % filename)
+            image, header = _memmapFitsImage(filename)
+            nsgp = header.get("LAM_NSGP", 1 if hemisphere == "ngp" else -1)
+            self._maps[hemisphere] = Struct(image=image,
+                                            scale=float(header.get("LAM_SCAL", 0.5*image.shape[1])),
+                                            nsgp=int(nsgp),
+                                            xCen=float(header.get("CRPIX1", 0.5*(image.shape[1] + 1))) - 1.0,
+                                            yCen=float(header.get("CRPIX2", 0.5*(image.shape[0] + 1))) - 1.0)
+
+    def ebv(self, ra, dec):
+        """Return E(B-V) at the given equatorial positions
+
+        Parameters
+        ----------
+        ra, dec : `numpy.ndarray`
+           Right Ascension and Declination (in radians).
+
+        Returns
+        -------
+        ebvValues : `numpy.ndarray`
+           Bilinearly interpolated SFD98 E(B-V) values (in mags).  Non-finite positions return NaN.
+        """
+        gl, gb = equatorialToGalactic(ra, dec)
+        ebvValues = np.full(gl.shape, np.nan, dtype=np.float64)
+        finite = np.isfinite(gl) & np.isfinite(gb)
+        for hemisphere, select in (("ngp", finite & (gb >= 0.0)), ("sgp", finite & (gb < 0.0))):
+            if select.any():
+                ebvValues[select] = self._interpolate(self._maps[hemisphere], gl[select], gb[select])
+        return ebvValues
+
+    @staticmethod
+    def _interpolate(sfdMap, gl, gb):
+        """Bilinearly interpolate a single hemisphere map at the given Galactic coordinates"""
+        rho = sfdMap.scale*np.sqrt(1.0 - sfdMap.nsgp*np.sin(gb))
+        x = sfdMap.xCen + rho*np.cos(gl)
+        y = sfdMap.yCen - sfdMap.nsgp*rho*np.sin(gl)
+        ny, nx = sfdMap.image.shape
+        x0 = np.clip(np.floor(x).astype(np.int64), 0, nx - 2)
+        y0 = np.clip(np.floor(y).astype(np.int64), 0, ny - 2)
+        fx = np.clip(x - x0, 0.0, 1.0)
+        fy = np.clip(y - y0, 0.0, 1.0)
+        image = sfdMap.image
+        return ((1.0 - fx)*(1.0 - fy)*image[y0, x0] + fx*(1.0 - fy)*image[y0, x0 + 1] +
+                (1.0 - fx)*fy*image[y0 + 1, x0] + fx*fy*image[y0 + 1, x0 + 1])
+
+
+_sfdDustMaps = {}
+
+
+def findSfdDustMapDir(mapDir=None):
+    """Return the directory of the SFD98 dust maps
+
+    Parameters
+    ----------
+    mapDir : `str` or `None`
+       Directory containing the SFD98 map files.  If `None`, the $SFD_DIR and $DUST_DIR (in which the
+       maps are expected in a "maps" subdirectory) environment variables are tried in turn.
+
+    Raises
+    ------
+    `IOError`
+       If no directory containing the SFD98 maps could be found.
+
+    Returns
+    -------
+    mapDir : `str`
+       Absolute path of the directory.
+    """
+    if mapDir is None:
+        candidates = []
+        if os.environ.get("SFD_DIR"):
+            candidates.append(os.environ["SFD_DIR"])
+        if os.environ.get("DUST_DIR"):
+            candidates.append(os.path.join(os.environ["DUST_DIR"], "maps"))
+            candidates.append(os.environ["DUST_DIR"])
+        for candidate in candidates:
+            if all(os.path.exists(os.path.join(candidate, mapName)) for
+                   mapName in SfdDustMap.mapNames.values()):
+                mapDir = candidate
+                break
+        else:
+            raise IOError("No SFD dust map directory configured and none found in $SFD_DIR or $DUST_DIR")
+    return os.path.abspath(os.path.expanduser(mapDir))
+
+
+def getSfdDustMapFilenames(mapDir=None):
+    """Return the filenames of the SFD98 dust maps (see `findSfdDustMapDir`)
+
+    Used to identify the dust map inputs of a task stage (see `computeInputKey`); an empty list is
+    returned if no local maps are found (the E(B-V) values are then not looked up in local files).
+    """
+    try:
+        mapDir = findSfdDustMapDir(mapDir)
+    except IOError:
+        return []
+    return [os.path.join(mapDir, mapName) for mapName in sorted(SfdDustMap.mapNames.values())]
+
+
+def getSfdDustMap(mapDir=None):
+    """Return a (cached) SfdDustMap for the SFD98 maps in mapDir
+
+    We instantiate this once only per directory, so that the memory-mapped maps (and any pages
+    already read) are shared across filters, tracts and tasks in the same process.
+
+    Parameters
+    ----------
+    mapDir : `str` or `None`
+       Directory containing the SFD98 map files.  If `None`, the $SFD_DIR and $DUST_DIR (in which the
+       maps are expected in a "maps" subdirectory) environment variables are tried in turn.
+
+    Raises
+    ------
+    `IOError`
+       If no directory containing the SFD98 maps could be found.
+
+    Returns
+    -------
+    sfdDustMap : `lsst.pipe.analysis.utils.SfdDustMap`
+    """
+    mapDir = findSfdDustMapDir(mapDir)
+    if mapDir not in _sfdDustMaps:
+        _sfdDustMaps[mapDir] = SfdDustMap(mapDir)
+    return _sfdDustMaps[mapDir]
+
+
 @contextmanager
 def andCatalog(version):
     eups = getEups()
@@ -1005,6 +2506,21 @@ def andCatalog(version):
         eups.setup("astrometry_net_data", current, noRecursion=True)
 
 
+def getAndCatalogFilenames(version):
+    """Return the filenames of the astrometry_net_data catalog of the given version
+
+    Used to identify the inputs of the external catalog matches (see `computeInputKey`); an empty
+    list is returned if the catalog cannot be found.
+    """
+    try:
+        product = getEups().findProduct("astrometry_net_data", version)
+    except Exception:
+        product = None
+    if product is None or not product.dir:
+        return []
+    return sorted(glob.glob(os.path.join(product.dir, "*")))
+
+
 def getRepoInfo(dataRef, coaddName=None, coaddDataset=None, doApplyUberCal=False):
     """Obtain the relevant repository information for the given dataRef
 
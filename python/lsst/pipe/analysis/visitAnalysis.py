@@ -10,34 +10,50 @@ np.seterr(all="ignore")  # noqa 402
 from collections import defaultdict
 
 from lsst.daf.persistence.butler import Butler
-from lsst.pex.config import Field
+from lsst.pex.config import Field, ListField
 from lsst.pipe.base import ArgumentParser, TaskRunner, TaskError
 from lsst.meas.base.forcedPhotCcd import PerTractCcdDataIdContainer
 from lsst.afw.table.catalogMatches import matchesToCatalog
-from .analysis import Analysis
-from .coaddAnalysis import CoaddAnalysisConfig, CoaddAnalysisTask, CompareCoaddAnalysisTask
+from .renderScheduler import startRenderScheduler, finishRenderScheduler
+from .analysis import Analysis, startAnalysisMetrics, finishAnalysisMetrics
+from .focalPlaneMaps import startFocalPlaneMaps, getFocalPlaneMaps, finishFocalPlaneMaps
+from .coaddAnalysis import (CoaddAnalysisConfig, CoaddAnalysisTask, CompareCoaddAnalysisConfig,
+                            CompareCoaddAnalysisTask)
 from .utils import (Filenamer, concatenateCatalogs, addApertureFluxesHSC, addFpPoint,
                     addFootprintNPix, addRotPoint, makeBadArray, addIntFloatOrStrColumn,
                     calibrateSourceCatalogMosaic, calibrateSourceCatalog, backoutApCorr,
                     matchJanskyToDn, andCatalog, writeParquet, getRepoInfo, getDataExistsRefList,
-                    setAliasMaps)
-from .plotUtils import annotateAxes, labelVisit, labelCamera, plotText
+                    setAliasMaps, MatchStore, getInputFilenames, isStageUpToDate, finishOutputKeys,
+                    getBBoxSkyCircle, getAndCatalogFilenames, invalidateDerivedQuantities)
+from .plotUtils import (annotateAxes, labelVisit, labelCamera, plotText, plotDensity, clearCcdOutlineCache,
+                        clearBackgroundLayers)
 
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
 import lsst.afw.table as afwTable
 
 
+# Per-ccd datasets from which the outputs of a visit are derived (any not defined for the mapper are ignored)
+_visitInputDatasets = ["src", "srcMatch", "calexp", "jointcal_wcs", "jointcal_photoCalib", "wcs", "fcr_md",
+                       "wcs_hsc", "fcr_hsc_md"]
+
+
 class CcdAnalysis(Analysis):
     def plotAll(self, dataId, filenamer, log, enforcer=None, butler=None, camera=None, ccdList=None,
                 tractInfo=None, patchList=None, hscRun=None, matchRadius=None, zpLabel=None, forcedStr=None,
                 postFix="", plotRunStats=True, highlightList=None, haveFpCoords=None):
         stats = self.stats
+        focalPlaneMaps = getFocalPlaneMaps()
+        if focalPlaneMaps is not None and self.prefix + "ccdId" in self.catalog.schema:
+            self.accumulateFocalPlaneMaps(focalPlaneMaps, postFix=postFix)
         if self.config.doPlotCcdXy:
-            self.plotCcd(filenamer(dataId, description=self.shortName, style="ccd" + postFix),
-                         stats=self.stats, hscRun=hscRun, matchRadius=matchRadius, zpLabel=zpLabel)
+            filename = filenamer(dataId, description=self.shortName, style="ccd" + postFix)
+            self.render(filename, self.plotCcd, filename, stats=self.stats, hscRun=hscRun,
+                        matchRadius=matchRadius, zpLabel=zpLabel)
         if self.config.doPlotFP and haveFpCoords:
-            self.plotFocalPlane(filenamer(dataId, description=self.shortName, style="fpa" + postFix),
-                                stats=stats, camera=camera, ccdList=ccdList, hscRun=hscRun,
-                                matchRadius=matchRadius, zpLabel=zpLabel)
+            filename = filenamer(dataId, description=self.shortName, style="fpa" + postFix)
+            self.render(filename, self.plotFocalPlane, filename, stats=stats, camera=camera,
+                        ccdList=ccdList, hscRun=hscRun, matchRadius=matchRadius, zpLabel=zpLabel)
 
         return Analysis.plotAll(self, dataId, filenamer, log, enforcer=enforcer, butler=butler, camera=camera,
                                 ccdList=ccdList, hscRun=hscRun, matchRadius=matchRadius, zpLabel=zpLabel,
@@ -49,9 +65,27 @@ class CcdAnalysis(Analysis):
                             camera=camera, ccdList=ccdList, hscRun=hscRun, matchRadius=matchRadius,
                             zpLabel=zpLabel, forcedStr=forcedStr)
 
+    def accumulateFocalPlaneMaps(self, focalPlaneMaps, centroid="base_SdssCentroid", postFix=""):
+        """Accumulate the quantity of each label in cells of each CCD, for binned focal plane maps"""
+        ccdId = self.catalog[self.prefix + "ccdId"]
+        xx = self.catalog[self.prefix + centroid + "_x"]
+        yy = self.catalog[self.prefix + centroid + "_y"]
+        good = (self.mag < self.config.magThreshold if self.config.magThreshold > 0 else
+                np.ones(len(self.mag), dtype=bool))
+        for name, data in self.data.items():
+            if not data.plot:
+                continue
+            if len(data.mag) == 0:
+                continue
+            selection = data.selection & good
+            focalPlaneMaps.accumulate(self.shortName + postFix + "_" + name, ccdId[selection], xx[selection],
+                                      yy[selection], data.quantity[good[data.selection]])
+
     def plotCcd(self, filename, centroid="base_SdssCentroid", cmap=plt.cm.nipy_spectral, idBits=32,
                 visitMultiplier=200, stats=None, hscRun=None, matchRadius=None, zpLabel=None):
         """Plot quantity as a function of CCD x,y"""
+        if self.statsOnly:
+            return
         xx = self.catalog[self.prefix + centroid + "_x"]
         yy = self.catalog[self.prefix + centroid + "_y"]
         ccd = (self.catalog[self.prefix + "id"] >> idBits) % visitMultiplier
@@ -75,6 +109,14 @@ class CcdAnalysis(Analysis):
                 ptSize = min(12, max(4, int(25/np.log10(len(data.mag)))))
             selection = data.selection & good
             quantity = data.quantity[good[data.selection]]
+            if self.useDensity(selection.sum()):
+                # Colour by the (median) CCD index, as for the points
+                kwargs = {"statistic": "median", "cmap": cmap, "vmin": vMin, "vmax": vMax}
+                plotDensity(axes[0], xx[selection], quantity, values=ccd[selection],
+                            extent=(-100, 2150, self.qMin, self.qMax), **kwargs)
+                plotDensity(axes[1], yy[selection], quantity, values=ccd[selection],
+                            extent=(-100, 4300, self.qMin, self.qMax), **kwargs)
+                continue
             kwargs = {"s": ptSize, "marker": "o", "lw": 0, "alpha": 0.5, "cmap": cmap,
                       "vmin": vMin, "vmax": vMax}
             axes[0].scatter(xx[selection], quantity, c=ccd[selection], **kwargs)
@@ -108,6 +150,8 @@ class CcdAnalysis(Analysis):
     def plotFocalPlane(self, filename, cmap=plt.cm.Spectral, stats=None, camera=None, ccdList=None,
                        hscRun=None, matchRadius=None, zpLabel=None, forcedStr=None, fontSize=8):
         """Plot quantity colormaped on the focal plane"""
+        if self.statsOnly:
+            return
         xFp = self.catalog[self.prefix + "base_FPPosition_x"]
         yFp = self.catalog[self.prefix + "base_FPPosition_y"]
         good = (self.mag < self.config.magThreshold if self.config.magThreshold > 0 else
@@ -123,21 +167,36 @@ class CcdAnalysis(Analysis):
             vMax = np.round(self.data["star"].quantity.max() + 50, -2)
         fig, axes = plt.subplots(1, 1, subplot_kw=dict(facecolor="0.7"))
         axes.tick_params(which="both", direction="in", top=True, right=True, labelsize=fontSize)
+        densityImage = None
+        # Render all labels on a common grid, so the density images line up (base_FPPosition may be NaN)
+        finite = np.isfinite(xFp) & np.isfinite(yFp)
+        extent = ((xFp[finite].min(), xFp[finite].max(), yFp[finite].min(), yFp[finite].max()) if
+                  finite.any() else None)
         for name, data in self.data.items():
             if not data.plot:
                 continue
             if len(data.mag) == 0:
                 continue
             selection = data.selection & good
-            axes.scatter(xFp[selection], yFp[selection], s=2, marker="o", lw=0,
-                         c=data.quantity[good[data.selection]], cmap=cmap, vmin=vMin, vmax=vMax)
+            if self.useDensity(selection.sum()):
+                densityImage = plotDensity(axes, xFp[selection], yFp[selection],
+                                           values=data.quantity[good[data.selection]],
+                                           statistic=self.config.densityStatistic, extent=extent, cmap=cmap,
+                                           vmin=vMin, vmax=vMax)
+            else:
+                axes.scatter(xFp[selection], yFp[selection], s=2, marker="o", lw=0,
+                             c=data.quantity[good[data.selection]], cmap=cmap, vmin=vMin, vmax=vMax)
         axes.set_xlabel("x_fpa (pixels)")
         axes.set_ylabel("y_fpa (pixels)")
 
         mappable = plt.cm.ScalarMappable(cmap=cmap, norm=plt.Normalize(vmin=vMin, vmax=vMax))
         mappable._A = []        # fake up the array of the scalar mappable. Urgh...
+        colorbarLabel = self.quantityName
+        if densityImage is not None and self.config.densityStatistic == "count":
+            mappable = densityImage
+            colorbarLabel = "Number per pixel"
         cb = plt.colorbar(mappable)
-        cb.set_label(self.quantityName, rotation=270, labelpad=15)
+        cb.set_label(colorbarLabel, rotation=270, labelpad=15)
         if hscRun is not None:
             axes.set_title("HSC stack run: " + hscRun, color="#800080")
         labelVisit(filename, plt, axes, 0.5, 1.04)
@@ -154,11 +213,21 @@ class CcdAnalysis(Analysis):
 class VisitAnalysisConfig(CoaddAnalysisConfig):
     doApplyUberCal = Field(dtype=bool, default=True, doc="Apply meas_mosaic ubercal results to input?" +
                            " FLUXMAG0 zeropoint is applied if doApplyUberCal is False")
+    doFocalPlaneMaps = Field(dtype=bool, default=False,
+                             doc=("Accumulate the quantity of each analysis in a grid of cells on each CCD, "
+                                  "and render them as binned focal plane maps?"))
+    focalPlaneMapCells = ListField(dtype=int, default=[4, 8],
+                                   doc="Number of cells along the x and y axes of each CCD for the focal "
+                                       "plane maps")
+    focalPlaneMapDir = Field(dtype=str, default=None, optional=True,
+                             doc=("Directory in which to accumulate (and render) the focal plane maps over "
+                                  "all visits processed (per tract and filter); None: per visit only"))
 
     def setDefaults(self):
         CoaddAnalysisConfig.setDefaults(self)
         self.analysis.fluxColumn = "base_PsfFlux_instFlux"
         self.analysisMatches.fluxColumn = "base_PsfFlux_instFlux"
+        self.quiverBinning = "ccd"
 
     def validate(self):
         CoaddAnalysisConfig.validate(self)
@@ -197,6 +266,23 @@ class VisitAnalysisTask(CoaddAnalysisTask):
                             help="Tract(s) to use (do one at a time for overlapping) e.g. 1^5^0")
         return parser
 
+    @staticmethod
+    def ccdIdsAreDetectorIds(camera, ccdIds):
+        """Are the data id ccd values all (integer) ids of detectors of the camera?
+
+        The focal plane maps are accumulated by detector id (see `FocalPlaneMaps`), so they can only be
+        accumulated if the ccd values of the data ids (e.g. not raft-based strings) are detector ids.
+        """
+        detectorIds = set(detector.getId() for detector in camera)
+        return all(isinstance(ccdId, (int, np.integer)) and ccdId in detectorIds for ccdId in ccdIds)
+
+    @staticmethod
+    def getCcdSkyCircle(dataRef):
+        """Return the center and radius of a circle enclosing the CCD (from its calexp metadata)"""
+        metadata = dataRef.get("calexp_md")
+        return getBBoxSkyCircle(afwImage.bboxFromMetadata(metadata),
+                                afwGeom.makeSkyWcs(metadata, strip=False))
+
     def runDataRef(self, dataRefList, tract=None):
         self.log.info("dataRefList size: {:d}".format(len(dataRefList)))
         if tract is None:
@@ -229,6 +315,34 @@ class VisitAnalysisTask(CoaddAnalysisTask):
                                    "If not, run with --config doApplyUberCal=False".format(repoInfo.dataset))
                 raise RuntimeError("No datasets found for datasetType = {:s}".format(repoInfo.dataset))
             filenamer = Filenamer(repoInfo.butler, "plotVisit", repoInfo.dataId)
+            inputFilenames = getInputFilenames(dataRefListTract, _visitInputDatasets)
+            doSkip = self.config.doSkipUpToDate
+            if self.config.doPlotMatches:
+                refCatFilenames = self.getRefCatFilenames(repoInfo.butler,
+                                                          (self.getCcdSkyCircle(dataRef) for
+                                                           dataRef in dataRefListTract))
+                if refCatFilenames is None:
+                    doSkip = False
+                else:
+                    inputFilenames += refCatFilenames
+            for cat in self.config.externalCatalogs:
+                inputFilenames += getAndCatalogFilenames(cat)
+            if isStageUpToDate(filenamer, repoInfo.dataId, self._DefaultName, inputFilenames, self.config,
+                               doSkip=doSkip, log=self.log):
+                commonZpDone = True  # the common ZP plots are among the outputs of the first tract
+                continue
+            self.matchStore = MatchStore.fromFilenamer(filenamer, repoInfo.dataId,
+                                                       directory=self.config.matchStoreDir,
+                                                       doPersist=self.config.doPersistMatches)
+            startAnalysisMetrics(statsOnly=self.config.statsOnly)
+            startRenderScheduler(self.config.numRenderWorkers, log=self.log)
+            if self.config.doFocalPlaneMaps:
+                if self.ccdIdsAreDetectorIds(repoInfo.camera, [dataRef.dataId[repoInfo.ccdKey] for
+                                                               dataRef in dataRefListTract]):
+                    startFocalPlaneMaps(repoInfo.camera, numCells=self.config.focalPlaneMapCells)
+                else:
+                    self.log.warn("The {:s} values of the data ids are not detector ids of the camera: "
+                                  "not accumulating the focal plane maps".format(repoInfo.ccdKey))
             # Create list of alias mappings for differing schema naming conventions (if any)
             aliasDictList = [self.config.flagsToAlias, ]
             if repoInfo.hscRun is not None and self.config.srcSchemaMap is not None:
@@ -254,6 +368,10 @@ class VisitAnalysisTask(CoaddAnalysisTask):
                              badArray=badCommonZp)
                 if self.config.writeParquetOnly:
                     self.log.info("Exiting after writing Parquet tables.  No plots generated.")
+                    invalidateDerivedQuantities()
+                    clearBackgroundLayers()
+                    clearCcdOutlineCache()
+                    finishOutputKeys(log=self.log)
                     return
 
             # purge the catalogs of flagged sources
@@ -280,7 +398,7 @@ class VisitAnalysisTask(CoaddAnalysisTask):
                                 filenamer(repoInfo.dataId, description="ellipResids", style="quiver"),
                                 dataId=repoInfo.dataId, butler=repoInfo.butler, camera=repoInfo.camera,
                                 ccdList=ccdListPerTract, hscRun=repoInfo.hscRun, zpLabel=self.zpLabel,
-                                scale=2)
+                                scale=2, binning=self.config.quiverBinning)
 
             # Create mag comparison plots using common ZP
             if self.config.doPlotMags and not commonZpDone:
@@ -328,13 +446,29 @@ class VisitAnalysisTask(CoaddAnalysisTask):
             for cat in self.config.externalCatalogs:
                 if self.config.photoCatName not in cat:
                     with andCatalog(cat):
+                        tileIds = None
+                        if self.config.doTileExternalCatalogs and "ccdId" in catalog.schema:
+                            tileIds = catalog["ccdId"]
                         matches = self.matchCatalog(catalog, repoInfo.filterName,
-                                                    self.config.externalCatalogs[cat])
+                                                    self.config.externalCatalogs[cat], tileIds=tileIds,
+                                                    dataId=repoInfo.dataId, matchName="external_" + cat)
                         self.plotMatches(matches, repoInfo.filterName, filenamer, repoInfo.dataId,
                                          butler=repoInfo.butler, camera=repoInfo.camera,
                                          ccdList=ccdListPerTract, hscRun=repoInfo.hscRun,
                                          matchRadius=self.config.matchRadius, zpLabel=self.zpLabel)
 
+            finishFocalPlaneMaps(filenamer, {key: value for key, value in repoInfo.dataId.items() if
+                                             key != repoInfo.ccdKey},
+                                 directory=self.config.focalPlaneMapDir, doRender=not self.config.statsOnly,
+                                 log=self.log)
+            finishRenderScheduler()
+            finishAnalysisMetrics(filenamer if self.config.statsOnly or self.config.doWriteMetrics else None,
+                                  repoInfo.dataId, log=self.log)
+            invalidateDerivedQuantities()
+            clearBackgroundLayers()
+            clearCcdOutlineCache()
+            finishOutputKeys(log=self.log)
+
     def readCatalogs(self, dataRefList, dataset, repoInfo, aliasDictList=None):
         """Read in and concatenate catalogs of type dataset in lists of data references
 
@@ -380,8 +514,10 @@ class VisitAnalysisTask(CoaddAnalysisTask):
             if aliasDictList is not None:
                 catalog = setAliasMaps(catalog, aliasDictList)
 
-            # Add ccdId column (useful to have in Parquet tables for subsequent interactive analysis)
-            if self.config.doWriteParquetTables:
+            # Add ccdId column (useful to have in Parquet tables for subsequent interactive analysis, and
+            # for binning the quiver plot whiskers and focal plane maps by CCD)
+            if (self.config.doWriteParquetTables or self.config.quiverBinning == "ccd" or
+                    self.config.doFocalPlaneMaps):
                 catalog = addIntFloatOrStrColumn(catalog, dataRef.dataId[repoInfo.ccdKey], "ccdId",
                                                  "Id of CCD on which source was detected")
 
@@ -455,7 +591,7 @@ class VisitAnalysisTask(CoaddAnalysisTask):
             matchmeta = packedMatches.table.getMetadata()
             rad = matchmeta.getDouble("RADIUS")
             matchmeta.setDouble("RADIUS", rad*1.05, "field radius in degrees, approximate, padded")
-            refObjLoader = self.config.refObjLoader.apply(butler=repoInfo.butler)
+            refObjLoader = self.getRefObjLoader(repoInfo.butler)
             matches = refObjLoader.joinMatchListWithCatalog(packedMatches, catalog)
             if not hasattr(matches[0].first, "schema"):
                 raise RuntimeError("Unable to unpack matches.  "
@@ -528,7 +664,7 @@ class VisitAnalysisTask(CoaddAnalysisTask):
         return calibrated
 
 
-class CompareVisitAnalysisConfig(VisitAnalysisConfig):
+class CompareVisitAnalysisConfig(VisitAnalysisConfig, CompareCoaddAnalysisConfig):
     doApplyUberCal1 = Field(dtype=bool, default=True, doc="Apply meas_mosaic ubercal results to input1?" +
                             " FLUXMAG0 zeropoint is applied if doApplyUberCal is False")
     doApplyUberCal2 = Field(dtype=bool, default=True, doc="Apply meas_mosaic ubercal results to input2?" +
@@ -658,6 +794,13 @@ class CompareVisitAnalysisTask(CompareCoaddAnalysisTask):
                 raise RuntimeError("No datasets found for datasetType = {:s}".format(repoInfo2.dataset))
             self.log.info("tract: {:d} ".format(repoInfo1.dataId["tract"]))
             self.log.info("ccdListPerTract1: {} ".format(ccdListPerTract1))
+            filenamer = Filenamer(repoInfo1.butler, "plotCompareVisit", repoInfo1.dataId)
+            if isStageUpToDate(filenamer, repoInfo1.dataId, self._DefaultName,
+                               (getInputFilenames(dataRefListTract1, _visitInputDatasets) +
+                                getInputFilenames(dataRefListTract2, _visitInputDatasets)), self.config,
+                               doSkip=self.config.doSkipUpToDate, log=self.log):
+                commonZpDone = True  # the common ZP plots are among the outputs of the first tract
+                continue
             doReadFootprints = None
             if self.config.doPlotFootprintNpix:
                 doReadFootprints = "light"
@@ -688,8 +831,12 @@ class CompareVisitAnalysisTask(CompareCoaddAnalysisTask):
 
             self.log.info("\nNumber of sources in catalogs: first = {0:d} and second = {1:d}".format(
                           len(catalog1), len(catalog2)))
-            commonZpCat = self.matchCatalogs(commonZpCat1, commonZpCat2)
-            catalog = self.matchCatalogs(catalog1, catalog2)
+            self.matchStore = MatchStore.fromFilenamer(filenamer, repoInfo1.dataId,
+                                                       directory=self.config.matchStoreDir,
+                                                       doPersist=self.config.doPersistMatches)
+            commonZpCat = self.matchCatalogs(commonZpCat1, commonZpCat2, dataId=repoInfo1.dataId,
+                                             matchName="commonZp")
+            catalog = self.matchCatalogs(catalog1, catalog2, dataId=repoInfo1.dataId, matchName="catalog")
             # Set some aliases for differing schema naming conventions
             if aliasDictList is not None:
                 for cat in [commonZpCat, catalog]:
@@ -703,8 +850,9 @@ class CompareVisitAnalysisTask(CompareCoaddAnalysisTask):
             except Exception:
                 pass
 
-            filenamer = Filenamer(repoInfo1.butler, "plotCompareVisit", repoInfo1.dataId)
             hscRun = repoInfo1.hscRun if repoInfo1.hscRun is not None else repoInfo2.hscRun
+            startAnalysisMetrics(statsOnly=self.config.statsOnly)
+            startRenderScheduler(self.config.numRenderWorkers, log=self.log)
             if self.config.doPlotFootprintNpix:
                 self.plotFootprint(catalog, filenamer, repoInfo1.dataId, butler=repoInfo1.butler,
                                    camera=repoInfo1.camera, ccdList=ccdListPerTract1, hscRun=hscRun,
@@ -752,6 +900,14 @@ class CompareVisitAnalysisTask(CompareCoaddAnalysisTask):
                                  camera=repoInfo1.camera, ccdList=ccdListPerTract1, hscRun=hscRun,
                                  matchRadius=self.config.matchRadius, zpLabel=self.zpLabel)
 
+            finishRenderScheduler()
+            finishAnalysisMetrics(filenamer if self.config.statsOnly or self.config.doWriteMetrics else None,
+                                  repoInfo1.dataId, log=self.log)
+            invalidateDerivedQuantities()
+            clearBackgroundLayers()
+            clearCcdOutlineCache()
+            finishOutputKeys(log=self.log)
+
     def readCatalogs(self, dataRefList1, dataRefList2, dataset, repoInfo1, repoInfo2,
                      doReadFootprints=None, aliasDictList=None):
         """Read in and concatenate catalogs of type dataset in lists of data references